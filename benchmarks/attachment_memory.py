@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.attachment_memory
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measure the peak memory(RSS) needed to encode, and stream, a message with a single file
+    attachment of increasing sizes. Each size is measured in a separate process.
+
+    Usage::
+
+        python benchmarks/attachment_memory.py [--baseline] [SIZE_MB ...]
+
+    ``--baseline`` measures the previous approach, the whole file read and encoded in memory
+    and the message flattened with ``as_string()``, for comparison.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def measure(size_mb, baseline=False):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from saltci.notif import stream
+
+    fd, path = tempfile.mkstemp(prefix='saltci-bench-')
+    try:
+        with os.fdopen(fd, 'wb') as wfh:
+            block = os.urandom(1024 * 1024)
+            for _ in xrange(size_mb):
+                wfh.write(block)
+            del block
+
+        msg = MIMEMultipart()
+        msg.attach(MIMEText('Build log attached', _charset='utf-8'))
+        start = time.time()
+        if baseline:
+            from email.encoders import encode_base64
+            from email.mime.base import MIMEBase
+            attachment = MIMEBase('application', 'octet-stream')
+            attachment.set_payload(open(path, 'rb').read())
+            encode_base64(attachment)
+            msg.attach(attachment)
+            chunks = stream.quote_stream([msg.as_string()])
+        else:
+            msg.attach(stream.FileAttachment(path, 'application', 'octet-stream'))
+            chunks = stream.quote_stream(stream.iter_message(msg))
+
+        sent = 0
+        for chunk in chunks:
+            sent += len(chunk)
+        return {
+            'attachment_mb': size_mb,
+            'baseline': baseline,
+            'bytes_streamed': sent,
+            'seconds': round(time.time() - start, 3),
+            # ru_maxrss is in kilobytes on Linux
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        }
+    finally:
+        os.unlink(path)
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '--child':
+        print json.dumps(measure(int(args[1]), baseline=args[2] == '1'))
+        return
+
+    baseline = '--baseline' in args
+    sizes = [int(arg) for arg in args if not arg.startswith('--')] or [1, 10, 100, 300]
+    results = []
+    for size_mb in sizes:
+        output = subprocess.Popen(
+            [sys.executable, __file__, '--child', str(size_mb), baseline and '1' or '0'],
+            stdout=subprocess.PIPE
+        ).communicate()[0]
+        results.append(json.loads(output))
+    print json.dumps(results, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.mimetype_detection
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Micro-benchmark the attachment MIME type detection over 1,000 attachments, comparing the
+    previous approach, loading the magic database for every attachment, against the process
+    wide, cached, detector.
+
+    Usage::
+
+        python benchmarks/mimetype_detection.py [ATTACHMENTS]
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import mimetypes
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+EXTENSIONS = ('.log', '.txt', '.xml', '.html', '.tar.gz', '.png', '.json', '')
+
+
+def previous_detect_mimetype(filename):
+    try:
+        import magic
+        mag = magic.open(magic.MAGIC_MIME)
+        mag.load()
+        return mag.file(filename).split(';')[0].split('/')
+    except (ImportError, AttributeError):
+        mimetype = mimetypes.guess_type(filename)[0]
+        if mimetype is None:
+            return ('text', 'plain')
+        return mimetype.split('/')
+
+
+def timed(func, filenames):
+    start = time.time()
+    for filename in filenames:
+        func(filename)
+    elapsed = time.time() - start
+    return {
+        'seconds': round(elapsed, 6),
+        'per_attachment_us': round(elapsed / len(filenames) * 1000000, 3)
+    }
+
+
+def main():
+    from saltci.notif import mime
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    tmpdir = tempfile.mkdtemp(prefix='saltci-bench-')
+    try:
+        filenames = []
+        for idx in xrange(count):
+            filename = os.path.join(
+                tmpdir, 'attachment-{0}{1}'.format(idx, EXTENSIONS[idx % len(EXTENSIONS)])
+            )
+            with open(filename, 'w') as wfh:
+                wfh.write('test output line {0}\n'.format(idx) * 10)
+            filenames.append(filename)
+
+        try:
+            import magic
+            backend = 'libmagic'
+        except ImportError:
+            backend = 'mimetypes'
+
+        detector = mime.MimeTypeDetector(cache_size=count)
+        results = {
+            'attachments': count,
+            'backend': backend,
+            'previous': timed(previous_detect_mimetype, filenames),
+            'cold_cache': timed(detector.detect, filenames),
+            'warm_cache': timed(detector.detect, filenames)
+        }
+        print json.dumps(results, indent=2)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.smtpsink
+    ~~~~~~~~~~~~~~~~~~~
+
+    A local, in-process, stand-in SMTP server which accepts, and discards, every message.
+
+    It advertises ``PIPELINING``, ``SIZE`` and ``AUTH`` and accepts any credentials, which is
+    enough to exercise every sendmail code path without a real relay.
+
+    To resemble a real relay, it can take ``latency`` seconds to accept each message and defer,
+    with a ``451``, a ``reject_rate`` fraction of them. Which messages get deferred is decided by
+    a random generator seeded with ``seed``, so runs are reproducible.
+
+    Usage::
+
+        sink = SMTPSink(('127.0.0.1', 0), latency=0.005, reject_rate=0.01)
+        sink.start()
+        host, port = sink.server_address
+        ...
+        sink.stop()
+
+    Or, to run it standalone::
+
+        python benchmarks/smtpsink.py [--latency SECONDS] [--reject-rate RATE] [PORT]
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import random
+import socket
+import optparse
+import threading
+import SocketServer
+
+
+class SMTPSinkHandler(SocketServer.StreamRequestHandler):
+    '''
+    Handle a single SMTP session.
+    '''
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        # Replies to pipelined commands are written one by one
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        sink = self.server
+        sink.increment('sessions')
+        self.reply('220 salt-ci SMTP sink')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().split(' ', 1)[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250-salt-ci')
+                self.reply('250-PIPELINING')
+                self.reply('250-SIZE 0')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif command == 'AUTH':
+                self.reply('235 Authentication successful')
+            elif command == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipients.append(line.strip())
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == '.\r\n':
+                        break
+                    size += len(line)
+                if sink.latency:
+                    time.sleep(sink.latency)
+                if sink.reject():
+                    sink.increment('rejected')
+                    self.reply('451 Try again later')
+                    continue
+                sink.increment('messages')
+                sink.increment('recipients', len(recipients))
+                sink.increment('bytes', size)
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                # NOOP, RSET, etc
+                self.reply('250 OK')
+
+
+class SMTPSink(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''
+    A threaded SMTP server which counts, and discards, every message it receives.
+    '''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address=('127.0.0.1', 0), latency=0, reject_rate=0, seed=0):
+        SocketServer.TCPServer.__init__(self, server_address, SMTPSinkHandler)
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reset()
+
+    def reset(self):
+        '''
+        Zero the counters and restart the sequence of deferrals.
+        '''
+        self.counters = dict(sessions=0, messages=0, recipients=0, bytes=0, rejected=0)
+        self._random = random.Random(self.seed)
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def reject(self):
+        '''
+        Should the current message be deferred?
+        '''
+        if not self.reject_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.reject_rate
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='SMTPSink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] [PORT]')
+    parser.add_option('--latency', type=float, default=0, help='Seconds to accept a message.')
+    parser.add_option(
+        '--reject-rate', type=float, default=0, help='The fraction of messages to defer.'
+    )
+    parser.add_option('--seed', type=int, default=0)
+    options, args = parser.parse_args()
+    sink = SMTPSink(
+        ('127.0.0.1', int(args[0]) if args else 2525),
+        latency=options.latency, reject_rate=options.reject_rate, seed=options.seed
+    )
+    print 'SMTP sink listening on {0}:{1}'.format(*sink.server_address)
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        print sink.counters
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.startup
+    ~~~~~~~~~~~~~~~~~~
+
+    Measure the startup cost of the modules the console scripts import. Each target is imported
+    in a fresh interpreter, ``--runs`` times, and the wall time of the whole process, interpreter
+    startup included, is reported along with, ``python -X importtime`` style, the slowest
+    imports of the last run.
+
+    A target is a module name, optionally followed by ``:<attribute>`` to also read an attribute
+    after importing it, for example, ``saltci:__version__``.
+
+    Usage::
+
+        python benchmarks/startup.py [--runs N] [--budget MS] [--imports N] [TARGET ...]
+
+    With ``--budget``, the exit code is 1 if any target's median wall time, in milliseconds,
+    exceeds it.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import sys
+import json
+import time
+import optparse
+import subprocess
+import __builtin__
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+DEFAULT_TARGETS = (
+    'saltci',
+    'saltci:__version__',
+    'saltci.scripts',
+    'saltci.config',
+    'saltci.notif.cli'
+)
+
+
+def measure(target, top):
+    '''
+    Import ``target``, timing every module it imports. Runs on the child process.
+    '''
+    sys.path.insert(0, ROOT_DIR)
+    original_import = __builtin__.__import__
+    timings = {}
+    # The time spent on nested imports, for each import on the stack
+    stack = []
+
+    def timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return original_import(name, *args, **kwargs)
+        stack.append(0.0)
+        start = time.time()
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if name not in timings:
+                timings[name] = (elapsed - nested, elapsed)
+
+    module, _, attribute = target.partition(':')
+    __builtin__.__import__ = timed_import
+    start = time.time()
+    try:
+        __import__(module)
+        if attribute:
+            getattr(sys.modules[module], attribute)
+        error = None
+    except Exception, err:
+        error = '{0}: {1}'.format(err.__class__.__name__, err)
+    finally:
+        __builtin__.__import__ = original_import
+
+    slowest = sorted(timings.iteritems(), key=lambda item: item[1][1], reverse=True)[:top]
+    return {
+        'import_ms': round((time.time() - start) * 1000, 3),
+        'error': error,
+        'imports': [
+            {
+                'module': name,
+                'self_ms': round(own * 1000, 3),
+                'cumulative_ms': round(cumulative * 1000, 3)
+            } for name, (own, cumulative) in slowest
+        ]
+    }
+
+
+def run(target, runs, top):
+    walls = []
+    result = None
+    for _ in xrange(runs):
+        start = time.time()
+        output = subprocess.Popen(
+            [sys.executable, __file__, '--child', target, str(top)], stdout=subprocess.PIPE
+        ).communicate()[0]
+        walls.append((time.time() - start) * 1000)
+        result = json.loads(output)
+    walls.sort()
+    result.update(
+        target=target,
+        runs=runs,
+        wall_ms_min=round(walls[0], 3),
+        wall_ms_median=round(walls[len(walls) // 2], 3),
+        wall_ms_max=round(walls[-1], 3)
+    )
+    return result
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        print json.dumps(measure(sys.argv[2], int(sys.argv[3])))
+        return
+
+    parser = optparse.OptionParser(usage='%prog [options] [TARGET ...]')
+    parser.add_option('--runs', type='int', default=10)
+    parser.add_option('--budget', type='float', default=None)
+    parser.add_option('--imports', type='int', default=10,
+                      help='How many of the slowest imports to report')
+    options, targets = parser.parse_args()
+
+    results = [
+        run(target, options.runs, options.imports) for target in targets or DEFAULT_TARGETS
+    ]
+    print json.dumps(results, indent=2)
+
+    if options.budget is not None:
+        over = [
+            result['target'] for result in results
+            if result['error'] is None and result['wall_ms_median'] > options.budget
+        ]
+        if over:
+            sys.stderr.write(
+                'Over the {0}ms startup budget: {1}\n'.format(options.budget, ', '.join(over))
+            )
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    benchmarks.throughput
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Measure the sendmail module's throughput, latency and peak memory(RSS) delivering realistic
+    message mixes to the local SMTP sink, see :mod:`benchmarks.smtpsink`, through each of it's
+    delivery paths:
+
+    ``send``
+        One ``sendmail.send`` call per message, delivered before it returns.
+    ``send_many``
+        ``sendmail.send_many`` calls of ``--batch`` messages each.
+    ``async``
+        ``sendmail.send`` calls with the ``async`` engine, the run ends once the engine has
+        delivered every message.
+
+    The message mixes are:
+
+    ``plain``
+        Text messages to 1 to 5 recipients.
+    ``html``
+        Text and HTML alternative messages to 1 to 5 recipients.
+    ``attachment``
+        Text messages with an ``--attachment-mb`` megabytes binary attachment.
+    ``fanout``
+        Text messages to 1 to 500 recipients.
+    ``mixed``
+        60% ``plain``, 25% ``html``, 10% ``fanout`` and 5% ``attachment`` messages.
+
+    The sink runs on this process, and each mix and path combination on a separate one, which
+    reports:
+
+    * ``msgs_per_sec``, the messages delivered per second.
+    * ``call_ms``, the 50th and 99th percentiles, and maximum, of the time each call took, one
+      message per call except for ``send_many``.
+    * ``delivery_ms``, the 50th and 99th percentiles of the time each message took to be
+      delivered, from the ``delivery_seconds`` metric.
+    * ``max_rss_kb``, the process' peak memory.
+
+    The messages are generated from ``--seed`` and so are the sink's deferrals, so runs of the
+    same revision are comparable. ``--output`` writes the results, as JSON, to a file which can
+    be passed to ``--compare`` on later runs, adding each result's relative change to it.
+
+    Usage::
+
+        python benchmarks/throughput.py [--messages N] [--latency SECONDS] [--reject-rate RATE]
+                                        [--output FILE] [--compare FILE] [MIX[:PATH] ...]
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import optparse
+import resource
+import platform
+import tempfile
+import subprocess
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_DIR)
+
+# Import the SMTP sink, which lives next to this script
+from smtpsink import SMTPSink
+
+MIXES = {
+    'plain': (('plain', 1.0),),
+    'html': (('html', 1.0),),
+    'attachment': (('attachment', 1.0),),
+    'fanout': (('fanout', 1.0),),
+    'mixed': (('plain', 0.6), ('html', 0.25), ('fanout', 0.1), ('attachment', 0.05))
+}
+PATHS = ('send', 'send_many', 'async')
+
+WORDS = (
+    'build', 'failed', 'passed', 'minion', 'state', 'highstate', 'test', 'suite', 'error',
+    'traceback', 'salt', 'master', 'returned', 'changes', 'duration', 'seconds', 'branch'
+)
+
+
+def percentile(values, q):
+    '''
+    The nearest-rank ``q`` percentile of the sorted ``values``.
+    '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))]
+
+
+def _text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    lines = [' '.join(words[idx:idx + 12]) for idx in xrange(0, len(words), 12)]
+    return '\n'.join(lines)
+
+
+def _recipients(rng, count):
+    return [
+        'dev{0}@example{1}.com'.format(rng.randint(0, 10000), rng.randint(0, 9))
+        for _ in xrange(count)
+    ]
+
+
+def make_spec(kind, rng, attachment):
+    '''
+    Return the ``sendmail.send`` keyword arguments of a message of the ``kind`` kind.
+    '''
+    spec = {
+        'subject': 'Build #{0} {1}'.format(rng.randint(1, 100000), rng.choice(WORDS)),
+        'body': _text(rng, rng.randint(500, 4000))
+    }
+    if kind == 'fanout':
+        spec['recipients'] = _recipients(rng, rng.randint(1, 500))
+    else:
+        spec['recipients'] = _recipients(rng, rng.randint(1, 5))
+    if kind == 'html':
+        spec['html'] = '<html><body>{0}</body></html>'.format(
+            ''.join([
+                '<p>{0}</p>'.format(line) for line in _text(rng, 16000).splitlines()
+            ])
+        )
+    elif kind == 'attachment':
+        spec['attachments'] = [attachment]
+    return spec
+
+
+def make_specs(mix, messages, seed, attachment):
+    rng = random.Random(seed)
+    kinds = []
+    for kind, weight in MIXES[mix]:
+        kinds.extend([kind] * int(weight * 100))
+    return [make_spec(rng.choice(kinds), rng, attachment) for _ in xrange(messages)]
+
+
+def measure(mix, path, options, port):
+    '''
+    Deliver ``options.messages`` messages of the ``mix`` mix through the ``path`` path. Runs on
+    the child process.
+    '''
+    from saltci.notif import engine, metrics
+    from saltci.notif.modules import sendmail
+
+    tmpdir = tempfile.mkdtemp(prefix='saltci-bench-')
+    try:
+        attachment = os.path.join(tmpdir, 'build.tar.gz')
+        with open(attachment, 'wb') as wfh:
+            block = os.urandom(1024 * 1024)
+            for _ in xrange(options.attachment_mb):
+                wfh.write(block)
+            del block
+
+        sendmail.__opts__ = {
+            'cachedir': tmpdir,
+            'sendmail': {
+                'smtp_host': '127.0.0.1',
+                'smtp_port': port,
+                'smtp_user': 'bench',
+                'smtp_pass': 'bench',
+                'sender': 'salt-ci@example.com',
+                'engine': path == 'async' and 'async' or 'sync',
+                'engine_max_pending': 0,
+                'deferral_retry_delay': options.retry_delay
+            }
+        }
+        sendmail.__pillar__ = {}
+        sendmail.__context__ = {}
+
+        specs = make_specs(mix, options.messages, options.seed, attachment)
+        calls = []
+        errors = 0
+        start = time.time()
+        if path == 'send_many':
+            for idx in xrange(0, len(specs), options.batch):
+                call_start = time.time()
+                status = sendmail.send_many(specs[idx:idx + options.batch])
+                calls.append(time.time() - call_start)
+                errors += len([ret for ret in status.itervalues() if isinstance(ret, dict)])
+        else:
+            for spec in specs:
+                call_start = time.time()
+                ret = sendmail.send(**spec)
+                calls.append(time.time() - call_start)
+                errors += isinstance(ret, dict)
+            if path == 'async':
+                delivery_engine = engine.get_engine(sendmail._get_config())
+                delivery_engine.join()
+                errors += delivery_engine.failed
+        seconds = time.time() - start
+
+        calls.sort()
+        delivery = metrics.DELIVERY.snapshot()
+        return {
+            'mix': mix,
+            'path': path,
+            'messages': len(specs),
+            'errors': errors,
+            'deferrals': metrics.DEFERRALS.snapshot(),
+            'seconds': round(seconds, 3),
+            'msgs_per_sec': round(len(specs) / seconds, 1),
+            'call_ms': {
+                'p50': round(percentile(calls, 0.5) * 1000, 3),
+                'p99': round(percentile(calls, 0.99) * 1000, 3),
+                'max': round(calls[-1] * 1000, 3)
+            },
+            'delivery_ms': {
+                'p50': round((delivery.get('p50') or 0) * 1000, 3),
+                'p99': round((delivery.get('p99') or 0) * 1000, 3)
+            },
+            # ru_maxrss is in kilobytes on Linux
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        }
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run(mix, path, options, sink):
+    sink.reset()
+    output = subprocess.Popen(
+        [sys.executable, __file__, '--child', mix, path, str(sink.server_address[1]),
+         json.dumps(options.__dict__)],
+        stdout=subprocess.PIPE
+    ).communicate()[0]
+    result = json.loads(output)
+    result['sink'] = dict(sink.counters)
+    return result
+
+
+def compare(results, baseline):
+    '''
+    Add to each result it's relative change to the matching ``baseline`` result.
+    '''
+    previous = dict([
+        ((result['mix'], result['path']), result) for result in baseline.get('results', ())
+    ])
+    for result in results:
+        other = previous.get((result['mix'], result['path']))
+        if other is None:
+            continue
+        change = {}
+        for name, value, old in (
+                ('msgs_per_sec', result['msgs_per_sec'], other['msgs_per_sec']),
+                ('call_p99_ms', result['call_ms']['p99'], other['call_ms']['p99']),
+                ('delivery_p99_ms', result['delivery_ms']['p99'], other['delivery_ms']['p99']),
+                ('max_rss_kb', result['max_rss_kb'], other['max_rss_kb'])):
+            if old:
+                change[name] = '{0:+.1%}'.format((value - old) / float(old))
+        result['change'] = change
+
+
+def _revision():
+    try:
+        return subprocess.Popen(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        ).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        options = optparse.Values(json.loads(sys.argv[5]))
+        print json.dumps(measure(sys.argv[2], sys.argv[3], options, int(sys.argv[4])))
+        return
+
+    parser = optparse.OptionParser(usage='%prog [options] [MIX[:PATH] ...]')
+    parser.add_option('--messages', type='int', default=200,
+                      help='How many messages each run delivers')
+    parser.add_option('--batch', type='int', default=50,
+                      help='How many messages each send_many call delivers')
+    parser.add_option('--attachment-mb', type='int', default=2)
+    parser.add_option('--latency', type='float', default=0.001,
+                      help='Seconds the sink takes to accept each message')
+    parser.add_option('--reject-rate', type='float', default=0.01,
+                      help='The fraction of messages the sink defers')
+    parser.add_option('--retry-delay', type='float', default=0.01,
+                      help='Seconds to wait before retrying a deferred delivery')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--output', default=None, help='Also write the results to this file')
+    parser.add_option('--compare', default=None,
+                      help='A previous run\'s output to compare the results with')
+    options, args = parser.parse_args()
+
+    runs = []
+    for arg in args or sorted(MIXES):
+        mix, _, path = arg.partition(':')
+        if mix not in MIXES or (path and path not in PATHS):
+            parser.error('Unknown mix or path: {0}'.format(arg))
+        runs.extend([(mix, path)] if path else [(mix, each) for each in PATHS])
+
+    sink = SMTPSink(
+        ('127.0.0.1', 0), latency=options.latency, reject_rate=options.reject_rate,
+        seed=options.seed
+    )
+    sink.start()
+    try:
+        results = [run(mix, path, options, sink) for mix, path in runs]
+    finally:
+        sink.stop()
+
+    if options.compare:
+        with open(options.compare) as rfh:
+            compare(results, json.load(rfh))
+
+    report = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'options': options.__dict__,
+        'results': results
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as wfh:
+            wfh.write(output + '\n')
+    print output
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,9 @@
     :license: Apache 2.0, see LICENSE for more details.
 '''
 
-from saltci.version import __version__, __version_info__
+# Import python libs
+import sys
+from types import ModuleType
 
 __package_name__    = 'Salt-CI'
 __summary__         = 'Salt Continuous Integration'
@@ -18,3 +20,28 @@ __email__           = 'pedro@algarvio.me'
 __license__         = 'Apache 2.0'
 __url__             = 'https://github.com/saltstack/salt-ci'
 __description__     = __doc__
+
+
+class _LazyModule(ModuleType):
+    '''
+    Only discover the version information, which, on development checkouts, might mean asking
+    git, when it's first accessed. Importing ``saltci`` itself, which every console script does,
+    stays cheap.
+    '''
+
+    def __getattr__(self, name):
+        if name in ('__version__', '__version_info__'):
+            from saltci.version import get_version
+            self.__version__, self.__version_info__ = get_version()
+            return self.__dict__[name]
+        raise AttributeError(
+            '\'module\' object has no attribute {0!r}'.format(name)
+        )
+
+
+_original_module = sys.modules[__name__]
+_lazy_module = _LazyModule(__name__)
+_lazy_module.__dict__.update(_original_module.__dict__)
+# Keep a reference to the original module, python 2 clears it's globals once it's garbage collected
+_lazy_module._original_module = _original_module
+sys.modules[__name__] = _lazy_module
@@ -12,10 +12,14 @@
 
 # Import python libs
 import os
+import sys
+import json
+import time
 
 # Import salt libs
 from salt import Master
 from salt.cli import SaltKey, SaltCMD
+from salt.utils import parsers
 
 # Import salt-ci libs
 from saltci import config
@@ -29,6 +33,19 @@ class SaltCIMaster(Master):
     def setup_config(self):
         return config.saltci_master_config(self.get_config_file_path())
 
+    def daemonize_if_required(self):
+        Master.daemonize_if_required(self)
+        # Any background processes must only be started after we've forked
+        self.start_background_services()
+
+    def start_background_services(self):
+        '''
+        Start the background services which must live as long as the master.
+        '''
+        if self.config.get('SQLALCHEMY_DATABASE_URI'):
+            from saltci.results import collector
+            self.results_collector = collector.start(self.config)
+
 
 class SaltCIKey(SaltKey):
 
@@ -46,3 +63,139 @@ class SaltCICMD(SaltCMD):
 
     def setup_config(self):
         return config.saltci_master_config(self.get_config_file_path())
+
+
+class SaltCIShard(parsers.OptionParser, parsers.ConfigDirMixIn, parsers.LogLevelMixIn):
+
+    __metaclass__ = parsers.OptionParserMeta
+
+    description = (
+        'Run a test suite across the targeted minions, in chunks balanced by the tests '
+        'historical durations. The tests are read, one per line, from the tests file, or from '
+        'the standard input if it\'s "-".'
+    )
+    usage = '%prog [options] <target> <function> <tests file>'
+
+    # ConfigDirMixIn configuration filename attribute
+    _config_filename_ = 'salt-ci-master'
+
+    # LogLevelMixIn attributes
+    _default_logging_level_ = 'warning'
+    _default_logging_logfile_ = '/var/log/salt/salt-ci-shard'
+
+    def _mixin_setup(self):
+        self.add_option(
+            '--expr-form',
+            default='glob',
+            help='The targeting expression form. Default: %default.'
+        )
+        self.add_option(
+            '--build',
+            default=None,
+            help='The build name. Default: generated from the current time.'
+        )
+        self.add_option(
+            '--branch',
+            default='',
+            help='The branch being built, whose test durations are used.'
+        )
+        self.add_option(
+            '--changed-since',
+            default=None,
+            metavar='REV',
+            help='Only run the tests impacted by the changes between REV and the --head '
+                 'revision, if the test impact map is current, the full suite otherwise.'
+        )
+        self.add_option(
+            '--head',
+            default='HEAD',
+            help='The revision being built. Default: %default.'
+        )
+        self.add_option(
+            '--repo',
+            default='.',
+            help='The path to the git repository being built. Default: the current directory.'
+        )
+        self.add_option(
+            '--chunks-per-minion',
+            default=None,
+            type=int,
+            help='Default: the scheduler_chunks_per_minion setting.'
+        )
+        self.add_option(
+            '--straggler-factor',
+            default=None,
+            type=float,
+            help='Default: the scheduler_straggler_factor setting.'
+        )
+        self.add_option(
+            '--timeout',
+            default=None,
+            type=int,
+            help='Seconds after which a chunk is given up on. Default: the scheduler_timeout '
+                 'setting.'
+        )
+
+    def _mixin_after_parsed(self):
+        if len(self.args) != 3:
+            self.print_help()
+            self.exit(1)
+
+    def setup_config(self):
+        return config.saltci_master_config(self.get_config_file_path())
+
+    def run(self):
+        self.parse_args()
+        from saltci.scheduler import SchedulerError, ShardScheduler
+
+        tgt, fun, tests_file = self.args
+        if tests_file == '-':
+            tests = sys.stdin.read().splitlines()
+        else:
+            with open(tests_file) as rfh:
+                tests = rfh.read().splitlines()
+
+        tests = [test.strip() for test in tests if test.strip()]
+        if self.options.changed_since:
+            tests = self.select_changed(tests)
+            if not tests:
+                print json.dumps({'tests': 0}, indent=2)
+                return
+
+        scheduler = ShardScheduler(
+            self.config, tgt, fun, tests,
+            build=self.options.build or 'shard-{0}'.format(time.strftime('%Y%m%d%H%M%S')),
+            branch=self.options.branch,
+            expr_form=self.options.expr_form,
+            chunks_per_minion=self.options.chunks_per_minion,
+            straggler_factor=self.options.straggler_factor,
+            timeout=self.options.timeout
+        )
+        try:
+            report = scheduler.run()
+        except SchedulerError, err:
+            self.error(str(err))
+        print json.dumps(report, indent=2, sort_keys=True)
+
+    def select_changed(self, tests):
+        '''
+        Return the tests impacted by the changes since the ``--changed-since`` revision.
+        '''
+        from saltci.results import models
+        from saltci.selection import SelectionError, select_changed
+
+        if not self.config.get('SQLALCHEMY_DATABASE_URI'):
+            self.error('--changed-since requires the SQLALCHEMY_DATABASE_URI setting')
+        engine = models.get_engine(self.config)
+        try:
+            selection = select_changed(
+                engine, tests, self.options.repo, self.options.changed_since,
+                self.options.head, self.options.branch, self.config['selection_ignore']
+            )
+        except SelectionError, err:
+            self.error(str(err))
+        finally:
+            engine.dispose()
+        if selection.full:
+            sys.stderr.write('Running the full test suite: {0}\n'.format(selection.reason))
+        return selection.tests
@@ -5,15 +5,47 @@
 
     Salt-CI Configuration Handling.
 
+    Loading the configuration means copying salt's defaults, globbing the include directories and
+    parsing every YAML file, and, for ``salt-ci-notif``, resolving the master's address. Since
+    the console scripts are started thousands of times a day, the fully merged configuration is
+    snapshotted, using msgpack, together with the modification times and sizes of every file, and
+    include directory, which contributed to it. The snapshot is reused for as long as none of
+    those changed.
+
     :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
     :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
     :license: Apache 2.0, see LICENSE for more details.
 '''
 
+# Import python libs
 import os
-import urlparse
+import glob
+import time
+import hashlib
+import logging
+
+# Import 3rd-party libs
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
+# Import salt libs
+import salt
 from salt import config as saltconfig
 
+
+log = logging.getLogger(__name__)
+
+# The environment variable which overrides where the configuration snapshots are stored. Set it
+# to an empty string to disable them.
+CONFIG_CACHE_ENV_VAR = 'SALT_CI_CONFIG_CACHE_DIR'
+# Snapshots which include the resolved master address expire after this many seconds
+CONFIG_CACHE_DNS_TTL = 300
+# Settings salt generates anew on every load, they are never written to a snapshot
+_VOLATILE_KEYS = ('aes',)
+
 _COMMON_CONFIG = dict(
     # ----- Logging Configuration --------------------------------------------------------------->
     log_file=None,
@@ -45,10 +77,112 @@ _DEFAULT_SENDMAIL_CONFIG = dict(
     use_ssl=False,
     use_tls=False,
     sender=None,
-    reply_to=None
+    reply_to=None,
+    smtp_timeout=5,
+    smtp_debug_level=0,
+    # The maximum size, in bytes, of a message including it's encoded attachments. 0 to disable.
+    max_message_size=0,
+    # ----- SMTP Connection Pool Settings ------------------------------------------------------->
+    pool_min_size=1,
+    pool_max_size=5,
+    pool_acquire_timeout=30,
+    pool_idle_timeout=300,
+    pool_max_messages=100,
+    pool_noop_interval=30,
+    # <---- SMTP Connection Pool Settings --------------------------------------------------------
+
+    # ----- Relay Rate Limiting Settings -------------------------------------------------------->
+    # Messages, and recipients, per second allowed per relay. 0 disables the limit
+    rate_limit_messages=0,
+    rate_limit_recipients=0,
+    # The concurrent deliveries per relay are adapted between these bounds
+    concurrency_min=1,
+    concurrency_max=10,
+    # How many times, and after how many seconds(doubled on each retry), to retry a delivery
+    # deferred by the relay(4xx)
+    deferral_retries=2,
+    deferral_retry_delay=1,
+    # <---- Relay Rate Limiting Settings ---------------------------------------------------------
+
+    # ----- Delivery Engine Settings ------------------------------------------------------------>
+    # 'sync' delivers the message before returning, 'async' queues it to be delivered in the
+    # background by the process wide delivery engine
+    engine='sync',
+    engine_workers=4,
+    engine_max_pending=10000,
+    # How many seconds, at most, an exiting process waits for it's queued deliveries, 0 waits
+    # for all of them
+    engine_drain_timeout=30,
+    # <---- Delivery Engine Settings -------------------------------------------------------------
+
+    # ----- Notification Digest Settings -------------------------------------------------------->
+    # Coalesce messages to the same recipients, and with the same subject, sent within
+    # digest_window seconds into a single digest email. Messages can also explicitly opt in by
+    # passing a digest_key.
+    digest=False,
+    digest_window=60,
+    digest_max_entries=50,
+    # <---- Notification Digest Settings ---------------------------------------------------------
+
+    # ----- Outbound Spool Settings ------------------------------------------------------------->
+    spool=False,
+    spool_dir=None,
+    spool_workers=2,
+    spool_poll_interval=1,
+    spool_max_attempts=10,
+    spool_retry_delay=30,
+    spool_max_retry_delay=3600,
+    # <---- Outbound Spool Settings --------------------------------------------------------------
+
+    # ----- Notification Templates Settings ----------------------------------------------------->
+    # The directory holding the templates sendmail.send_template renders. Defaults to
+    # salt-ci-notif.d/templates next to the configuration file.
+    template_dir=None,
+    # <---- Notification Templates Settings ------------------------------------------------------
+
+    # ----- Delivery Mode Settings -------------------------------------------------------------->
+    # 'relay' hands every message to smtp_host, 'direct' delivers it to each recipient domain's
+    # mail exchanger, in a single transaction per domain.
+    delivery_mode='relay',
+    direct_smtp_port=25,
+    direct_use_tls=False,
+    # For how long, in seconds, to cache the mail exchangers of a domain
+    mx_cache_ttl=300,
+    # <---- Delivery Mode Settings ---------------------------------------------------------------
+
+    # ----- Metrics Settings -------------------------------------------------------------------->
+    # Write the metrics, every metrics_export_interval seconds, on the Prometheus text format, to
+    # <cachedir>/sendmail/metrics.prom
+    metrics_export=False,
+    metrics_export_interval=15,
+    # <---- Metrics Settings ---------------------------------------------------------------------
 )
 
 
+def sendmail_config(opts, pillar=None):
+    '''
+    Resolve the sendmail configuration.
+
+    We start with the default configuration and iterate over it's keys.
+    If the key is present in opts and the value of opts[key] is not equal to the default
+    one, then that value is used and we continue onto the next key.
+    If the key is not found in opts, but instead is found in pillar and the value of
+    pillar[key] is not equal to the default value, then that value is used.
+    If the key is not in either opts nor pillar, the value remains at it's default.
+    '''
+    result = _DEFAULT_SENDMAIL_CONFIG.copy()
+    opts = opts.get('sendmail', {})
+    pillar = (pillar or {}).get('sendmail', {})
+    for key, value in _DEFAULT_SENDMAIL_CONFIG.iteritems():
+        if key in opts and opts[key] != value:
+            # Any options in opts takes precedence to pillar
+            value = opts[key]
+        elif key in pillar and pillar[key] != value:
+            value = pillar[key]
+        result[key] = value
+    return result
+
+
 def saltci_master_config(path):
     '''
     Load `salt-ci-master` configuration from the provided path.
@@ -57,6 +191,7 @@ def saltci_master_config(path):
     opts = saltconfig.DEFAULT_MASTER_OPTS.copy()
     # override with our own defaults
     opts.update(_COMMON_CONFIG.copy())
+    opts.update(_COMMON_DB_CONFIG.copy())
     # Tweak our defaults
     opts.update(
         # ----- Primary Configuration Settings -------------------------------------------------->
@@ -66,9 +201,68 @@ def saltci_master_config(path):
         log_file='/var/log/salt/salt-ci-master',
         pidfile='/var/run/salt-ci-master.pid',
         # <---- Primary Configuration Settings ---------------------------------------------------
+
+        # ----- Build Results Settings ---------------------------------------------------------->
+        # The CI job returns are only stored if SQLALCHEMY_DATABASE_URI is set. They are written in
+        # batches of up to results_batch_size test results, or whatever arrived within
+        # results_flush_interval seconds.
+        results_batch_size=1000,
+        results_flush_interval=1,
+        results_max_pending=100000,
+        # How many of each test's latest runs the flaky tests report considers
+        results_stats_window=50,
+        # The queued returns are also bounded by the size, in bytes, of their test messages, and
+        # batches are written as soon as they reach results_batch_bytes. 0 disables either.
+        results_batch_bytes=8388608,
+        results_max_pending_bytes=268435456,
+        # Test messages larger than results_compress_threshold bytes are kept compressed until
+        # written, those larger than results_spill_threshold bytes are stored, compressed, on the
+        # content addressed blob store, under results_blob_dir, <cachedir>/saltci-results/blobs
+        # by default, and referenced by their hash on the database. 0 disables either.
+        results_compress_threshold=4096,
+        results_spill_threshold=65536,
+        results_blob_dir=None,
+        # The blobs no test result references are swept every results_blob_sweep_interval
+        # seconds. 0 disables the sweep.
+        results_blob_sweep_interval=86400,
+        # <---- Build Results Settings -----------------------------------------------------------
+
+        # ----- Test Shard Scheduler Settings --------------------------------------------------->
+        # The test suites are split in this many chunks per minion, the more chunks, the better
+        # the balance when minions finish early, at the cost of more jobs
+        scheduler_chunks_per_minion=4,
+        # Once there's nothing else to run, a chunk running this many times longer than
+        # estimated is also run on an idle minion, the first return wins
+        scheduler_straggler_factor=1.5,
+        # Seconds after which a minion running a chunk is given up on
+        scheduler_timeout=3600,
+        # The files, fnmatch patterns relative to the repository root, which impact no test when
+        # only running the tests impacted by a change
+        selection_ignore=['*.rst', '*.md', 'doc/*', 'AUTHORS', 'LICENSE'],
+        # <---- Test Shard Scheduler Settings ----------------------------------------------------
+
+        # ----- Web Dashboard Settings ---------------------------------------------------------->
+        web_host='0.0.0.0',
+        web_port=8080,
+        # The dashboard's responses are cached for up to web_cache_ttl seconds, or until new
+        # results are ingested
+        web_cache_ttl=5,
+        web_cache_entries=1024,
+        # The sass binary used to compile the dashboard's stylesheets, once, at startup
+        SASS_BIN_PATH=None,
+        # How many of the latest build status events are kept for replaying to reconnecting
+        # clients, and how many each client buffers before dropping it's oldest ones
+        web_events_buffer=1000,
+        web_events_client_buffer=100,
+        # Seconds between the keep alive comments sent to idle event stream clients
+        web_events_keepalive=15,
+        # <---- Web Dashboard Settings -----------------------------------------------------------
     )
     # Return final and parsed options
-    return saltconfig.master_config(path, 'SALT_CI_MASTER_CONFIG', opts)
+    return _cached_config(
+        'master', path, 'SALT_CI_MASTER_CONFIG', opts,
+        lambda: saltconfig.master_config(path, 'SALT_CI_MASTER_CONFIG', opts)
+    )
 
 
 def saltci_notif_config(path, check_dns=True, env_var='SALT_CI_NOTIF_CONFIG'):
@@ -87,6 +281,13 @@ def saltci_notif_config(path, check_dns=True, env_var='SALT_CI_NOTIF_CONFIG'):
         default_include='salt-ci-notif.d/*.conf',
         log_file='/var/log/salt/salt-ci-notif',
         pidfile='/var/run/salt-ci-notif.pid',
+        # Run jobs as threads so that they all share the same SMTP connection pool
+        multiprocessing=False,
+        # The UNIX socket salt-ci-notif-call forwards function calls to. Empty to disable it.
+        notif_socket='/var/run/salt-ci-notif.ipc',
+        # Fork this many worker processes to deliver the messages, partitioned by the recipients'
+        # domain. 0 delivers them from the daemon's process.
+        notif_workers=0,
         # <---- Primary Configuration Settings ---------------------------------------------------
 
         # ----- Include salt-ci-notif modules  -------------------------------------------------->
@@ -99,4 +300,144 @@ def saltci_notif_config(path, check_dns=True, env_var='SALT_CI_NOTIF_CONFIG'):
         sendmail=_DEFAULT_SENDMAIL_CONFIG.copy(),
         # <---- Sendmail Settings ----------------------------------------------------------------
     )
-    return saltconfig.minion_config(path, check_dns=check_dns, env_var=env_var, defaults=defaults)
+    return _cached_config(
+        'notif', path, env_var, defaults,
+        lambda: saltconfig.minion_config(
+            path, check_dns=check_dns, env_var=env_var, defaults=defaults
+        ),
+        ttl=check_dns and CONFIG_CACHE_DNS_TTL or None
+    )
+
+
+def _config_sources(path, env_var, opts):
+    '''
+    Return the files, and include directories, which contributed to the loaded ``opts``.
+    '''
+    paths = [path]
+    if os.environ.get(env_var):
+        paths.append(os.environ[env_var])
+
+    includes = opts.get('include') or []
+    if isinstance(includes, basestring):
+        includes = [includes]
+    if opts.get('default_include'):
+        includes = [opts['default_include']] + list(includes)
+
+    sources = set(paths)
+    for config_path in paths:
+        for pattern in includes:
+            if not os.path.isabs(pattern):
+                pattern = os.path.join(os.path.dirname(config_path), pattern)
+            # A file added to, or removed from, an include directory changes it's mtime
+            sources.add(os.path.dirname(pattern))
+            sources.update(glob.glob(pattern))
+    return sorted(sources)
+
+
+def _stat_sources(sources):
+    stats = []
+    for source in sources:
+        try:
+            stat = os.stat(source)
+            stats.append([source, stat.st_mtime, stat.st_size])
+        except OSError:
+            stats.append([source, None, None])
+    return stats
+
+
+def _snapshot_path(kind, path, env_var, defaults):
+    '''
+    Return the path of the configuration snapshot, or ``None`` if snapshots are disabled.
+    '''
+    if not HAS_MSGPACK:
+        return None
+
+    cache_dir = os.environ.get(CONFIG_CACHE_ENV_VAR)
+    if cache_dir is None:
+        cache_dir = os.path.join(defaults['cachedir'], 'saltci-config')
+    elif not cache_dir:
+        return None
+
+    # Anything, besides the files, the loaded configuration depends on
+    key = repr((
+        kind, os.path.abspath(path), os.environ.get(env_var), salt.__version__,
+        os.path.getmtime(__file__)
+    ))
+    return os.path.join(
+        cache_dir, '{0}-{1}.msgpack'.format(kind, hashlib.sha1(key).hexdigest())
+    )
+
+
+def _load_snapshot(snapshot_path, ttl):
+    try:
+        with open(snapshot_path, 'rb') as rfh:
+            snapshot = msgpack.loads(rfh.read())
+    except (IOError, OSError):
+        return None
+    except Exception, err:
+        log.debug('Ignoring the corrupt config snapshot {0}: {1}'.format(snapshot_path, err))
+        return None
+
+    if ttl is not None and time.time() - snapshot['created'] > ttl:
+        return None
+    sources = [source for source, _, _ in snapshot['sources']]
+    if _stat_sources(sources) != snapshot['sources']:
+        return None
+    return snapshot['opts']
+
+
+def _save_snapshot(snapshot_path, opts, sources):
+    snapshot = dict(
+        created=time.time(),
+        sources=sources,
+        opts=dict([(key, value) for key, value in opts.iteritems() if key not in _VOLATILE_KEYS])
+    )
+    cache_dir = os.path.dirname(snapshot_path)
+    tmp_path = '{0}.{1}'.format(snapshot_path, os.getpid())
+    try:
+        data = msgpack.dumps(snapshot)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        # The configuration holds credentials
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'wb') as wfh:
+            wfh.write(data)
+        os.rename(tmp_path, snapshot_path)
+    except Exception, err:
+        # Not being able to snapshot the configuration is not fatal
+        log.debug('Failed to write the config snapshot {0}: {1}'.format(snapshot_path, err))
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _refresh_volatile(kind, opts):
+    '''
+    Generate the settings salt generates anew on every load, which are never snapshotted.
+    '''
+    if kind == 'master':
+        import salt.crypt
+        opts['aes'] = salt.crypt.Crypticle.generate_key_string()
+    return opts
+
+
+def _cached_config(kind, path, env_var, defaults, loader, ttl=None):
+    '''
+    Return the configuration from it's snapshot, if still valid, otherwise, load it using
+    ``loader`` and snapshot it.
+    '''
+    snapshot_path = _snapshot_path(kind, path, env_var, defaults)
+    if snapshot_path is None:
+        return loader()
+
+    opts = _load_snapshot(snapshot_path, ttl)
+    if opts is not None:
+        return _refresh_volatile(kind, opts)
+
+    # The files known before loading are stat'ed before and after it. If any of them changed
+    # meanwhile, what was loaded might not match what is stat'ed and it's not snapshotted.
+    before = _stat_sources(_config_sources(path, env_var, defaults))
+    opts = loader()
+    after = _stat_sources(_config_sources(path, env_var, opts))
+    if not [entry for entry in before if entry not in after]:
+        _save_snapshot(snapshot_path, opts, after)
+    return opts
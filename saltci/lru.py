@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.lru
+    ~~~~~~~~~~
+
+    A thread-safe, size bounded, least recently used cache.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    A thread-safe LRU cache holding up to ``cache_size`` entries.
+    '''
+
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        '''
+        Return the value cached for ``key``, ``None`` if there's none.
+        '''
+        with self._lock:
+            try:
+                value = self._cache.pop(key)
+            except KeyError:
+                return None
+            # Most recently used entries are kept at the end
+            self._cache[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = value
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def pop(self, key):
+        '''
+        Drop, and return, the value cached for ``key``, ``None`` if there's none.
+        '''
+        with self._lock:
+            return self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.builder
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Build email messages out of cached skeletons.
+
+    A notification is usually sent several times with the same contents, to each committer of a
+    build, for example, with only the recipients changing. The invariant part of a message, it's
+    MIME tree, with the body parts and attachments, plus the ``Subject``, ``From``,
+    ``Reply-To`` and extra headers, is built and flattened once into a :class:`Skeleton`, which
+    is cached keyed by those contents. Each message is stamped out of a skeleton by
+    only formatting it's ``Message-ID``, ``Date`` and recipients headers.
+
+    The formatted, folded, headers are cached too, the host's FQDN, used on the message ids, is
+    resolved once per process and the date is only formatted once per second.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import time
+import socket
+import random
+import itertools
+import threading
+from email.encoders import encode_base64
+from email.header import Header
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email import utils
+
+# Import salt-ci libs
+from saltci.lru import LRUCache
+from saltci.notif import mime, stream
+
+# The length headers are folded at, the same as the email generator's
+MAX_HEADER_LENGTH = 78
+
+# Skeletons holding more than this, in bytes, usually in-memory attachments, aren't cached
+MAX_CACHED_SKELETON_SIZE = 1024 * 1024
+
+_FQDN = None
+_FQDN_LOCK = threading.Lock()
+
+# The time, truncated to the second, and the formatted date of the last call to formatdate()
+_DATE = (None, None)
+
+# Distinguishes the message ids generated within the same second
+_MSGID_SEQUENCE = itertools.count(random.randrange(1000000))
+
+_SKELETONS = LRUCache(128)
+_HEADERS = LRUCache(4096)
+
+
+def fqdn():
+    '''
+    Return the host's fully qualified domain name, only resolved on the first call.
+    '''
+    global _FQDN
+    if _FQDN is None:
+        with _FQDN_LOCK:
+            if _FQDN is None:
+                _FQDN = socket.getfqdn()
+    return _FQDN
+
+
+def make_msgid():
+    '''
+    Return a message id, like :func:`email.utils.make_msgid` does, but using the cached FQDN and
+    a sequence number, instead of a random one, so that the ids of the messages generated within
+    the same second never collide.
+    '''
+    return '<{0}.{1}.{2}@{3}>'.format(
+        time.strftime('%Y%m%d%H%M%S', time.gmtime()), os.getpid(), next(_MSGID_SEQUENCE), fqdn()
+    )
+
+
+def formatdate():
+    '''
+    Return the current local time formatted for the ``Date`` header.
+    '''
+    global _DATE
+    now = int(time.time())
+    cached = _DATE
+    if cached[0] != now:
+        cached = _DATE = (now, utils.formatdate(now, localtime=True))
+    return cached[1]
+
+
+def format_header(name, value):
+    '''
+    Return the ``name`` header line, folded, exactly as the email generator writes it.
+    '''
+    key = (name, value)
+    line = _HEADERS.get(key)
+    if line is None:
+        if isinstance(value, str) and any([ord(char) > 127 for char in value]):
+            # The email generator writes 8bit strings as they are
+            folded = value
+        else:
+            folded = Header(value, maxlinelen=MAX_HEADER_LENGTH, header_name=name).encode()
+        line = '{0}: {1}\n'.format(name, folded)
+        _HEADERS.set(key, line)
+    return line
+
+
+class Skeleton(object):
+    '''
+    The flattened invariant part of a message, it's headers, without the blank line separating
+    them from the body, and it's body, as :func:`saltci.notif.stream.segments`.
+    '''
+
+    __slots__ = ('headers', 'body', 'size')
+
+    def __init__(self, msg):
+        segments = stream.segments(msg)
+        self.headers, body = segments[0].split('\n\n', 1)
+        self.headers += '\n'
+        self.body = ['\n' + body] + segments[1:]
+        self.size = stream.segments_size(segments)
+
+    @property
+    def memory(self):
+        '''
+        The size, in bytes, of the flattened contents held in memory.
+        '''
+        return len(self.headers) + sum([
+            len(segment) for segment in self.body if isinstance(segment, basestring)
+        ])
+
+
+class Message(object):
+    '''
+    A message stamped out of a :class:`Skeleton`.
+    '''
+
+    __slots__ = ('skeleton', 'headers')
+
+    def __init__(self, skeleton, headers):
+        self.skeleton = skeleton
+        self.headers = headers
+
+    @property
+    def size(self):
+        return self.skeleton.size + len(self.headers)
+
+    def iter_message(self, blocksize=stream.BLOCK_SIZE):
+        '''
+        Yield the flattened message in chunks, streaming the file attachments.
+        '''
+        yield self.skeleton.headers + self.headers
+        for chunk in stream.iter_segments(self.skeleton.body, blocksize):
+            yield chunk
+
+
+def _skeleton_key(subject, sender, body, html, attachments, reply_to, charset, extra_headers):
+    '''
+    Return the skeleton cache key of the message contents. File attachments are identified by
+    their path, size and modification time. ``None`` if the contents can't be cached.
+    '''
+    files = []
+    for entry in attachments:
+        if isinstance(entry, dict):
+            files.append(tuple(sorted([
+                (key, tuple(value) if isinstance(value, list) else value)
+                for key, value in entry.iteritems()
+            ])))
+            continue
+        try:
+            stat = os.stat(entry)
+        except (OSError, TypeError):
+            # Not a file, building the skeleton fails
+            return None
+        files.append((entry, stat.st_size, stat.st_mtime))
+    key = (
+        subject, sender, body, html, reply_to, charset,
+        tuple(sorted((extra_headers or {}).iteritems())), tuple(files)
+    )
+    try:
+        hash(key)
+    except TypeError:
+        # Unhashable extra headers or attachment headers
+        return None
+    return key
+
+
+def _build_skeleton(subject, sender, body, html, attachments, reply_to, charset,
+                    extra_headers):
+    if len(attachments) == 0 and not html:
+        # No html content and zero attachments means plain text
+        msg = MIMEText(body, _subtype='plain', _charset=charset)
+    elif len(attachments) > 0 and not html:
+        # No html and at least one attachment means multipart
+        msg = MIMEMultipart()
+        msg.attach(MIMEText(body, _subtype='plain', _charset=charset))
+    else:
+        # Anything else
+        msg = MIMEMultipart()
+        alternative = MIMEMultipart('alternative')
+        alternative.attach(MIMEText(body, _subtype='plain', _charset=charset))
+        alternative.attach(MIMEText(html, _subtype='html', _charset=charset))
+        msg.attach(alternative)
+
+    msg['Subject'] = subject.rstrip()
+    msg['From'] = sender.rstrip()
+    if reply_to:
+        msg['Reply-To'] = reply_to.rstrip()
+
+    if extra_headers:
+        for key, value in extra_headers.iteritems():
+            msg[key] = str(value).rstrip()
+
+    for entry in attachments:
+        if isinstance(entry, dict):
+            if isinstance(entry['mimetype'], basestring):
+                entry['mimetype'] = entry['mimetype'].split('/')
+
+            attachment = MIMEBase(*entry['mimetype'])
+            attachment.set_payload(entry['data'])
+            encode_base64(attachment)
+
+            attachment.add_header(
+                'Content-Disposition', '{0};filename={1}'.format(
+                    entry.get('disposition', 'attachment'),
+                    entry['filename']
+                )
+            )
+            for key, value in entry.get('headers', {}):
+                attachment.add_header(key, value.rstrip())
+
+        elif os.path.isfile(entry):
+            # The file contents are only read, and encoded, while the message is streamed
+            attachment = stream.FileAttachment(entry, *mime.detect_mimetype(entry))
+            attachment.add_header(
+                'Content-Disposition', '{0};filename={1}'.format(
+                    'attachment',
+                    os.path.basename(entry)
+                )
+            )
+        else:
+            # We currently only support dict based or explicit filename attachments.
+            # Maybe latter we can add salt:// support for attachments.
+            # Would be cool if we could do something like:
+            #   salt://<minion-id>/filename
+            #   salt:///path/to/filename@<minion-id>
+            #   salt://<minion-id>@/path/to/filename
+            raise NotImplementedError
+
+        msg.attach(attachment)
+
+    return Skeleton(msg)
+
+
+def build(subject, sender, body, html=None, recipients=(), cc=(), bcc=(), attachments=(),
+          reply_to=None, charset='utf-8', extra_headers=None):
+    '''
+    Build a message, out of a cached skeleton if one with the same contents was built before.
+    The recipients must already be normalized, see :func:`saltci.notif.recipients.normalize`.
+
+    :returns: A :class:`Message`.
+    '''
+    key = _skeleton_key(
+        subject, sender, body, html, attachments, reply_to, charset, extra_headers
+    )
+    skeleton = _SKELETONS.get(key) if key is not None else None
+    if skeleton is None:
+        skeleton = _build_skeleton(
+            subject, sender, body, html, attachments, reply_to, charset, extra_headers
+        )
+        if key is not None and skeleton.memory <= MAX_CACHED_SKELETON_SIZE:
+            _SKELETONS.set(key, skeleton)
+
+    # Message ids are unique, they're not worth caching
+    headers = ['Message-ID: {0}\n'.format(make_msgid()), 'Date: {0}\n'.format(formatdate())]
+    for name, addresses in (('To', recipients), ('Cc', cc), ('Bcc', bcc)):
+        if addresses:
+            headers.append(format_header(name, ', '.join(addresses)))
+    return Message(skeleton, ''.join(headers))
@@ -10,13 +10,22 @@
     :license: Apache 2.0, see LICENSE for more details.
 '''
 
+# Import python libs
+import time
+import socket
+import logging
+import threading
+
 # Import salt libs
 from salt import Minion
 from salt.cli import SaltCall
 
 # Import salt-ci libs
 from saltci import config
+from saltci.notif import ipc
+
 
+log = logging.getLogger(__name__)
 
 
 class SaltCINotif(Minion):
@@ -27,6 +36,74 @@ class SaltCINotif(Minion):
     def setup_config(self):
         return config.saltci_notif_config(self.get_config_file_path())
 
+    def daemonize_if_required(self):
+        Minion.daemonize_if_required(self)
+        # Any background threads must only be started after we've forked
+        self.start_background_services()
+
+    def start_background_services(self):
+        '''
+        Start the background services which must live as long as the notifications minion.
+        '''
+        if self.config['notif_workers']:
+            # Fork the workers before any threads are started
+            from saltci.notif import workers
+            log.info('Starting {0} notifications workers'.format(self.config['notif_workers']))
+            self.worker_pool = workers.start_pool(self.config['notif_workers'])
+
+        # The spool worker is started by whichever comes first, a spooled message or the
+        # thread below
+        from saltci.notif import spool
+        spool.serve()
+
+        # The sendmail settings may come from the pillar, which the minion only compiles once
+        # it's connected to the master
+        thread = threading.Thread(
+            target=self.start_sendmail_services, name='SendmailServicesStarter'
+        )
+        thread.daemon = True
+        thread.start()
+
+        path = ipc.socket_path(self.config)
+        if path:
+            log.info('Serving local function calls on {0}'.format(path))
+            try:
+                self.call_server = ipc.CallServer(path, self.loaded_functions)
+            except socket.error, err:
+                log.error('Failed to serve local function calls on {0}: {1}'.format(path, err))
+            else:
+                self.call_server.start()
+
+    def loaded_functions(self):
+        '''
+        Return the execution modules the minion loaded, ``None`` until it's connected to the
+        master. The minion replaces them whenever it refreshes it's pillar.
+        '''
+        return getattr(getattr(self, 'minion', None), 'functions', None)
+
+    def start_sendmail_services(self):
+        '''
+        Start the outbound spool worker and the metrics exporter, if enabled, once the minion
+        compiled it's pillar, with the same sendmail settings the module resolves.
+        '''
+        while 'pillar' not in self.config:
+            time.sleep(1)
+        sendmail_opts = config.sendmail_config(self.config, self.config['pillar'])
+
+        if sendmail_opts['spool']:
+            # Deliver whatever was left spooled by the previous run
+            from saltci.notif import spool
+            self.spool_worker = spool.get_worker(self.config, sendmail_opts)
+
+        if sendmail_opts['metrics_export']:
+            from saltci.notif import metrics
+            path = metrics.export_path(self.config)
+            log.info('Exporting the sendmail metrics to {0}'.format(path))
+            self.metrics_exporter = metrics.MetricsExporter(
+                path, sendmail_opts['metrics_export_interval']
+            )
+            self.metrics_exporter.start()
+
 
 class SaltCINotifCall(SaltCall):
     # ConfigDirMixIn configuration filename attribute
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.delivery
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    The single code path every message takes to reach the relay, or the recipient domains' mail
+    exchangers, whether it's delivered synchronously, by the delivery engine or by the spool
+    worker.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import socket
+import logging
+import smtplib
+
+# Import salt-ci libs
+from saltci.notif import metrics, pool, ratelimit, recipients, smtp
+
+
+log = logging.getLogger(__name__)
+
+
+def deliver(opts, sender, send_to, payload, size=None, retries=None):
+    '''
+    Deliver a message honoring the relay's rate limits and concurrency.
+
+    When ``delivery_mode`` is ``direct``, the recipients are grouped by their domain and each
+    domain gets a single transaction to it's mail exchanger. The recipients of the domains whose
+    delivery failed are reported as refused, unless they all failed, in which case the last
+    error is raised.
+
+    :param payload: The message as a string, an iterable of strings, or a callable returning
+                    either of those. Since iterables can only be consumed once, pass a callable
+                    if deferred deliveries are to be retried.
+    :param retries: How many times to retry a delivery the relay deferred(4xx). Defaults to the
+                    ``deferral_retries`` setting.
+    :returns: A dictionary with an entry for each recipient that was refused.
+    '''
+    started = time.time()
+    try:
+        refused = _deliver(opts, sender, send_to, payload, size, retries)
+    except Exception, err:
+        metrics.ERRORS.inc(value=type(err).__name__)
+        raise
+    metrics.DELIVERY.observe(time.time() - started)
+    metrics.DELIVERIES.inc()
+    if refused:
+        metrics.REFUSED.inc(len(refused))
+    return refused
+
+
+def _deliver(opts, sender, send_to, payload, size, retries):
+    if retries is None:
+        retries = opts.get('deferral_retries', 0) if callable(payload) else 0
+
+    if opts.get('delivery_mode', 'relay') != 'direct':
+        return _transaction(opts, sender, send_to, payload, size, retries)
+
+    groups = recipients.group_by_domain(send_to)
+    if len(groups) > 1 and not callable(payload):
+        # Every domain gets it's own transaction, the payload must be consumed more than once
+        data = payload if isinstance(payload, basestring) else ''.join(payload)
+        payload = lambda: data
+
+    refused = {}
+    errors = 0
+    for domain, domain_send_to in groups.iteritems():
+        try:
+            refused.update(
+                _deliver_domain(opts, domain, sender, domain_send_to, payload, size, retries)
+            )
+        except (smtplib.SMTPException, socket.error), err:
+            errors += 1
+            if errors == len(groups):
+                raise
+            log.error('Failed to deliver the message to {0}: {1}'.format(domain, err))
+            if isinstance(err, smtplib.SMTPRecipientsRefused):
+                refused.update(err.recipients)
+                continue
+            # Connection failures are transient
+            code = getattr(err, 'smtp_code', 451)
+            for addr in domain_send_to:
+                refused[addr] = (code, str(err))
+    return refused
+
+
+def _deliver_domain(opts, domain, sender, send_to, payload, size, retries):
+    '''
+    Deliver the message to the most preferred reachable mail exchanger of ``domain``.
+    '''
+    hosts = recipients.mx_hosts(domain, opts.get('mx_cache_ttl', 300))
+    for idx, host in enumerate(hosts):
+        try:
+            return _transaction(
+                recipients.direct_opts(opts, host), sender, send_to, payload, size, retries
+            )
+        except (socket.error, smtplib.SMTPConnectError), err:
+            # Only move on to the next mail exchanger if this one could not be reached
+            if idx + 1 == len(hosts) or not callable(payload):
+                raise
+            log.warning(
+                'Failed to connect to {0}, the MX for {1}, trying {2}: {3}'.format(
+                    host, domain, hosts[idx + 1], err
+                )
+            )
+
+
+def _transaction(opts, sender, send_to, payload, size, retries):
+    '''
+    Deliver the message in a single SMTP transaction, retrying deferrals.
+    '''
+    limiter = ratelimit.get_limiter(opts)
+    attempt = 0
+    while True:
+        data = payload() if callable(payload) else payload
+        try:
+            with limiter.slot(len(send_to)):
+                with pool.get_pool(opts).connection() as server:
+                    return smtp.sendmail(server, sender, send_to, data, size=size)
+        except Exception, err:
+            if attempt >= retries or not ratelimit.is_deferral(err):
+                raise
+            attempt += 1
+            metrics.DEFERRALS.inc()
+            delay = opts.get('deferral_retry_delay', 1) * 2 ** (attempt - 1)
+            log.info(
+                'The relay deferred the message, retrying in {0} seconds: {1}'.format(delay, err)
+            )
+            time.sleep(delay)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.digest
+    ~~~~~~~~~~~~~~~~~~~
+
+    Coalesce bursts of similar notifications into a single digest email.
+
+    Messages are grouped by their recipients and a digest key, which defaults to the subject.
+    A group is flushed, as a single digest message, once ``digest_window`` seconds have passed
+    since it's first message or as soon as it holds ``digest_max_entries`` messages.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import uuid
+import atexit
+import logging
+import threading
+from cgi import escape
+
+# Import salt-ci libs
+from saltci.notif import metrics, recipients
+
+log = logging.getLogger(__name__)
+
+_COALESCER = None
+_COALESCER_LOCK = threading.Lock()
+
+SEPARATOR = '\n\n' + '-' * 72 + '\n\n'
+
+
+def get_coalescer(opts, flush):
+    '''
+    Return the process wide coalescer, creating it if needed, using the digest settings of the
+    provided resolved sendmail configuration.
+
+    :param flush: The callable which delivers a flushed group. It's passed the message spec, a
+                  dictionary with the keyword arguments ``sendmail.send`` accepts.
+    '''
+    global _COALESCER
+    window = opts.get('digest_window', 60)
+    max_entries = opts.get('digest_max_entries', 50)
+    if _COALESCER is None:
+        with _COALESCER_LOCK:
+            if _COALESCER is None:
+                _COALESCER = Coalescer(window, max_entries, flush)
+                # Don't let short lived processes, like ``salt-ci-notif-call``, exit with
+                # messages pending. Registered now, so that it runs before the delivery engine
+                # is drained.
+                atexit.register(_COALESCER.flush_all)
+    _COALESCER.configure(window, max_entries)
+    return _COALESCER
+
+
+def pending():
+    '''
+    Return the number of messages waiting to be flushed.
+    '''
+    if _COALESCER is None:
+        return 0
+    return _COALESCER.pending
+
+
+metrics.gauge(metrics.PREFIX + 'digest_pending', 'Messages waiting to be coalesced.', pending)
+
+
+def _canonical(address):
+    try:
+        return recipients.parse(address)[1]
+    except recipients.InvalidAddress:
+        # Building the digest fails anyway
+        return address.strip().lower()
+
+
+def group_key(spec, digest_key=None):
+    '''
+    Return the key messages are grouped by. The recipients are compared as
+    :func:`saltci.notif.recipients.normalize` delivers to them, canonicalized, and without
+    those already on a previous list.
+    '''
+    seen = set()
+    key = []
+    for name in ('recipients', 'cc', 'bcc'):
+        value = spec.get(name) or ()
+        if isinstance(value, basestring):
+            value = value.split(',')
+        addresses = frozenset([_canonical(addr) for addr in value if addr.strip()]) - seen
+        seen.update(addresses)
+        key.append(addresses)
+    key.append(digest_key if digest_key is not None else (spec.get('subject') or '').strip())
+    return tuple(key)
+
+
+def compose(specs):
+    '''
+    Compose the digest message spec from the coalesced message specs.
+    '''
+    if len(specs) == 1:
+        return specs[0]
+
+    first = specs[0]
+    subjects = [(spec.get('subject') or '').strip() for spec in specs]
+    if len(set(subjects)) == 1:
+        subject = '[Digest] {0} (x{1})'.format(subjects[0], len(specs))
+    else:
+        subject = '[Digest] {0} notifications'.format(len(specs))
+
+    bodies = []
+    htmls = []
+    attachments = []
+    for idx, spec in enumerate(specs):
+        header = '{0}/{1}: {2}'.format(idx + 1, len(specs), subjects[idx])
+        bodies.append('{0}\n\n{1}'.format(header, spec.get('body') or ''))
+        htmls.append(
+            '<h3>{0}</h3>\n{1}'.format(
+                escape(header), spec.get('html') or '<pre>{0}</pre>'.format(
+                    escape(spec.get('body') or '')
+                )
+            )
+        )
+        entry_attachments = spec.get('attachments') or ()
+        if isinstance(entry_attachments, basestring):
+            entry_attachments = [
+                attachment.strip() for attachment in entry_attachments.split(',')
+            ]
+        attachments.extend(entry_attachments)
+
+    digest = first.copy()
+    digest.update(
+        subject=subject,
+        body=SEPARATOR.join(bodies),
+        attachments=attachments
+    )
+    if [spec for spec in specs if spec.get('html')]:
+        digest['html'] = '\n<hr/>\n'.join(htmls)
+    return digest
+
+
+class _Group(object):
+
+    __slots__ = ('id', 'created', 'specs', 'timer')
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.created = time.time()
+        self.specs = []
+        self.timer = None
+
+
+class Coalescer(object):
+    '''
+    Keep an in-memory index of the pending message groups and flush them on window expiry or
+    once they reach the size limit.
+    '''
+
+    def __init__(self, window, max_entries, flush):
+        self._flush = flush
+        self._groups = {}
+        self._lock = threading.Lock()
+        self.configure(window, max_entries)
+
+    def configure(self, window, max_entries):
+        '''
+        Apply the digest settings to the groups created from now on. The size limit applies to
+        every group as soon as it gets another message.
+        '''
+        self.window = window
+        self.max_entries = max(int(max_entries), 1)
+
+    @property
+    def pending(self):
+        with self._lock:
+            return sum([len(group.specs) for group in self._groups.itervalues()])
+
+    def add(self, spec, digest_key=None):
+        '''
+        Add a message spec to it's group.
+
+        :returns: The group id.
+        '''
+        key = group_key(spec, digest_key)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _Group()
+                group.timer = threading.Timer(self.window, self._expire, (key, group.id))
+                group.timer.daemon = True
+                group.timer.start()
+            group.specs.append(spec)
+            if len(group.specs) < self.max_entries:
+                return group.id
+            del self._groups[key]
+            group.timer.cancel()
+        self._deliver(group)
+        return group.id
+
+    def _expire(self, key, group_id):
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None or group.id != group_id:
+                # Already flushed because it reached the size limit
+                return
+            del self._groups[key]
+        self._deliver(group)
+
+    def flush_all(self):
+        with self._lock:
+            groups = self._groups.values()
+            self._groups.clear()
+        for group in groups:
+            group.timer.cancel()
+            self._deliver(group)
+
+    def _deliver(self, group):
+        log.debug(
+            'Flushing digest {0} with {1} message(s)'.format(group.id, len(group.specs))
+        )
+        try:
+            ret = self._flush(compose(group.specs))
+        except Exception:
+            log.exception('Failed to deliver digest {0}'.format(group.id))
+            return
+        if isinstance(ret, dict) and 'error' in ret:
+            log.error('Failed to deliver digest {0}: {1}'.format(group.id, ret['error']))
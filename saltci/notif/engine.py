@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.engine
+    ~~~~~~~~~~~~~~~~~~~
+
+    Asynchronous delivery engine.
+
+    Messages submitted to the engine are queued in memory and delivered in the background by a
+    small, fixed, number of worker threads, each of them reusing pooled SMTP sessions. This allows
+    thousands of outstanding deliveries without blocking the salt jobs which submitted them.
+
+    See :func:`saltci.notif.modules.sendmail.send` on the durability of the queued messages.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import uuid
+import Queue
+import atexit
+import socket
+import logging
+import smtplib
+import threading
+
+# Import salt-ci libs
+from saltci.notif import delivery, metrics, pool
+
+
+log = logging.getLogger(__name__)
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+metrics.gauge(
+    metrics.PREFIX + 'engine_pending', 'Deliveries queued on the delivery engine.',
+    lambda: sum([engine.pending for engine in _ENGINES.values()])
+)
+
+
+class EngineFull(Exception):
+    '''
+    Raised when the engine already has ``engine_max_pending`` outstanding deliveries.
+    '''
+
+
+def get_engine(opts):
+    '''
+    Return the delivery engine for the provided resolved sendmail configuration, starting it if
+    needed.
+    '''
+    key = pool.fingerprint(opts)
+    engine = _ENGINES.get(key)
+    if engine is not None:
+        return engine
+
+    with _ENGINES_LOCK:
+        if key not in _ENGINES:
+            engine = DeliveryEngine(opts)
+            engine.start()
+            _ENGINES[key] = engine
+        return _ENGINES[key]
+
+
+@atexit.register
+def _drain_engines():
+    '''
+    Don't let short lived processes, like ``salt-ci-notif-call``, exit with deliveries pending,
+    unless they can't be delivered within ``engine_drain_timeout`` seconds.
+    '''
+    for engine in _ENGINES.values():
+        engine.drain()
+
+
+class DeliveryEngine(object):
+    '''
+    Deliver messages in the background using ``engine_workers`` threads.
+    '''
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.workers = max(int(opts.get('engine_workers', 4)), 1)
+        self._queue = Queue.Queue(maxsize=max(int(opts.get('engine_max_pending', 10000)), 0))
+        self._threads = []
+        self.delivered = 0
+        self.failed = 0
+        self._counters_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def start(self):
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self._work, name='DeliveryEngine-{0}'.format(idx))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, sender, send_to, payload, size=None):
+        '''
+        Queue a message for delivery.
+
+        :param payload: The message as a string, an iterable of strings, or a callable returning
+                        either of those, which is only called when the message is delivered.
+        :returns: The delivery id.
+        '''
+        delivery_id = uuid.uuid4().hex
+        try:
+            self._queue.put_nowait((delivery_id, sender, send_to, payload, size))
+        except Queue.Full:
+            raise EngineFull(
+                'There are already {0} deliveries pending'.format(self._queue.maxsize)
+            )
+        return delivery_id
+
+    def join(self, timeout=None):
+        '''
+        Wait for all the pending deliveries, at most ``timeout`` seconds unless it's ``None``.
+
+        :returns: Whether there are no pending deliveries left.
+        '''
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                if deadline is None:
+                    self._queue.all_tasks_done.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def drain(self):
+        '''
+        Wait, at most ``engine_drain_timeout`` seconds, for the pending deliveries. Those still
+        queued by then are abandoned, and logged, as are those still in progress.
+        '''
+        timeout = self.opts.get('engine_drain_timeout', 30)
+        if self.join(timeout or None):
+            return
+        abandoned = []
+        while True:
+            try:
+                abandoned.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+            self._queue.task_done()
+        for delivery_id, sender, send_to, _, _ in abandoned:
+            log.error(
+                'Abandoning delivery {0}, from {1} to {2}, it was not delivered within {3} '
+                'seconds'.format(delivery_id, sender, ', '.join(send_to), timeout)
+            )
+        if self.pending:
+            log.error('Exiting with {0} deliveries in progress'.format(self.pending))
+
+    def _work(self):
+        while True:
+            delivery_id, sender, send_to, payload, size = self._queue.get()
+            try:
+                self.deliver(delivery_id, sender, send_to, payload, size)
+            except Exception:
+                log.exception('Failed to process delivery {0}'.format(delivery_id))
+            finally:
+                self._queue.task_done()
+
+    def deliver(self, delivery_id, sender, send_to, payload, size=None):
+        try:
+            delivery.deliver(self.opts, sender, send_to, payload, size=size)
+        except (smtplib.SMTPException, socket.error), err:
+            log.error('Failed to deliver message {0}: {1}'.format(delivery_id, err))
+            with self._counters_lock:
+                self.failed += 1
+            return False
+        log.debug('Delivered message {0}'.format(delivery_id))
+        with self._counters_lock:
+            self.delivered += 1
+        return True
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.ipc
+    ~~~~~~~~~~~~~~~~
+
+    A local UNIX socket endpoint, served by the ``salt-ci-notif`` daemon, which lets
+    ``salt-ci-notif-call`` forward function calls to the already running daemon, reusing it's
+    loaded modules, cached configuration and pooled SMTP connections, instead of loading salt,
+    the configuration and every module on each call.
+
+    Each request, and it's reply, is a JSON document prefixed by it's length as a 4 bytes, big
+    endian, unsigned integer.
+
+    The client side must stay cheap to import, salt is only imported by the server.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import sys
+import glob
+import json
+import errno
+import socket
+import struct
+import logging
+import threading
+import traceback
+import SocketServer
+
+
+log = logging.getLogger(__name__)
+
+# The environment variable which tells salt-ci-notif-call where the daemon's socket is
+SOCKET_ENV_VAR = 'SALT_CI_NOTIF_SOCKET'
+DEFAULT_SOCKET = '/var/run/salt-ci-notif.ipc'
+
+# Where the daemon loads it's configuration from, unless told otherwise on the command line
+CONFIG_ENV_VAR = 'SALT_CI_NOTIF_CONFIG'
+DEFAULT_CONFIG = '/etc/salt/salt-ci-notif'
+DEFAULT_INCLUDE = 'salt-ci-notif.d/*.conf'
+
+_HEADER = struct.Struct('!I')
+
+
+class DaemonUnavailable(Exception):
+    '''
+    Raised when the ``salt-ci-notif`` daemon can't be reached.
+    '''
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise socket.error(errno.ECONNRESET, 'Connection closed by peer')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def send_frame(sock, payload):
+    data = json.dumps(payload)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_frame(sock):
+    size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))[0]
+    return json.loads(_recv_exactly(sock, size))
+
+
+def _read_config(path):
+    import yaml
+    try:
+        with open(path) as rfh:
+            opts = yaml.safe_load(rfh.read())
+    except (IOError, OSError, yaml.YAMLError):
+        return {}
+    return opts if isinstance(opts, dict) else {}
+
+
+def configured_socket_path(config_path=None):
+    '''
+    Return the ``notif_socket`` setting, reading only the daemon's configuration file, and the
+    files it includes, which override it, the same way salt loads them, but without salt.
+    '''
+    if config_path is None:
+        config_path = os.environ.get(CONFIG_ENV_VAR) or DEFAULT_CONFIG
+    opts = _read_config(config_path)
+    path = opts.get('notif_socket', DEFAULT_SOCKET)
+
+    includes = opts.get('include') or []
+    if isinstance(includes, basestring):
+        includes = [includes]
+    for pattern in [DEFAULT_INCLUDE] + list(includes):
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(os.path.dirname(config_path), pattern)
+        for include in sorted(glob.glob(pattern)):
+            path = _read_config(include).get('notif_socket', path)
+    return path
+
+
+def socket_path(opts=None):
+    '''
+    Return the daemon's socket path, empty if disabled. The environment variable takes
+    precedence over the ``notif_socket`` setting which, without ``opts``, is read from the
+    configuration files, see :func:`configured_socket_path`.
+    '''
+    if os.environ.get(SOCKET_ENV_VAR):
+        return os.environ[SOCKET_ENV_VAR]
+    if opts is None:
+        return configured_socket_path()
+    return opts.get('notif_socket')
+
+
+def call(path, fun, args=(), timeout=None):
+    '''
+    Call ``fun`` on the daemon listening on ``path``.
+
+    :param args: The command line arguments, ``key=value`` arguments are passed as keyword
+                 arguments.
+    :param timeout: How long to wait for the reply, by default, wait for as long as it takes.
+    :raises DaemonUnavailable: If nothing is listening on ``path``.
+    :returns: The reply, a dictionary with either the ``return`` and ``retcode`` keys, an
+              ``error`` key or, if the daemon did not load it's modules yet, an ``unavailable``
+              key.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error, err:
+            if err.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.EACCES):
+                raise DaemonUnavailable(str(err))
+            raise
+        sock.settimeout(timeout)
+        send_frame(sock, {'fun': fun, 'arg': list(args)})
+        return recv_frame(sock)
+    finally:
+        sock.close()
+
+
+def retcode(ret):
+    '''
+    Return the exit code of a function's return, ``1`` if it's an error, a dictionary with an
+    ``error`` key, like sendmail's functions return, ``0`` otherwise.
+    '''
+    return int(isinstance(ret, dict) and 'error' in ret)
+
+
+def _nested(ret, indent=4):
+    '''
+    Format ``ret`` like salt's default, ``nested``, outputter does, without the colors.
+    '''
+    prefix = ' ' * indent
+    lines = []
+    if isinstance(ret, dict):
+        lines.append(prefix + '----------')
+        for key in sorted(ret):
+            lines.append('{0}{1}:'.format(prefix, key))
+            lines.extend(_nested(ret[key], indent + 4))
+    elif isinstance(ret, (list, tuple)):
+        for item in ret:
+            if isinstance(item, (dict, list, tuple)):
+                lines.append(prefix + '-')
+                lines.extend(_nested(item, indent + 4))
+            else:
+                lines.append('{0}- {1}'.format(prefix, item))
+    else:
+        lines.append(u'{0}{1}'.format(prefix, ret))
+    return lines
+
+
+def run_client(argv):
+    '''
+    Forward a ``salt-ci-notif-call`` command line to the running daemon.
+
+    Only plain function calls, without any command line options, are forwarded.
+
+    :returns: The exit code or, ``None`` if the call must be executed in process.
+    '''
+    if not argv or [arg for arg in argv if arg.startswith('-')]:
+        return None
+
+    path = socket_path()
+    if not path:
+        return None
+    try:
+        reply = call(path, argv[0], argv[1:])
+    except DaemonUnavailable:
+        return None
+    except socket.error, err:
+        log.debug('Failed to forward the call to {0}: {1}'.format(path, err))
+        return None
+
+    if 'unavailable' in reply:
+        log.debug('Not forwarding the call to {0}: {1}'.format(path, reply['unavailable']))
+        return None
+
+    if 'error' in reply:
+        sys.stderr.write(reply['error'] + '\n')
+        return 1
+
+    output = u'\n'.join(['local:'] + _nested(reply['return'])) + u'\n'
+    sys.stdout.write(output.encode('utf-8'))
+    return reply.get('retcode', 0)
+
+
+class _CallHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            request = recv_frame(self.request)
+        except (socket.error, ValueError, struct.error), err:
+            log.debug('Discarding a malformed request: {0}'.format(err))
+            return
+        reply = self.server.call(request)
+        try:
+            send_frame(self.request, reply)
+        except (TypeError, ValueError), err:
+            send_frame(
+                self.request, {'error': 'Failed to serialize the return: {0}'.format(err)}
+            )
+
+
+class CallServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''
+    Serve function calls, over a UNIX socket, from the daemon's process, using the execution
+    modules the daemon's minion loaded, and loads again whenever it refreshes it's pillar, so
+    that calls share their ``__context__`` with the minion's jobs. Until the minion loads them,
+    once connected to the master, callers run their calls themselves.
+
+    :param functions: A callable returning the minion's loaded functions, ``None`` until they're
+                      loaded.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, path, functions):
+        try:
+            call(path, 'test.ping')
+        except (DaemonUnavailable, socket.error):
+            # Nothing is serving calls on it, it's a left over
+            if os.path.exists(path):
+                os.unlink(path)
+        else:
+            raise socket.error(errno.EADDRINUSE, '{0} is already being served'.format(path))
+
+        # Only the user the daemon runs as may call functions
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, _CallHandler)
+        finally:
+            os.umask(umask)
+        self.path = path
+        self.functions = functions
+        self._thread = None
+
+    def call(self, request):
+        functions = self.functions()
+        if functions is None:
+            return {'unavailable': 'The daemon did not load it\'s modules yet'}
+        fun = request.get('fun')
+        if fun not in functions:
+            return {'error': '\'{0}\' is not available.'.format(fun)}
+
+        import salt.minion
+        try:
+            func = functions[fun]
+            args, kwargs = salt.minion.detect_kwargs(func, request.get('arg', []))
+            ret = func(*args, **kwargs)
+            return {'return': ret, 'retcode': retcode(ret)}
+        except Exception:
+            log.exception('Failed to call {0!r}'.format(fun))
+            return {'error': traceback.format_exc()}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='CallServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.metrics
+    ~~~~~~~~~~~~~~~~~~~~
+
+    In-process metrics of the notifications hot path.
+
+    Timings are kept on fixed bucket histograms and events on counters, each observation takes a
+    lock, a ``bisect()`` and a couple of additions, so they are always collected. Gauges, like
+    the delivery backlogs, are only computed when the metrics are read. Processes delivering on
+    behalf of another, like the ``salt-ci-notif`` daemon's workers, see
+    :mod:`saltci.notif.workers`, :func:`drain` their histograms and counters, which the other
+    process :func:`merge` into it's own.
+
+    The metrics are reported by ``sendmail.stats`` and, if ``metrics_export`` is enabled, written
+    every ``metrics_export_interval`` seconds, on the `Prometheus text format`_, to
+    ``<cachedir>/sendmail/metrics.prom``, ready for the node exporter's textfile collector.
+
+    .. _`Prometheus text format`: http://prometheus.io/docs/instrumenting/exposition_formats/
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import math
+import time
+import bisect
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'saltci_sendmail_'
+
+# Seconds, from a local relay's sub-millisecond replies to a remote one's timeouts
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30
+)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_METRICS = OrderedDict()
+_METRICS_LOCK = threading.Lock()
+
+
+def _register(cls, name, *args):
+    metric = _METRICS.get(name)
+    if metric is not None:
+        return metric
+    with _METRICS_LOCK:
+        if name not in _METRICS:
+            _METRICS[name] = cls(name, *args)
+        return _METRICS[name]
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help, buckets)
+
+
+def counter(name, help, label=None):
+    return _register(Counter, name, help, label)
+
+
+def meter(name, help):
+    return _register(Meter, name, help)
+
+
+def gauge(name, help, callback):
+    '''
+    Register a gauge, ``callback`` returns it's current value.
+    '''
+    return _register(Gauge, name, help, callback)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Timer(object):
+
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.started)
+
+
+class Histogram(object):
+    '''
+    Count observations in cumulative buckets.
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def time(self):
+        '''
+        Return a context manager which observes how long it's block took.
+        '''
+        return _Timer(self)
+
+    def drain(self):
+        with self._lock:
+            if not self.count:
+                return None
+            state = (self.counts, self.count, self.sum, self.max)
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.sum = self.max = 0.0
+        return state
+
+    def merge(self, state):
+        counts, count, total, maximum = state
+        with self._lock:
+            for idx, bucket_count in enumerate(counts):
+                self.counts[idx] += bucket_count
+            self.count += count
+            self.sum += total
+            if maximum > self.max:
+                self.max = maximum
+
+    def quantile(self, q):
+        '''
+        Estimate the ``q`` quantile interpolating within it's bucket.
+        '''
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+            maximum = self.max
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for idx, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.bounds[idx - 1] if idx else 0.0
+                upper = self.bounds[idx] if idx < len(self.bounds) else maximum
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, maximum)
+            seen += bucket_count
+        return maximum
+
+    def snapshot(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'avg': self.sum / self.count,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max
+        }
+
+    def render(self):
+        with self._lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds, counts):
+            cumulative += bucket_count
+            lines.append('{0}_bucket{{le="{1!r}"}} {2}'.format(self.name, bound, cumulative))
+        lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(self.name, count))
+        lines.append('{0}_sum {1!r}'.format(self.name, total))
+        lines.append('{0}_count {1}'.format(self.name, count))
+        return lines
+
+
+class Counter(object):
+    '''
+    A monotonically increasing count, optionally split by the value of a single ``label``.
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, value=None):
+        with self._lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def drain(self):
+        with self._lock:
+            values, self.values = self.values, {}
+        return values or None
+
+    def merge(self, values):
+        for value, amount in values.iteritems():
+            self.inc(amount, value)
+
+    def snapshot(self):
+        if self.label is None:
+            return self.values.get(None, 0)
+        return dict(self.values)
+
+    def render(self):
+        if self.label is None:
+            return ['{0} {1}'.format(self.name, self.values.get(None, 0))]
+        return [
+            '{0}{{{1}="{2}"}} {3}'.format(self.name, self.label, _escape(value), count)
+            for value, count in sorted(self.values.items())
+        ]
+
+
+class Meter(Counter):
+    '''
+    A counter which also tracks it's one minute exponentially weighted moving average rate.
+    '''
+
+    TICK = 5.0
+    ALPHA = 1 - math.exp(-TICK / 60.0)
+
+    def __init__(self, name, help):
+        Counter.__init__(self, name, help)
+        self.rate = 0.0
+        self._uncounted = 0
+        self._last_tick = time.time()
+
+    def _tick(self):
+        # Must be called with the lock held
+        now = time.time()
+        ticks = int((now - self._last_tick) / self.TICK)
+        if not ticks:
+            return
+        self._last_tick += ticks * self.TICK
+        instant = self._uncounted / self.TICK
+        self._uncounted = 0
+        self.rate += self.ALPHA * (instant - self.rate)
+        # The rate decays during the remaining, idle, ticks
+        self.rate *= (1 - self.ALPHA) ** (ticks - 1)
+
+    def inc(self, amount=1, value=None):
+        with self._lock:
+            self._tick()
+            self._uncounted += amount
+            self.values[None] = self.values.get(None, 0) + amount
+
+    def drain(self):
+        with self._lock:
+            self._uncounted = 0
+            values, self.values = self.values, {}
+        return values or None
+
+    def snapshot(self):
+        with self._lock:
+            self._tick()
+            return {'count': self.values.get(None, 0), 'per_second': self.rate}
+
+
+class Gauge(object):
+    '''
+    A value computed, by ``callback``, when read.
+    '''
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def snapshot(self):
+        try:
+            return self.callback()
+        except Exception:
+            log.exception('Failed to compute the {0} gauge'.format(self.name))
+            return None
+
+    def render(self):
+        value = self.snapshot()
+        if value is None:
+            return []
+        return ['{0} {1}'.format(self.name, value)]
+
+
+def snapshot():
+    '''
+    Return a dictionary with every metric's current value, keyed by their name, without the
+    common prefix.
+    '''
+    return dict([
+        (name[len(PREFIX):] if name.startswith(PREFIX) else name, metric.snapshot())
+        for name, metric in _METRICS.items()
+    ])
+
+
+def drain():
+    '''
+    Return the observations of every histogram and counter since they were last drained,
+    resetting them, for another process to :func:`merge`.
+    '''
+    state = {}
+    for name, metric in _METRICS.items():
+        if hasattr(metric, 'drain'):
+            value = metric.drain()
+            if value is not None:
+                state[name] = value
+    return state
+
+
+def merge(state):
+    '''
+    Add the observations another process :func:`drain`-ed to this process' metrics.
+    '''
+    for name, value in state.iteritems():
+        metric = _METRICS.get(name)
+        if metric is not None:
+            metric.merge(value)
+
+
+def render():
+    '''
+    Return every metric on the Prometheus text format.
+    '''
+    lines = []
+    for name, metric in _METRICS.items():
+        lines.append('# HELP {0} {1}'.format(name, metric.help))
+        lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def export_path(opts):
+    '''
+    Return the path the metrics are exported to.
+    '''
+    return os.path.join(opts['cachedir'], 'sendmail', 'metrics.prom')
+
+
+def export(path):
+    '''
+    Atomically write the metrics to ``path``, readers never see a partially written file.
+    '''
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.metrics.')
+    try:
+        with os.fdopen(fd, 'w') as wfh:
+            wfh.write(render())
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class MetricsExporter(threading.Thread):
+    '''
+    Export the metrics to ``path`` every ``interval`` seconds.
+    '''
+
+    def __init__(self, path, interval=15):
+        threading.Thread.__init__(self, name='SendmailMetricsExporter')
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                export(self.path)
+            except (IOError, OSError), err:
+                log.error('Failed to export the metrics to {0}: {1}'.format(self.path, err))
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+
+# ----- The hot path metrics -------------------------------------------------------------------->
+CONNECT = histogram(
+    PREFIX + 'connect_seconds', 'Time to establish the TCP, or SSL, connection to the server.'
+)
+HANDSHAKE = histogram(
+    PREFIX + 'handshake_seconds', 'Time spent on EHLO, STARTTLS and AUTH.'
+)
+POOL_WAIT = histogram(
+    PREFIX + 'pool_wait_seconds',
+    'Time to check out a pooled SMTP connection, including connecting a new one.'
+)
+BUILD = histogram(PREFIX + 'build_seconds', 'Time to build a message.')
+ENCODE = histogram(
+    PREFIX + 'encode_seconds',
+    'Time spent producing, and encoding, the message while streaming it to the server.'
+)
+TRANSMIT = histogram(
+    PREFIX + 'transmit_seconds', 'Time spent writing the message to the server\'s socket.'
+)
+TRANSACTION = histogram(
+    PREFIX + 'transaction_seconds', 'Time from MAIL FROM to the server accepting the message.'
+)
+DELIVERY = histogram(
+    PREFIX + 'delivery_seconds',
+    'Time to deliver a message, including the rate limiting and pool waits.'
+)
+MESSAGE_SIZE = histogram(PREFIX + 'message_bytes', 'Size of the sent messages.', SIZE_BUCKETS)
+BYTES_SENT = counter(PREFIX + 'sent_bytes_total', 'Bytes of message data sent.')
+DELIVERIES = meter(PREFIX + 'deliveries_total', 'Messages accepted by the server.')
+DEFERRALS = counter(PREFIX + 'deferrals_total', 'Deliveries the server deferred, 4xx, and retried.')
+REFUSED = counter(PREFIX + 'refused_recipients_total', 'Recipients refused by the server.')
+ERRORS = counter(PREFIX + 'errors_total', 'Failed deliveries, by error class.', 'class')
+# <---- The hot path metrics ---------------------------------------------------------------------
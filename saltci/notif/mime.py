@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.mime
+    ~~~~~~~~~~~~~~~~~
+
+    Attachment MIME type detection.
+
+    The magic database is loaded once per process and the detected types are cached, keyed by
+    the file's path, size and modification time.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import logging
+import mimetypes
+import threading
+
+# Import salt-ci libs
+from saltci.lru import LRUCache
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MIMETYPE = ('text', 'plain')
+
+
+class MimeTypeDetector(object):
+    '''
+    Detect a file's MIME type using libmagic, if available, falling back to guessing it from the
+    file's extension.
+    '''
+
+    def __init__(self, cache_size=1024):
+        self._cache = LRUCache(cache_size)
+        self._magic = None
+        self._magic_loaded = False
+        # A libmagic cookie is not thread safe
+        self._lock = threading.Lock()
+
+    def _load_magic(self):
+        # Must be called with the lock held
+        self._magic_loaded = True
+        try:
+            import magic
+        except ImportError:
+            return
+
+        try:
+            if hasattr(magic, 'open'):
+                # The bindings shipped with libmagic
+                cookie = magic.open(magic.MAGIC_MIME)
+                cookie.load()
+                self._magic = cookie.file
+            else:
+                # python-magic
+                self._magic = magic.Magic(mime=True).from_file
+        except Exception, err:
+            log.warning('Failed to load the magic database: {0}'.format(err))
+
+    def detect(self, filename):
+        '''
+        Return a ``(maintype, subtype)`` tuple for ``filename``.
+        '''
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return self._guess(filename)
+
+        key = (filename, stat.st_size, stat.st_mtime)
+        mimetype = self._cache.get(key)
+        if mimetype is None:
+            with self._lock:
+                mimetype = self._detect(filename)
+            self._cache.set(key, mimetype)
+        return mimetype
+
+    def _detect(self, filename):
+        # Must be called with the lock held
+        if not self._magic_loaded:
+            self._load_magic()
+
+        if self._magic is not None:
+            try:
+                mimetype = self._magic(filename)
+            except Exception, err:
+                log.debug('Failed to detect the mimetype of {0}: {1}'.format(filename, err))
+            else:
+                mimetype = (mimetype or '').split(';')[0].strip()
+                if mimetype.count('/') == 1:
+                    return tuple(mimetype.split('/'))
+        return self._guess(filename)
+
+    def _guess(self, filename):
+        mimetype = mimetypes.guess_type(filename)[0]
+        if mimetype is None:
+            return DEFAULT_MIMETYPE
+        return tuple(mimetype.split('/'))
+
+
+_DETECTOR = MimeTypeDetector()
+
+
+def detect_mimetype(filename):
+    '''
+    Return a ``(maintype, subtype)`` tuple for ``filename`` using the process wide detector.
+    '''
+    return _DETECTOR.detect(filename)
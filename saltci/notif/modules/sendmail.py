@@ -13,19 +13,18 @@
 # Import python libs
 import os
 import json
+import time
 import socket
 import logging
 import smtplib
 import getpass
 
-from email.encoders import encode_base64
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import formatdate, make_msgid
-
 # Import salt-ci libs
-from saltci.config import _DEFAULT_SENDMAIL_CONFIG
+from saltci.config import _DEFAULT_SENDMAIL_CONFIG, sendmail_config
+from saltci.notif import (
+    builder, delivery, digest, engine, metrics, pool, ratelimit, recipients as rcpts, spool,
+    workers
+)
 
 
 log = logging.getLogger(__name__)
@@ -35,157 +34,248 @@ __opts__ = _DEFAULT_SENDMAIL_CONFIG.copy()
 
 
 # Tell salt explicitly what functions this module provides
-__load__ = ['send', 'test']
+__load__ = ['send', 'send_many', 'send_template', 'stats', 'test']
 
 
 def __virtual__():
     opts = _get_config()
+    if opts['delivery_mode'] == 'direct':
+        # Messages are delivered to each recipient domain's mail exchanger
+        return True
     if not opts['smtp_host'] or not opts['smtp_user'] or not opts['smtp_pass']:
         log.warning('Sendmail not configured. Not loading module.')
         return False
     return True
 
 
+def _config_fingerprint():
+    '''
+    A cheap fingerprint of the sendmail sections of ``__opts__`` and ``__pillar__``.
+    '''
+    return (
+        repr(sorted(__opts__.get('sendmail', {}).items())),
+        repr(sorted(__pillar__.get('sendmail', {}).items()))
+    )
+
+
 def _get_config():
     '''
-    Load the default configuration.
-
-    We start with the default configuration and iterate over it's keys.
-    If the key is present in __opts__ and the value of __opts__[key] is not equal to the default
-    one, then that value is used and we continue onto the next key.
-    If the key is not found in __opts__, but instead is found in __pillar__ and the value of
-    __pillar__[key] is not equal to the default value, then that value is used.
-    If the key is not in either __opts__ nor __pillar__, the value remains at it's default.
+    Load the sendmail configuration from ``__opts__`` and ``__pillar__``. See
+    :func:`saltci.config.sendmail_config` for the details.
+
+    The resolved configuration is cached in ``__context__`` and only resolved again when the
+    sendmail sections of ``__opts__`` or ``__pillar__``, which is replaced when the pillar is
+    refreshed, change. The returned dictionary is shared and must not be modified.
     '''
+    fingerprint = _config_fingerprint()
+    cached = __context__.get('sendmail.config')
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
 
-    result = _DEFAULT_SENDMAIL_CONFIG.copy()
-    opts = __opts__.get('sendmail', {})
-    pillar = __pillar__.get('sendmail', {})
-    for key, value in _DEFAULT_SENDMAIL_CONFIG.iteritems():
-        if key in opts and opts[key] != value:
-            # Any options in __opts__ takes precedence to __pillar__
-            value = opts[key]
-        elif key in pillar and pillar[key] != value:
-            value = pillar[key]
-        result[key] = value
-    return result
+    opts = sendmail_config(__opts__, __pillar__)
+    if cached is not None:
+        # Only reconnect if the effective SMTP settings changed
+        pool.reconfigure(cached[1], opts)
+    __context__['sendmail.config'] = (fingerprint, opts)
+    return opts
 
 
-def _setup_mailserver():
+def _get_pool(opts=None):
     '''
-    Setup the mail server and store it in the current context.
+    Return the SMTP connection pool matching the current configuration.
     '''
-    if 'mailserver' not in __context__:
-        log.info('Setting up mailserver')
-        __context__['mailserver'] = _Connection()
+    if opts is None:
+        opts = _get_config()
+    return pool.get_pool(opts)
 
 
-class _Connection(object):
+def _build_message(subject=None, recipients=(), sender=None, body=None, html=None, cc=(),
+                   bcc=(), attachments=(), reply_to=None, charset=None, extra_headers=None,
+                   opts=None):
+    '''
+    Build the email message. The arguments are the same as the ones :func:`send` accepts, plus,
+    the already resolved sendmail configuration, ``opts``, to avoid resolving it once more.
 
-    def connect(self):
-        if getattr(self, 'server', None) is not None:
-            # Already connected
-            return
+    :returns: A ``(sender, send_to, message)`` tuple, the message being a
+              :class:`saltci.notif.builder.Message`, or, a dictionary with an 'error' key
+              explaining what the problem was.
+    '''
+    started = time.time()
 
-        opts = _get_config()
+    if not recipients and not cc and not bcc:
+        log.error('No recipients provided. Message will not be sent!')
+        return {'error': 'No recipients provided. Message will not be sent!'}
 
+    # ----- Let's convert the values passed from cli if that's the case ------------------------->
+    if recipients and isinstance(recipients, basestring):
+        recipients = tuple([addr.strip() for addr in recipients.split(',')])
+
+    if cc and isinstance(cc, basestring):
+        cc = tuple([addr.strip() for addr in cc.split(',')])
+
+    if bcc and isinstance(bcc, basestring):
+        bcc = tuple([addr.strip() for addr in bcc.split(',')])
+
+    if attachments and isinstance(attachments, basestring):
+        attachments = tuple([attachment.strip() for attachment in attachments.split(',')])
+    # <---- Let's convert the values passed from cli if that's the case --------------------------
+
+    try:
+        recipients, cc, bcc, send_to = rcpts.normalize(recipients, cc, bcc)
+    except rcpts.InvalidAddress, err:
+        log.error('{0}. Message will not be sent!'.format(err))
+        return {'error': '{0}. Message will not be sent!'.format(err)}
+
+    if not send_to:
+        log.error('No recipients provided. Message will not be sent!')
+        return {'error': 'No recipients provided. Message will not be sent!'}
+
+    if extra_headers and isinstance(extra_headers, basestring):
         try:
-            if opts.get('use_ssl', False) is True:
-                log.debug(
-                    'Setting up an SSL SMTP connection to {smtp_host}:{smtp_port}'.format(
-                        **opts
-                    )
-                )
-                mailserver = smtplib.SMTP_SSL(
-                    opts['smtp_host'],
-                    opts['smtp_port'],
-                    timeout=5
-                )
-            else:
-                log.debug(
-                    'Setting up an SMTP connection to {smtp_host}:{smtp_port}'.format(
-                        **opts
-                    )
-                )
-                mailserver = smtplib.SMTP(
-                    opts['smtp_host'],
-                    opts['smtp_port'],
-                    timeout=5
-                )
-        except socket.error, err:
-            log.error(
-                'Failed to setup SMTP connection: {0}'.format(err),
-                exc_info=err
-            )
-            raise
+            extra_headers = json.loads(extra_headers)
+        except ValueError:
+            return {'error': 'Failed to parse the extra headers JSON string'}
+        if not isinstance(extra_headers, dict):
+            return {
+                'error': 'The provided JSON string containing the extra headers did not result '
+                         'in a python dictionary'
+            }
 
-        mailserver.ehlo_or_helo_if_needed()
+    if opts is None:
+        opts = _get_config()
+
+    if charset is None:
+        charset = 'utf-8'
+
+    if sender is None:
+        # Grab any sender set on the configuration
+        sender = opts.get('sender', opts['smtp_user'])
+
+        if sender is None:
+            # Sender is still None, let's compute it
+            sender = '{0}@{1}'.format(getpass.getuser(), builder.fqdn())
+
+    if isinstance(sender, (list, tuple)):
+        # sender can be tuple of (name, address)
+        sender = '{0} <{1}>'.format(*sender)
+
+    if reply_to is None and opts.get('reply_to', None) is not None:
+        reply_to = opts['reply_to']
+    if isinstance(reply_to, (list, tuple)):
+        # reply_to can be tuple of (name, address)
+        reply_to = '{0} <{1}>'.format(*reply_to)
+
+    # Only the headers which differ between messages with the same contents are built each time
+    msg = builder.build(
+        subject, sender, body, html=html, recipients=recipients, cc=cc, bcc=bcc,
+        attachments=attachments, reply_to=reply_to, charset=charset, extra_headers=extra_headers
+    )
 
-        if opts.get('use_tls', False):
-            if 'starttls' not in mailserver.esmtp_features:
-                return 'TLS enabled but server does not support TLS'
-            mailserver.starttls()
-            mailserver.ehlo_or_helo_if_needed()
+    metrics.BUILD.observe(time.time() - started)
+    return sender, send_to, msg
 
-        if opts['smtp_user'] and opts['smtp_pass']:
-            mailserver.login(
-                opts['smtp_user'],
-                opts['smtp_pass']
+
+def _deliver(sender, send_to, payload, opts, size=None):
+    '''
+    Deliver the flattened message, ``payload``, using a pooled SMTP connection. See
+    :func:`saltci.notif.delivery.deliver` for the details.
+    '''
+    try:
+        refused = delivery.deliver(opts, sender, send_to, payload, size=size)
+        if refused:
+            return 'Message delivered to SMTP server. Refused recipients: {0}'.format(
+                ', '.join(sorted(refused))
             )
+        return 'Message delivered to SMTP server'
+    except smtplib.SMTPException, err:
+        return {'error': 'Failed to send email message: {0}'.format(err)}
+    except socket.error, err:
+        return {'error': 'Failed to setup SMTP connection: {0}'.format(err)}
 
-        mailserver.set_debuglevel(opts.get('smtp_debug_level', 0))
-        self.server = mailserver
 
-    def disconnect(self):
-        if getattr(self, 'server', None) is not None:
-            server = self.server
-            self.server = None
-            try:
-                server.quit()
-            except socket.sslerror, err:
-                # avoid false failure detection when the server closes the SMTP connection with
-                # TLS enabled
-                if not opts['use_tls']:
-                    log.exception(err)
-                    raise err
-
-    def send(self, sender, send_to, message):
-        if getattr(self, 'server', None) is None:
+def _dispatch(sender, send_to, msg, opts):
+    '''
+    Spool the message if the spool is enabled, and the daemon runs it's worker, hand it to the
+    worker processes if the daemon supervises any, see :mod:`saltci.notif.workers`, or to the
+    delivery engine if the ``async`` engine is selected, otherwise, deliver it right away. Either
+    way, the message is streamed so that it's attachments are never fully loaded into memory.
+    '''
+    size = msg.size
+    if opts['max_message_size'] and size > opts['max_message_size']:
+        return {
+            'error': 'The message size, {0} bytes, exceeds the maximum allowed size of {1} '
+                     'bytes'.format(size, opts['max_message_size'])
+        }
+
+    if opts['spool']:
+        worker = spool.get_worker(__opts__, opts)
+        if worker is None:
+            # Nothing would ever deliver it
+            log.warning(
+                'Not spooling the message, the spool worker only runs on the salt-ci-notif '
+                'daemon'
+            )
+        else:
             try:
-                self.connect()
-            except Exception, err:
-                raise Exception('Failed to setup SMTP connection: {0}'.format(err))
-        self.server.sendmail(sender, send_to, message.as_string())
+                qid = worker.spool.enqueue(sender, send_to, msg.iter_message())
+            except (IOError, OSError), err:
+                return {'error': 'Failed to spool email message: {0}'.format(err)}
+            return 'Message queued for delivery with id {0}'.format(qid)
 
-    def __del__(self):
-        self.disconnect()
-        if __context__ and 'mailserver' in __context__:
-            __context__.pop('mailserver')
+    supervisor = workers.get_pool()
+    if supervisor is not None:
+        try:
+            delivery_id = supervisor.submit(opts, sender, send_to, msg)
+        except workers.PoolFull, err:
+            return {'error': 'Failed to queue email message: {0}'.format(err)}
+        return 'Message queued for delivery with id {0}'.format(delivery_id)
 
+    if opts['engine'] == 'async':
+        try:
+            delivery_id = engine.get_engine(opts).submit(
+                sender, send_to, msg.iter_message, size=size
+            )
+        except engine.EngineFull, err:
+            return {'error': 'Failed to queue email message: {0}'.format(err)}
+        return 'Message queued for delivery with id {0}'.format(delivery_id)
 
-def _detect_mimetype(filename):
-    try:
-        import magic
-        mag = magic.open(magic.MAGIC_MIME)
-        mag.load()
-        mimetype = mag.file(filename)
-        mimetype.rsplit(';')[0]
-        return mimetype.split('/')
-    except ImportError:
-        import mimetypes
-        mimetype = mimetypes.guess_type(filename)
-        if mimetype == (None, None):
-            return ('text', 'plain')
+    return _deliver(sender, send_to, msg.iter_message, opts, size=size)
+
+
+def _send_spec(spec):
+    '''
+    Build and dispatch a message from a spec, a dictionary with the keyword arguments
+    :func:`send` accepts.
+    '''
+    opts = _get_config()
+    built = _build_message(opts=opts, **spec)
+    if isinstance(built, dict):
+        # An error occurred while building the message
+        return built
+    return _dispatch(*(built + (opts,)))
+
+
+def _coalesce(spec, digest_key, opts):
+    '''
+    Hand the message spec to the digest coalescer.
+    '''
+    if not spec.get('recipients') and not spec.get('cc') and not spec.get('bcc'):
+        log.error('No recipients provided. Message will not be sent!')
+        return {'error': 'No recipients provided. Message will not be sent!'}
+    group_id = digest.get_coalescer(opts, _send_spec).add(spec, digest_key)
+    return 'Message coalesced into digest {0}'.format(group_id)
 
 
 def send(subject=None, recipients=(), sender=None, body=None, html=None, cc=(), bcc=(),
-         attachments=(), reply_to=None, charset=None, extra_headers=None):
+         attachments=(), reply_to=None, charset=None, extra_headers=None, digest_key=None):
     '''
 
     Send an email
 
     :param subject: A string containing the email subject.
     :param recipients: A list of email addresses or a comma delimited string of email addresses.
+                       Addresses are compared case insensitively, without their display names,
+                       and duplicates, across ``recipients``, ``cc`` and ``bcc``, are dropped.
     :param sender: The email address of the sender. Defaults to what was set on the configuration
                    file. If it's a list or tuple it's expected to be something like:
                        (name, address)
@@ -204,8 +294,18 @@ def send(subject=None, recipients=(), sender=None, body=None, html=None, cc=(),
     :param charset: The charset to use in the message. If not set, defaults to utf-8.
     :param extra_headers: A dictionary containing the key and value pairs for each header. If it's
                           a string, it's handled as it was a JSON string.
-    :returns: A string if the message was properly queued on the server, a dictionary with an
-              'error' keys explaining what the problem was.
+    :param digest_key: Coalesce this message with the other messages, to the same recipients and
+                       with the same digest key, sent within ``digest_window`` seconds into a
+                       single digest email. If ``digest`` is enabled on the configuration, the
+                       subject is used as the digest key when not passed.
+    :returns: A string if the message was properly queued on the server, or locally when either
+              ``spool`` is enabled or the ``async`` engine is selected on the configuration, a
+              dictionary with an 'error' keys explaining what the problem was. Messages are
+              only spooled by the ``salt-ci-notif`` daemon, which runs the spool worker,
+              anywhere else they're delivered as if the spool was disabled.
+
+    Messages queued in memory, by the ``async`` engine or for the ``salt-ci-notif`` daemon's
+    worker processes, are not durable. Enable the spool if they must survive a restart.
 
     CLI Example::
         salt '*' subject=Foo recipients=foo@biz.tld,bar@biz.tld body='Test message!!!'
@@ -216,139 +316,213 @@ def send(subject=None, recipients=(), sender=None, body=None, html=None, cc=(),
                    which has sendmail configured!
     '''
 
-    if not recipients and not cc and not bcc:
-        log.error('No recipients provided. Message will not be sent!')
-        return {'error': 'No recipients provided. Message will not be sent!'}
-
-    # ----- Let's convert the values passed from cli if that's the case ------------------------->
-    if recipients and isinstance(recipients, basestring):
-        recipients = tuple([addr.strip() for addr in recipients.split(',')])
+    opts = _get_config()
+    if opts['digest'] or digest_key is not None:
+        return _coalesce(
+            dict(
+                subject=subject, recipients=recipients, sender=sender, body=body, html=html,
+                cc=cc, bcc=bcc, attachments=attachments, reply_to=reply_to, charset=charset,
+                extra_headers=extra_headers
+            ),
+            digest_key,
+            opts
+        )
+
+    built = _build_message(
+        subject=subject, recipients=recipients, sender=sender, body=body, html=html, cc=cc,
+        bcc=bcc, attachments=attachments, reply_to=reply_to, charset=charset,
+        extra_headers=extra_headers, opts=opts
+    )
+    if isinstance(built, dict):
+        # An error occurred while building the message
+        return built
 
-    if cc and isinstance(cc, basestring):
-        cc = tuple([addr.strip() for addr in cc.split(',')])
+    sender, send_to, msg = built
+    return _dispatch(sender, send_to, msg, opts)
 
-    if bcc and isinstance(bcc, basestring):
-        bcc = tuple([addr.strip() for addr in bcc.split(',')])
 
-    if attachments and isinstance(attachments, basestring):
-        attachments = tuple([attachment.strip() for attachment in attachments.split(',')])
-    # <---- Let's convert the values passed from cli if that's the case --------------------------
+def _render_template(template, context=None, opts=None):
+    '''
+    Render the named template. See :mod:`saltci.notif.templates` for the details.
 
-    if extra_headers and isinstance(extra_headers, basestring):
+    :returns: A dictionary with the rendered ``body`` and, if their templates exist, ``html``
+              and ``subject`` or, a dictionary with an 'error' key explaining what the problem
+              was.
+    '''
+    if context and isinstance(context, basestring):
         try:
-            extra_headers = json.loads(extra_headers)
+            context = json.loads(context)
         except ValueError:
-            return {'error': 'Failed to parse the extra headers JSON string'}
-        if not isinstance(extra_headers, dict):
-            return {
-                'error': 'The provided JSON string containing the extra headers did not result '
-                         'in a python dictionary'
-            }
+            return {'error': 'Failed to parse the template context JSON string'}
+    if context is not None and not isinstance(context, dict):
+        return {
+            'error': 'The provided template context did not result in a python dictionary'
+        }
+
+    if opts is None:
+        opts = _get_config()
+
+    # Jinja2 is only imported once a template is rendered
+    from saltci.notif import templates
+    environment = templates.get_environment(
+        templates.template_path(__opts__, opts), templates.bytecode_cache_path(__opts__)
+    )
+    try:
+        return templates.render(environment, template, context or {})
+    except templates.TemplateError, err:
+        return {'error': 'Failed to render the {0!r} template: {1}'.format(template, err)}
+
+
+def send_template(template, context=None, subject=None, recipients=(), sender=None, cc=(),
+                  bcc=(), attachments=(), reply_to=None, charset=None, extra_headers=None,
+                  digest_key=None):
+    '''
+
+    Render a named template, from the configured ``template_dir``, and send it as an email.
+
+    The template is made of ``<template>.txt``, the plain text body, and, optionally,
+    ``<template>.html``, the HTML body, and ``<template>.subject``, the subject.
+
+    :param template: The template name.
+    :param context: A dictionary with the template context. If it's a string, it's handled as it
+                    was a JSON string.
+    :param subject: A string containing the email subject. Takes precedence over the subject
+                    template.
 
+    The remaining arguments are the same as the ones :func:`send` accepts.
+
+    CLI Example::
+        salt '*' sendmail.send_template build-failed recipients=foo@biz.tld context='{"build": 1}'
+    '''
     opts = _get_config()
+    rendered = _render_template(template, context, opts)
+    if 'error' in rendered:
+        return rendered
 
-    if charset is None:
-        charset = 'utf-8'
+    if subject is None:
+        subject = rendered.get('subject', '')
 
-    if sender is None:
-        # Grab any sender set on the configuration
-        sender = opts.get('sender', opts['smtp_user'])
+    return send(
+        subject=subject, recipients=recipients, sender=sender, body=rendered['body'],
+        html=rendered.get('html'), cc=cc, bcc=bcc, attachments=attachments, reply_to=reply_to,
+        charset=charset, extra_headers=extra_headers, digest_key=digest_key
+    )
 
-        if sender is None:
-            # Sender is still None, let's compute it
-            sender = '{0}@{1}'.format(getpass.getuser(), socket.getfqdn())
 
-    if isinstance(sender, (list, tuple)):
-        # sender can be tuple of (name, address)
-        sender = '{0} <{1}>'.format(*sender)
+def _load_messages(messages):
+    '''
+    Load the message specs passed to :func:`send_many`.
+    '''
+    if not isinstance(messages, basestring):
+        return messages
 
-    if reply_to is None and opts.get('reply_to', None) is not None:
-        reply_to = opts['reply_to']
-    if isinstance(sender, (list, tuple)):
-        # reply_to can be tuple of (name, address)
-        reply_to = '{0} <{1}>'.format(*reply_to)
+    if os.path.isfile(messages):
+        # YAML is a superset of JSON, the same loader handles both
+        import yaml
+        with open(messages) as rfh:
+            return yaml.safe_load(rfh.read())
+    return json.loads(messages)
 
-    # Let's start constructing the email message
-    if len(attachments) == 0 and not html:
-        # No html content and zero attachments means plain text
-        msg = MIMEText(body, _subtype='text', _charset=charset)
-    elif len(attachments) > 0 and not html:
-        # No html and at least one attachment means multipart
-        msg = MIMEMultipart()
-        msg.attach(MIMEText(body, _subtype='text', _charset=charset))
-    else:
-        # Anything else
-        msg = MIMEMultipart()
-        alternative = MIMEMultipart('alternative')
-        alternative.attach(MIMEText(body, _subtype='plain', _charset=charset))
-        alternative.attach(MIMEText(html, _subtype='html', _charset=charset))
-        msg.attach(alternative)
-
-    msg['Message-ID'] = make_msgid()
-    msg['Subject'] = subject.rstrip()
-    msg['From'] = sender.rstrip()
-    msg['Date'] = formatdate(localtime=True)
-
-    if recipients:
-        msg['To'] = ', '.join([addr.rstrip() for addr in recipients])
-    if cc:
-        msg['Cc'] = ', '.join([addr.rstrip() for addr in cc])
-    if bcc:
-        msg['Bcc'] = ', '.join([addr.rstrip() for addr in bcc])
-    if reply_to:
-        msg['Reply-To'] = reply_to.rstrip()
-
-    send_to = set(recipients or ()) | set(bcc or ()) | set(cc or ())
-
-    if extra_headers:
-        for key, value in extra_headers.iteritems():
-            msg[key] = str(value).rstrip()
-
-    for entry in attachments:
-        if isinstance(entry, dict):
-            if isinstance(entry['mimetype'], basestring):
-                entry['mimetype'] = entry['mimetype'].split('/')
-
-            attachment = MIMEBase(*entry['mimetype'])
-            attachment.set_payload(entry['data'])
-            encode_base64(attachment)
-
-            attachment.add_header(
-                'Content-Disposition', '{0};filename={1}'.format(
-                    entry.get('disposition', 'attachment'),
-                    entry['filename']
-                )
-            )
-            for key, value in entry.get('headers', {}):
-                attachment.add_header(key, value.rstrip())
-
-        elif os.path.isfile(entry):
-            attachment = MIMEBase(*_detect_mimetype(entry))
-            attachment.set_payload(open(entry, 'rb').read())
-            encode_base64(attachment)
-            attachment.add_header(
-                'Content-Disposition', '{0};filename={1}'.format(
-                    'attachment',
-                    os.path.basename(entry)
-                )
-            )
-        else:
-            # We currently only support dict based or explicit filename attachments.
-            # Maybe latter we can add salt:// support for attachments.
-            # Would be cool if we could do something like:
-            #   salt://<minion-id>/filename
-            #   salt:///path/to/filename@<minion-id>
-            #   salt://<minion-id>@/path/to/filename
-            raise NotImplementedError
 
-        msg.attach(attachment)
+def send_many(messages):
+    '''
+    Send several email messages at once.
+
+    All messages are built in one pass, with the configuration resolved only once, and delivered
+    over as few SMTP sessions as possible. If the SMTP server supports it, commands are pipelined.
+
+    :param messages: A list of dictionaries, each of them containing the same keyword arguments
+                     :func:`send`, or :func:`send_template` if it has a ``template`` key,
+                     accepts, plus an optional ``id`` key. If it's a string, it's
+                     handled as the path to a JSON or YAML file containing that list, or,
+                     as the JSON string itself.
+    :returns: A dictionary mapping each message ``id``, or it's position on the ``messages`` list
+              if not provided, to the same return value :func:`send` would have provided.
 
-    _setup_mailserver()
+    CLI Example::
+        salt '*' sendmail.send_many /full/path/to/messages.yaml
+        salt '*' sendmail.send_many '[{"subject": "Foo", "recipients": "foo@biz.tld", "body": "Bar"}]'
+    '''
     try:
-        __context__['mailserver'].send(sender, send_to, msg)
-        return 'Message delivered to SMTP server'
-    except smtplib.SMTPException, err:
-        return {'error': 'Failed to send email message: {0}'.format(err)}
+        messages = _load_messages(messages)
+    except (IOError, ValueError), err:
+        return {'error': 'Failed to load the messages: {0}'.format(err)}
+
+    if not isinstance(messages, (list, tuple)):
+        return {'error': 'The provided messages did not result in a python list'}
+
+    opts = _get_config()
+    status = {}
+    envelopes = []
+    for idx, spec in enumerate(messages):
+        if not isinstance(spec, dict):
+            status[idx] = {'error': 'The message spec is not a dictionary'}
+            continue
+        spec = spec.copy()
+        key = spec.pop('id', idx)
+        digest_key = spec.pop('digest_key', None)
+        if 'template' in spec:
+            rendered = _render_template(spec.pop('template'), spec.pop('context', None), opts)
+            if 'error' in rendered:
+                status[key] = rendered
+                continue
+            if spec.get('subject') is None:
+                spec['subject'] = rendered.get('subject', '')
+            spec.update(body=rendered['body'], html=rendered.get('html'))
+        if opts['digest'] or digest_key is not None:
+            status[key] = _coalesce(spec, digest_key, opts)
+            continue
+        try:
+            built = _build_message(opts=opts, **spec)
+        except TypeError, err:
+            built = {'error': 'Invalid message spec: {0}'.format(err)}
+        if isinstance(built, dict):
+            status[key] = built
+            continue
+        envelopes.append((key,) + built)
+
+    for key, sender, send_to, msg in envelopes:
+        # Messages are delivered sequentially. Since the pool hands out the most recently
+        # released connection first, they all share the same warm SMTP session.
+        status[key] = _dispatch(sender, send_to, msg, opts)
+    return status
+
+
+def stats():
+    '''
+    Report the current delivery rates, concurrency and backlog, plus the hot path metrics, the
+    timing histograms summarized as their average, 50th, 90th and 99th percentiles and maximum,
+    in seconds, and the counters. See :mod:`saltci.notif.metrics`.
+
+    CLI Example::
+        salt '*' sendmail.stats
+    '''
+    opts = _get_config()
+    connections = pool.get_pool(opts)
+    ret = {
+        'relays': dict([
+            (key, limiter.stats()) for key, limiter in ratelimit.limiters().iteritems()
+        ]),
+        'pool': {'size': connections.size, 'idle': connections.idle},
+        'backlog': {
+            'waiting': sum([
+                limiter.waiting for limiter in ratelimit.limiters().itervalues()
+            ])
+        }
+    }
+    if opts['digest'] or digest.pending():
+        ret['backlog']['digest'] = digest.pending()
+    if opts['engine'] == 'async':
+        ret['backlog']['engine'] = engine.get_engine(opts).pending
+    if workers.get_pool() is not None:
+        ret['backlog']['workers'] = workers.get_pool().pending
+    if opts['spool']:
+        try:
+            ret['backlog']['spool'] = len(spool.Spool(spool.spool_path(__opts__, opts)))
+        except (IOError, OSError), err:
+            ret['backlog']['spool'] = {'error': str(err)}
+    ret['metrics'] = metrics.snapshot()
+    return ret
 
 
 def test(recipent=None):
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.pool
+    ~~~~~~~~~~~~~~~~~
+
+    Thread-safe, bounded, SMTP connection pool.
+
+    Establishing an SMTP session(EHLO, STARTTLS, AUTH) is by far the most expensive part of sending
+    a notification. The pool keeps authenticated sessions around so that concurrent
+    ``sendmail.send`` calls can reuse them.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import socket
+import logging
+import smtplib
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Import salt-ci libs
+from saltci.notif import metrics, smtp
+
+
+log = logging.getLogger(__name__)
+
+# The configuration keys which, when changed, require new SMTP connections
+CONNECTION_KEYS = (
+    'smtp_host',
+    'smtp_port',
+    'smtp_user',
+    'smtp_pass',
+    'use_ssl',
+    'use_tls',
+    'smtp_timeout',
+    'smtp_debug_level'
+)
+
+# How often, in seconds, the pools are pruned, see prune_pools()
+PRUNE_INTERVAL = 60
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+_LAST_PRUNE = 0
+
+
+class PoolTimeout(smtplib.SMTPException):
+    '''
+    Raised when no SMTP connection could be acquired from the pool in a timely fashion.
+    '''
+
+
+def fingerprint(opts):
+    '''
+    Return the key which identifies the SMTP connections the provided options produce.
+    '''
+    return tuple([opts.get(key) for key in CONNECTION_KEYS])
+
+
+def get_pool(opts):
+    '''
+    Return the connection pool for the provided resolved sendmail configuration, creating it if
+    needed.
+    '''
+    _maybe_prune()
+    key = fingerprint(opts)
+    pool = _POOLS.get(key)
+    if pool is not None:
+        return pool
+
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = SMTPConnectionPool(opts)
+        return _POOLS[key]
+
+
+def prune_pools():
+    '''
+    Close every pool's connections idle for longer than ``pool_idle_timeout`` and forget the
+    pools left without any, like those of the mail exchangers, in ``direct`` delivery mode, no
+    longer delivered to.
+    '''
+    with _POOLS_LOCK:
+        pools = _POOLS.items()
+    for key, pool in pools:
+        if not pool.reap():
+            continue
+        with _POOLS_LOCK:
+            if _POOLS.get(key) is pool:
+                del _POOLS[key]
+        # A delivery might still be using it
+        pool.retire()
+
+
+def _maybe_prune():
+    global _LAST_PRUNE
+    now = time.time()
+    if now - _LAST_PRUNE < PRUNE_INTERVAL:
+        return
+    _LAST_PRUNE = now
+    prune_pools()
+
+
+def reconfigure(old_opts, new_opts):
+    '''
+    Apply a sendmail configuration change. The pool matching ``old_opts`` is only closed, and
+    thus it's connections, if the effective SMTP connection settings changed. Otherwise, the
+    existing pool just picks up any new pool settings.
+    '''
+    old_key = fingerprint(old_opts)
+    if old_key == fingerprint(new_opts):
+        pool = _POOLS.get(old_key)
+        if pool is not None:
+            pool.configure(new_opts)
+        return
+
+    with _POOLS_LOCK:
+        pool = _POOLS.pop(old_key, None)
+    if pool is not None:
+        log.info('The SMTP connection settings changed. Closing the existing connections.')
+        pool.close()
+
+
+def close_pools():
+    '''
+    Close every known connection pool.
+    '''
+    with _POOLS_LOCK:
+        pools = _POOLS.values()
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
+
+
+def _connections(attr):
+    return sum([getattr(pool, attr) for pool in _POOLS.values()])
+
+
+metrics.gauge(
+    metrics.PREFIX + 'pool_connections', 'Open pooled SMTP connections.',
+    lambda: _connections('size')
+)
+metrics.gauge(
+    metrics.PREFIX + 'pool_idle_connections', 'Idle pooled SMTP connections.',
+    lambda: _connections('idle')
+)
+
+
+class _PooledConnection(object):
+    '''
+    Book keeping wrapper around an :class:`smtplib.SMTP` instance.
+    '''
+
+    __slots__ = ('server', 'created', 'last_used', 'messages')
+
+    def __init__(self, server):
+        self.server = server
+        self.created = self.last_used = time.time()
+        self.messages = 0
+
+
+class SMTPConnectionPool(object):
+    '''
+    A bounded pool of authenticated SMTP connections.
+
+    Connections are handed out in LIFO order, that way, the most recently used, and thus most
+    likely alive, connections get reused while the remaining ones are allowed to expire.
+    '''
+
+    def __init__(self, opts):
+        self.opts = opts.copy()
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._retired = False
+        self.last_used = time.time()
+        self._cond = threading.Condition(threading.Lock())
+        self.configure(opts)
+
+    def configure(self, opts):
+        '''
+        Apply the pool settings from ``opts``.
+        '''
+        self._cond.acquire()
+        try:
+            self.min_size = max(int(opts.get('pool_min_size', 1)), 0)
+            self.max_size = max(int(opts.get('pool_max_size', 5)), 1)
+            self.acquire_timeout = opts.get('pool_acquire_timeout', 30)
+            self.idle_timeout = opts.get('pool_idle_timeout', 300)
+            self.max_messages = opts.get('pool_max_messages', 100)
+            self.noop_interval = opts.get('pool_noop_interval', 30)
+            # More connections might be allowed now
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def acquire(self):
+        '''
+        Return a healthy :class:`_PooledConnection`, waiting at most ``pool_acquire_timeout``
+        seconds for one to be released if the pool is exhausted.
+        '''
+        deadline = None
+        while True:
+            conn = None
+            expired = []
+            self._cond.acquire()
+            try:
+                if self._closed:
+                    raise smtplib.SMTPException('The SMTP connection pool is closed')
+                self.last_used = time.time()
+                expired = self._reap_idle()
+                if self._idle:
+                    conn = self._idle.pop()
+                elif self._size < self.max_size:
+                    # Reserve the slot now, connect outside the lock
+                    self._size += 1
+                else:
+                    if deadline is None:
+                        deadline = time.time() + self.acquire_timeout
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            'Timed out waiting for an SMTP connection from the pool'
+                        )
+                    self._cond.wait(remaining)
+                    continue
+            finally:
+                self._cond.release()
+                for idle in expired:
+                    log.debug('Closing idle SMTP connection')
+                    smtp.close(idle.server, self.opts)
+
+            if conn is None:
+                try:
+                    return _PooledConnection(smtp.connect(self.opts))
+                except:
+                    self._discard_slot()
+                    raise
+
+            if self._is_healthy(conn):
+                return conn
+            self._close(conn)
+
+    def release(self, conn, discard=False):
+        '''
+        Give a connection back to the pool. Broken connections, or those which have reached
+        ``pool_max_messages``, should be discarded.
+        '''
+        conn.last_used = time.time()
+        if self.max_messages and conn.messages >= self.max_messages:
+            log.debug('SMTP connection reached the maximum messages per connection')
+            discard = True
+
+        self._cond.acquire()
+        try:
+            if not discard and not self._closed and not self._retired:
+                self._idle.append(conn)
+                self._cond.notify()
+                return
+        finally:
+            self._cond.release()
+        self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Context manager which checks out a connection and returns it to the pool once done.
+        Any error other than an SMTP response error(the session is still usable after a
+        ``RSET``) discards the connection.
+        '''
+        with metrics.POOL_WAIT.time():
+            conn = self.acquire()
+        try:
+            yield conn.server
+        except smtplib.SMTPResponseException:
+            discard = not self._reset(conn)
+            self.release(conn, discard=discard)
+            raise
+        except smtplib.SMTPRecipientsRefused:
+            discard = not self._reset(conn)
+            self.release(conn, discard=discard)
+            raise
+        except:
+            self.release(conn, discard=True)
+            raise
+        else:
+            conn.messages += 1
+            self.release(conn)
+
+    def close(self):
+        '''
+        Close all idle connections and refuse to hand out new ones. Connections currently
+        checked out are closed as they get released.
+        '''
+        self._cond.acquire()
+        try:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        for conn in idle:
+            self._close(conn)
+
+    def reap(self):
+        '''
+        Close the connections idle for longer than ``pool_idle_timeout``.
+
+        :returns: Whether the pool has no connections and wasn't used for that long either.
+        '''
+        self._cond.acquire()
+        try:
+            expired = self._reap_idle()
+            unused = (
+                self.idle_timeout and self._size == 0 and
+                time.time() - self.last_used >= self.idle_timeout
+            )
+        finally:
+            self._cond.release()
+        for idle in expired:
+            log.debug('Closing idle SMTP connection')
+            smtp.close(idle.server, self.opts)
+        return bool(unused)
+
+    def retire(self):
+        '''
+        Close the connections as they get released, while still handing out new ones, once the
+        pool is no longer known.
+        '''
+        self._cond.acquire()
+        try:
+            self._retired = True
+            idle = list(self._idle)
+            self._idle.clear()
+        finally:
+            self._cond.release()
+        for conn in idle:
+            self._close(conn)
+
+    def _reap_idle(self):
+        # Must be called with the lock held. Connections are appended to the right, so the
+        # oldest idle ones are at the left. The caller closes the returned connections once the
+        # lock is released.
+        expired = []
+        if not self.idle_timeout:
+            return expired
+        now = time.time()
+        while self._idle and self._size > self.min_size:
+            if now - self._idle[0].last_used < self.idle_timeout:
+                break
+            expired.append(self._idle.popleft())
+            self._size -= 1
+        return expired
+
+    def _is_healthy(self, conn):
+        if not self.noop_interval or time.time() - conn.last_used < self.noop_interval:
+            return True
+        try:
+            return conn.server.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error), err:
+            log.debug('Pooled SMTP connection failed the health check: {0}'.format(err))
+            return False
+
+    def _reset(self, conn):
+        try:
+            return conn.server.rset()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def _discard_slot(self):
+        self._cond.acquire()
+        try:
+            self._size -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _close(self, conn):
+        self._discard_slot()
+        smtp.close(conn.server, self.opts)
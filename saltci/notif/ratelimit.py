@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.ratelimit
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Per relay rate limiting and adaptive concurrency.
+
+    Each relay, identified by ``smtp_host:smtp_port``, gets a :class:`RelayLimiter` shared by every
+    delivery in the process. It combines two token buckets, messages and recipients per second,
+    with an AIMD(additive increase, multiplicative decrease) concurrency limit which backs off when
+    the relay defers(4xx) and slowly ramps up again on success.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import smtplib
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Import salt-ci libs
+from saltci.notif import metrics
+
+# The window, in seconds, used to compute the current rates
+RATE_WINDOW = 10
+
+# Limiters unused for this many seconds are forgotten, checked at most every PRUNE_INTERVAL
+IDLE_TIMEOUT = 600
+PRUNE_INTERVAL = 60
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+_LAST_PRUNE = 0
+
+metrics.gauge(
+    metrics.PREFIX + 'relay_waiting', 'Deliveries waiting for a relay slot.',
+    lambda: sum([limiter.waiting for limiter in _LIMITERS.values()])
+)
+
+
+def relay_key(opts):
+    return '{0}:{1}'.format(opts['smtp_host'], opts['smtp_port'])
+
+
+def get_limiter(opts):
+    '''
+    Return the limiter for the relay the provided resolved sendmail configuration points to.
+    '''
+    _maybe_prune()
+    key = relay_key(opts)
+    limiter = _LIMITERS.get(key)
+    if limiter is not None:
+        return limiter
+
+    with _LIMITERS_LOCK:
+        if key not in _LIMITERS:
+            _LIMITERS[key] = RelayLimiter(opts)
+        return _LIMITERS[key]
+
+
+def prune_limiters():
+    '''
+    Forget the limiters of the relays, like the mail exchangers in ``direct`` delivery mode,
+    not delivered to for ``IDLE_TIMEOUT`` seconds. Their rates have expired and their
+    concurrency limit is learnt again.
+    '''
+    now = time.time()
+    with _LIMITERS_LOCK:
+        for key, limiter in _LIMITERS.items():
+            if limiter.idle and now - limiter.last_used >= IDLE_TIMEOUT:
+                del _LIMITERS[key]
+
+
+def _maybe_prune():
+    global _LAST_PRUNE
+    now = time.time()
+    if now - _LAST_PRUNE < PRUNE_INTERVAL:
+        return
+    _LAST_PRUNE = now
+    prune_limiters()
+
+
+def limiters():
+    return dict(_LIMITERS)
+
+
+def is_deferral(err):
+    '''
+    Is ``err`` a transient(4xx) SMTP failure?
+    '''
+    if isinstance(err, smtplib.SMTPResponseException):
+        return 400 <= err.smtp_code < 500
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return any([400 <= code < 500 for code, _ in err.recipients.values()])
+    return False
+
+
+class TokenBucket(object):
+    '''
+    A thread-safe token bucket refilled at ``rate`` tokens per second. A ``rate`` of 0 disables
+    it.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(capacity or max(self.rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        '''
+        Take ``tokens`` from the bucket, blocking until they are available. Requests larger than
+        the bucket's capacity wait for a full bucket.
+        '''
+        if not self.rate:
+            return
+        tokens = min(float(tokens), self.capacity)
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency(object):
+    '''
+    An AIMD concurrency limit. Each success adds ``1 / limit`` to the limit, so it grows by one
+    for each "round" of successful deliveries, while each deferral halves it.
+    '''
+
+    def __init__(self, minimum=1, maximum=10):
+        self.minimum = max(int(minimum), 1)
+        self.maximum = max(int(maximum), self.minimum)
+        self.limit = float(self.minimum)
+        self.in_flight = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        self._cond.acquire()
+        try:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        finally:
+            self._cond.release()
+
+    def release(self, deferred=False):
+        self._cond.acquire()
+        try:
+            self.in_flight -= 1
+            if deferred:
+                self.limit = max(float(self.minimum), self.limit / 2)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+
+class RelayLimiter(object):
+    '''
+    Rate limiting, and adaptive concurrency, for a single relay.
+    '''
+
+    def __init__(self, opts):
+        self.relay = relay_key(opts)
+        self.messages = TokenBucket(opts.get('rate_limit_messages', 0))
+        self.recipients = TokenBucket(opts.get('rate_limit_recipients', 0))
+        self.concurrency = AdaptiveConcurrency(
+            opts.get('concurrency_min', 1), opts.get('concurrency_max', 10)
+        )
+        self.waiting = 0
+        self.delivered = 0
+        self.deferred = 0
+        self.last_used = time.time()
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def idle(self):
+        return not self.waiting and not self.concurrency.in_flight
+
+    @contextmanager
+    def slot(self, recipients=1):
+        '''
+        Wait for the rate limits, and the concurrency limit, to allow one more delivery of a
+        message with ``recipients`` recipients.
+        '''
+        with self._lock:
+            self.waiting += 1
+            self.last_used = time.time()
+        try:
+            self.messages.acquire()
+            self.recipients.acquire(recipients)
+            self.concurrency.acquire()
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+        try:
+            yield
+        except Exception, err:
+            deferred = is_deferral(err)
+            self.concurrency.release(deferred=deferred)
+            if deferred:
+                with self._lock:
+                    self.deferred += 1
+            raise
+        else:
+            self.concurrency.release()
+            now = time.time()
+            with self._lock:
+                self.delivered += 1
+                self._recent.append((now, recipients))
+                self._expire(now)
+
+    def _expire(self, now):
+        # Must be called with the lock held
+        while self._recent and now - self._recent[0][0] > RATE_WINDOW:
+            self._recent.popleft()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            messages = len(self._recent)
+            recipients = sum([count for _, count in self._recent])
+            return {
+                'messages_per_second': round(messages / float(RATE_WINDOW), 3),
+                'recipients_per_second': round(recipients / float(RATE_WINDOW), 3),
+                'concurrency_limit': int(self.concurrency.limit),
+                'in_flight': self.concurrency.in_flight,
+                'waiting': self.waiting,
+                'delivered': self.delivered,
+                'deferred': self.deferred
+            }
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.recipients
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Recipient parsing, canonicalization and grouping.
+
+    Addresses are parsed once, the results are kept in an LRU cache since the same people get
+    mailed all day, and canonicalized by stripping the display name and lower casing them, so
+    that ``Foo@X.org``, ``foo@x.org `` and ``"Foo" <foo@x.org>`` are all the same recipient.
+
+    When ``delivery_mode`` is ``direct``, recipients are grouped by their domain and each domain
+    gets a single transaction, with all it's recipients, to it's mail exchanger. The MX records
+    are looked up using `dnspython`_, if available, and cached, for the ``MX_CACHE_SIZE`` most
+    recently mailed domains, for ``mx_cache_ttl`` seconds.
+
+    .. _`dnspython`: http://www.dnspython.org
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import logging
+from collections import OrderedDict
+from email.utils import formataddr, getaddresses
+
+# Import 3rd-party libs
+try:
+    import dns.resolver
+    import dns.exception
+    HAS_DNSPYTHON = True
+except ImportError:
+    HAS_DNSPYTHON = False
+
+# Import salt-ci libs
+from saltci.lru import LRUCache
+
+
+log = logging.getLogger(__name__)
+
+
+class InvalidAddress(ValueError):
+    '''
+    Raised when a recipient is not a valid email address.
+    '''
+
+
+class AddressCache(LRUCache):
+    '''
+    A thread-safe LRU cache of parsed addresses.
+    '''
+
+    def __init__(self, cache_size=4096):
+        super(AddressCache, self).__init__(cache_size)
+
+    def parse(self, address):
+        '''
+        Return a ``(display, canonical)`` tuple for ``address``, where ``display`` is the address
+        as it should be shown on the message headers and ``canonical`` is the bare, lower cased,
+        address used to identify the recipient.
+        '''
+        parsed = self.get(address)
+        if parsed is None:
+            parsed = _parse(address)
+            self.set(address, parsed)
+        return parsed
+
+
+def _parse(address):
+    addresses = getaddresses([address])
+    if len(addresses) != 1:
+        raise InvalidAddress('{0!r} is not a single email address'.format(address))
+    name, addr = addresses[0]
+    addr = addr.strip()
+    if addr.count('@') != 1 or not all(addr.split('@')):
+        raise InvalidAddress('{0!r} is not a valid email address'.format(address))
+    return formataddr((name.strip(), addr)), addr.lower()
+
+
+_CACHE = AddressCache()
+
+
+def parse(address):
+    '''
+    Parse ``address`` using the process wide cache. See :meth:`AddressCache.parse`.
+    '''
+    return _CACHE.parse(address)
+
+
+def normalize(recipients=(), cc=(), bcc=()):
+    '''
+    Canonicalize and deduplicate the recipients. An address which is already a recipient is
+    dropped from the ``cc`` list, and one which is on either of those is dropped from the ``bcc``
+    list.
+
+    :raises InvalidAddress: If any of the addresses is invalid.
+    :returns: A ``(recipients, cc, bcc, send_to)`` tuple, where the first three are the lists of
+              addresses to show on the headers and ``send_to`` is the list of canonical addresses
+              to deliver the message to.
+    '''
+    seen = set()
+    send_to = []
+    ret = []
+    for addresses in (recipients, cc, bcc):
+        headers = []
+        for address in addresses or ():
+            if not address.strip():
+                continue
+            display, canonical = parse(address)
+            if canonical in seen:
+                continue
+            seen.add(canonical)
+            send_to.append(canonical)
+            headers.append(display)
+        ret.append(headers)
+    return tuple(ret) + (send_to,)
+
+
+def group_by_domain(send_to):
+    '''
+    Group the canonical addresses by their domain, keeping their order.
+    '''
+    groups = OrderedDict()
+    for addr in send_to:
+        groups.setdefault(addr.rsplit('@', 1)[1], []).append(addr)
+    return groups
+
+
+# How many domains' mail exchangers are cached
+MX_CACHE_SIZE = 4096
+
+_MX_CACHE = LRUCache(MX_CACHE_SIZE)
+
+
+def mx_hosts(domain, ttl=300):
+    '''
+    Return the mail exchangers for ``domain``, most preferred first. If the domain has no MX
+    records, or `dnspython`_ is not installed, the domain itself is used as the mail exchanger.
+    '''
+    now = time.time()
+    cached = _MX_CACHE.get(domain)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    if not HAS_DNSPYTHON:
+        log.debug('dnspython is not installed. Using {0} as it\'s own MX'.format(domain))
+        return [domain]
+
+    try:
+        answer = dns.resolver.query(domain, 'MX')
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        hosts = [domain]
+    except dns.exception.DNSException, err:
+        # Don't cache transient failures
+        log.warning('Failed to lookup the MX records for {0}: {1}'.format(domain, err))
+        return [domain]
+    else:
+        hosts = [
+            str(record.exchange).rstrip('.') for record in
+            sorted(answer, key=lambda record: record.preference)
+        ] or [domain]
+
+    _MX_CACHE.set(domain, (now + ttl, hosts))
+    return hosts
+
+
+def direct_opts(opts, host):
+    '''
+    Return a copy of the resolved sendmail configuration pointing at the mail exchanger ``host``.
+    The relay credentials are not sent to mail exchangers, and no connection to them is kept
+    open for longer than ``pool_idle_timeout``.
+    '''
+    opts = opts.copy()
+    opts.update(
+        smtp_host=host,
+        smtp_port=opts.get('direct_smtp_port', 25),
+        smtp_user=None,
+        smtp_pass=None,
+        use_ssl=False,
+        use_tls=opts.get('direct_use_tls', False),
+        pool_min_size=0
+    )
+    return opts
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.smtp
+    ~~~~~~~~~~~~~~~~~
+
+    Low level SMTP helpers shared by the sendmail module and it's connection pool.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import socket
+import logging
+import smtplib
+
+# Import salt-ci libs
+from saltci.notif import metrics, stream
+
+
+log = logging.getLogger(__name__)
+
+
+def connect(opts):
+    '''
+    Open, secure and authenticate a new SMTP connection using the resolved sendmail
+    configuration ``opts``.
+    '''
+    started = time.time()
+    try:
+        if opts.get('use_ssl', False) is True:
+            log.debug(
+                'Setting up an SSL SMTP connection to {smtp_host}:{smtp_port}'.format(**opts)
+            )
+            mailserver = smtplib.SMTP_SSL(
+                opts['smtp_host'],
+                opts['smtp_port'],
+                timeout=opts.get('smtp_timeout', 5)
+            )
+        else:
+            log.debug(
+                'Setting up an SMTP connection to {smtp_host}:{smtp_port}'.format(**opts)
+            )
+            mailserver = smtplib.SMTP(
+                opts['smtp_host'],
+                opts['smtp_port'],
+                timeout=opts.get('smtp_timeout', 5)
+            )
+    except socket.error, err:
+        log.error(
+            'Failed to setup SMTP connection: {0}'.format(err),
+            exc_info=err
+        )
+        raise
+    connected = time.time()
+    metrics.CONNECT.observe(connected - started)
+
+    try:
+        mailserver.ehlo_or_helo_if_needed()
+
+        if opts.get('use_tls', False):
+            if not mailserver.has_extn('starttls'):
+                raise smtplib.SMTPException('TLS enabled but server does not support TLS')
+            mailserver.starttls()
+            # The server capabilities must be queried again after STARTTLS
+            mailserver.ehlo()
+
+        if opts['smtp_user'] and opts['smtp_pass']:
+            mailserver.login(
+                opts['smtp_user'],
+                opts['smtp_pass']
+            )
+    except Exception:
+        close(mailserver, opts)
+        raise
+    metrics.HANDSHAKE.observe(time.time() - connected)
+
+    mailserver.set_debuglevel(opts.get('smtp_debug_level', 0))
+    return mailserver
+
+
+def close(mailserver, opts):
+    '''
+    Politely close an SMTP connection, ignoring any errors the server might throw at us.
+    '''
+    try:
+        mailserver.quit()
+    except socket.sslerror, err:
+        # avoid false failure detection when the server closes the SMTP connection with
+        # TLS enabled
+        if not opts.get('use_tls', False):
+            log.exception(err)
+    except (smtplib.SMTPException, socket.error), err:
+        log.debug('Error while closing SMTP connection: {0}'.format(err))
+    finally:
+        try:
+            mailserver.close()
+        except socket.error:
+            pass
+
+
+def sendmail(mailserver, from_addr, to_addrs, msg, size=None):
+    '''
+    Same as :meth:`smtplib.SMTP.sendmail` but ``msg`` can also be an iterable of strings which
+    is streamed to the server. If the server advertises the ``PIPELINING`` extension(RFC 2920),
+    the ``MAIL``, ``RCPT`` and ``DATA`` commands are sent in a single round trip.
+
+    :param size: The message size, if known, passed to servers supporting the ``SIZE``
+                 extension.
+    :returns: A dictionary with an entry for each recipient that was refused.
+    '''
+    mailserver.ehlo_or_helo_if_needed()
+    started = time.time()
+
+    if isinstance(to_addrs, basestring):
+        to_addrs = [to_addrs]
+    else:
+        to_addrs = list(to_addrs)
+
+    if size is None and isinstance(msg, basestring):
+        size = len(msg)
+
+    options = []
+    if size is not None and mailserver.does_esmtp and mailserver.has_extn('size'):
+        options.append('size={0}'.format(size))
+
+    if mailserver.has_extn('pipelining'):
+        refused = _pipelined_envelope(mailserver, from_addr, to_addrs, options)
+    else:
+        refused = _envelope(mailserver, from_addr, to_addrs, options)
+
+    # Coalesce the chunks into larger writes, small ones, like the DATA terminator, would
+    # otherwise be held back by Nagle's algorithm waiting for the previous write to be ACK'ed.
+    # The time spent on the writes is kept apart from the time spent producing the chunks,
+    # which is when the attachments are read and encoded.
+    buffered = []
+    buffered_size = 0
+    sent = 0
+    transmitting = 0.0
+    streaming = time.time()
+    for chunk in stream.quote_stream(stream.iter_chunks(msg)):
+        buffered.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size >= stream.BLOCK_SIZE:
+            writing = time.time()
+            mailserver.send(''.join(buffered))
+            transmitting += time.time() - writing
+            sent += buffered_size
+            buffered = []
+            buffered_size = 0
+    writing = time.time()
+    mailserver.send(''.join(buffered))
+    finished = time.time()
+    transmitting += finished - writing
+    sent += buffered_size
+    metrics.TRANSMIT.observe(transmitting)
+    metrics.ENCODE.observe(finished - streaming - transmitting)
+    metrics.BYTES_SENT.inc(sent)
+    metrics.MESSAGE_SIZE.observe(sent)
+
+    code, resp = mailserver.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    metrics.TRANSACTION.observe(time.time() - started)
+    return refused
+
+
+def _envelope(mailserver, from_addr, to_addrs, options):
+    '''
+    Send the ``MAIL``, ``RCPT`` and ``DATA`` commands, one at a time.
+    '''
+    code, resp = mailserver.mail(from_addr, options)
+    if code != 250:
+        mailserver.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for addr in to_addrs:
+        code, resp = mailserver.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        mailserver.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    mailserver.putcmd('data')
+    code, resp = mailserver.getreply()
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _pipelined_envelope(mailserver, from_addr, to_addrs, options):
+    '''
+    Send the ``MAIL``, ``RCPT`` and ``DATA`` commands in a single round trip.
+    '''
+    commands = ['mail FROM:{0}{1}'.format(
+        smtplib.quoteaddr(from_addr), ''.join([' ' + option for option in options])
+    )]
+    for addr in to_addrs:
+        commands.append('rcpt TO:{0}'.format(smtplib.quoteaddr(addr)))
+    commands.append('data')
+    mailserver.send(smtplib.CRLF.join(commands) + smtplib.CRLF)
+
+    # Every pipelined command gets it's reply, in order, so they all need to be consumed
+    mail_reply = mailserver.getreply()
+    refused = {}
+    for addr in to_addrs:
+        code, resp = mailserver.getreply()
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    code, resp = mailserver.getreply()
+
+    if code == 354 and (mail_reply[0] != 250 or len(refused) == len(to_addrs)):
+        # The server should not have accepted DATA, send an empty message so that the
+        # transaction is terminated and it can be reset.
+        mailserver.send('.' + smtplib.CRLF)
+        mailserver.getreply()
+
+    if mail_reply[0] != 250:
+        raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+    if len(refused) == len(to_addrs):
+        raise smtplib.SMTPRecipientsRefused(refused)
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.spool
+    ~~~~~~~~~~~~~~~~~~
+
+    Durable, on-disk, outbound mail spool and it's background delivery worker.
+
+    The spool directory layout is::
+
+        <spool_dir>/tmp/      Files being written. Never read by the worker.
+        <spool_dir>/data/     The flattened messages.
+        <spool_dir>/queue/    Envelopes waiting for delivery. The envelope's modification time is
+                              the time of the next delivery attempt.
+        <spool_dir>/active/   Envelopes currently being delivered.
+        <spool_dir>/dead/     Envelopes which could not be delivered. Their message is kept in
+                              ``data/`` for inspection.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import json
+import time
+import uuid
+import Queue
+import socket
+import logging
+import smtplib
+import threading
+
+# Import salt-ci libs
+from saltci.notif import delivery, metrics, stream
+
+
+log = logging.getLogger(__name__)
+
+SUBDIRS = ('tmp', 'data', 'queue', 'active', 'dead')
+
+# The running spool workers, by spool directory
+_WORKERS = {}
+_WORKERS_LOCK = threading.Lock()
+# Whether this process runs the spool workers, only the salt-ci-notif daemon does
+_SERVING = False
+
+
+metrics.gauge(
+    metrics.PREFIX + 'spool_messages', 'Messages on the outbound spool.',
+    lambda: sum([len(worker.spool) for worker in _WORKERS.values()])
+)
+
+
+def spool_path(opts, sendmail_opts):
+    '''
+    Return the spool directory. Unless explicitly configured, it lives under the minion's
+    ``cachedir``.
+    '''
+    if sendmail_opts.get('spool_dir'):
+        return sendmail_opts['spool_dir']
+    return os.path.join(opts['cachedir'], 'sendmail', 'spool')
+
+
+def serve():
+    '''
+    Let this process run the spool workers. Only the ``salt-ci-notif`` daemon must, a short
+    lived process would re-queue the deliveries the daemon's worker has in flight, and exit with
+    it's own in flight.
+    '''
+    global _SERVING
+    _SERVING = True
+
+
+def get_worker(opts, sendmail_opts):
+    '''
+    Return the worker draining the configured spool, starting it if needed, or ``None`` if this
+    process doesn't run the spool workers, see :func:`serve`. A running worker is handed the
+    provided resolved sendmail configuration, when it changes.
+    '''
+    if not _SERVING:
+        return None
+    path = spool_path(opts, sendmail_opts)
+    worker = _WORKERS.get(path)
+    if worker is None:
+        with _WORKERS_LOCK:
+            if path not in _WORKERS:
+                log.info('Starting the outbound mail spool worker on {0}'.format(path))
+                worker = SpoolWorker(Spool(path), sendmail_opts)
+                worker.start()
+                _WORKERS[path] = worker
+            worker = _WORKERS[path]
+    if worker.opts is not sendmail_opts:
+        worker.configure(sendmail_opts)
+    return worker
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool(object):
+    '''
+    The on-disk outbound message spool.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        for subdir in SUBDIRS:
+            dirname = os.path.join(path, subdir)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname, 0700)
+                except OSError:
+                    if not os.path.isdir(dirname):
+                        raise
+
+    def _path(self, subdir, qid):
+        return os.path.join(self.path, subdir, qid)
+
+    def _write(self, subdir, qid, data, mtime=None):
+        '''
+        Atomically, and durably, write ``data`` to ``subdir``/``qid``.
+        '''
+        tmp = self._path('tmp', '{0}.{1}'.format(qid, subdir))
+        with open(tmp, 'wb') as wfh:
+            if isinstance(data, basestring):
+                wfh.write(data)
+            else:
+                for chunk in data:
+                    wfh.write(chunk)
+            wfh.flush()
+            os.fsync(wfh.fileno())
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.rename(tmp, self._path(subdir, qid))
+        _fsync_dir(os.path.join(self.path, subdir))
+
+    def enqueue(self, sender, recipients, payload):
+        '''
+        Spool a message for delivery.
+
+        :returns: The queue id.
+        '''
+        qid = '{0:d}-{1}'.format(int(time.time() * 1000000), uuid.uuid4().hex[:12])
+        envelope = {
+            'sender': sender,
+            'recipients': list(recipients),
+            'attempts': 0,
+            'created': time.time(),
+            'last_error': None
+        }
+        # The message data has to be in place before the envelope is queued
+        self._write('data', qid, payload)
+        self._write('queue', qid, json.dumps(envelope))
+        return qid
+
+    def recover(self):
+        '''
+        Put back into the queue any envelopes left active by a previous, interrupted, run.
+        '''
+        for qid in os.listdir(os.path.join(self.path, 'active')):
+            log.info('Re-queueing interrupted spooled message {0}'.format(qid))
+            os.rename(self._path('active', qid), self._path('queue', qid))
+
+    def due(self, now=None):
+        '''
+        Return the queue ids, oldest first, whose next delivery attempt is due.
+        '''
+        if now is None:
+            now = time.time()
+        queue_dir = os.path.join(self.path, 'queue')
+        qids = []
+        for qid in sorted(os.listdir(queue_dir)):
+            try:
+                if os.stat(os.path.join(queue_dir, qid)).st_mtime <= now:
+                    qids.append(qid)
+            except OSError:
+                # Claimed in the meantime
+                continue
+        return qids
+
+    def claim(self, qid):
+        '''
+        Mark an envelope as being delivered.
+
+        :returns: The envelope dictionary or ``None`` if it was already claimed.
+        '''
+        try:
+            os.rename(self._path('queue', qid), self._path('active', qid))
+        except OSError:
+            return None
+        with open(self._path('active', qid)) as rfh:
+            return json.loads(rfh.read())
+
+    def payload(self, qid):
+        '''
+        Return a generator which reads the spooled message in chunks.
+        '''
+        rfh = open(self._path('data', qid), 'rb')
+
+        def _read():
+            try:
+                while True:
+                    chunk = rfh.read(stream.BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                rfh.close()
+        return _read()
+
+    def size(self, qid):
+        return os.path.getsize(self._path('data', qid))
+
+    def complete(self, qid):
+        os.unlink(self._path('active', qid))
+        os.unlink(self._path('data', qid))
+
+    def defer(self, qid, envelope, when):
+        self._write('queue', qid, json.dumps(envelope), mtime=when)
+        os.unlink(self._path('active', qid))
+
+    def bury(self, qid, envelope):
+        self._write('dead', qid, json.dumps(envelope))
+        os.unlink(self._path('active', qid))
+
+    def __len__(self):
+        return len(os.listdir(os.path.join(self.path, 'queue')))
+
+
+def _is_permanent(err):
+    '''
+    Permanent SMTP failures(5xx) are not worth retrying.
+    '''
+    if isinstance(err, smtplib.SMTPResponseException):
+        return 500 <= err.smtp_code < 600
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return all([500 <= code < 600 for code, _ in err.recipients.values()])
+    return False
+
+
+class SpoolWorker(object):
+    '''
+    Drain the spool in the background, using at most ``spool_workers`` concurrent deliveries.
+
+    Failed deliveries are retried with an exponential backoff, starting at ``spool_retry_delay``
+    seconds and capped at ``spool_max_retry_delay`` seconds. Messages which fail permanently, or
+    more than ``spool_max_attempts`` times, are dead-lettered.
+    '''
+
+    def __init__(self, spool, sendmail_opts):
+        self.spool = spool
+        # The number of threads can't change once started
+        self.concurrency = max(int(sendmail_opts.get('spool_workers', 2)), 1)
+        self.configure(sendmail_opts)
+        self._queue = Queue.Queue(maxsize=self.concurrency)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def configure(self, sendmail_opts):
+        '''
+        Deliver, from now on, using the provided resolved sendmail configuration.
+        '''
+        self.poll_interval = sendmail_opts.get('spool_poll_interval', 1)
+        self.max_attempts = sendmail_opts.get('spool_max_attempts', 10)
+        self.retry_delay = sendmail_opts.get('spool_retry_delay', 30)
+        self.max_retry_delay = sendmail_opts.get('spool_max_retry_delay', 3600)
+        self.opts = sendmail_opts
+
+    def start(self):
+        self.spool.recover()
+        scanner = threading.Thread(target=self._scan, name='SpoolScanner')
+        self._threads.append(scanner)
+        for idx in range(self.concurrency):
+            self._threads.append(
+                threading.Thread(target=self._work, name='SpoolWorker-{0}'.format(idx))
+            )
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _scan(self):
+        while not self._stop.is_set():
+            try:
+                for qid in self.spool.due():
+                    envelope = self.spool.claim(qid)
+                    if envelope is None:
+                        continue
+                    # Blocks while all the workers are busy
+                    self._queue.put((qid, envelope))
+            except Exception:
+                log.exception('Failed to scan the outbound mail spool')
+            self._stop.wait(self.poll_interval)
+
+    def _work(self):
+        while not self._stop.is_set():
+            qid, envelope = self._queue.get()
+            try:
+                self.deliver(qid, envelope)
+            except Exception:
+                log.exception('Failed to process spooled message {0}'.format(qid))
+
+    def deliver(self, qid, envelope):
+        try:
+            # The spool has it's own retry schedule
+            refused = delivery.deliver(
+                self.opts, envelope['sender'], envelope['recipients'],
+                lambda: self.spool.payload(qid), size=self.spool.size(qid), retries=0
+            )
+            deferred = [
+                addr for addr, (code, _) in refused.iteritems() if 400 <= code < 500
+            ]
+            if deferred:
+                # Only retry the recipients, in direct delivery mode, whose domain deferred
+                envelope['recipients'] = deferred
+                raise smtplib.SMTPRecipientsRefused(
+                    dict([(addr, refused[addr]) for addr in deferred])
+                )
+        except (smtplib.SMTPException, socket.error, IOError), err:
+            envelope['attempts'] += 1
+            envelope['last_error'] = str(err)
+            if _is_permanent(err) or envelope['attempts'] >= self.max_attempts:
+                log.error(
+                    'Giving up on spooled message {0} after {1} attempt(s): {2}'.format(
+                        qid, envelope['attempts'], err
+                    )
+                )
+                self.spool.bury(qid, envelope)
+                return
+            delay = min(
+                self.retry_delay * 2 ** (envelope['attempts'] - 1), self.max_retry_delay
+            )
+            log.warning(
+                'Failed to deliver spooled message {0}, retrying in {1} seconds: {2}'.format(
+                    qid, delay, err
+                )
+            )
+            self.spool.defer(qid, envelope, time.time() + delay)
+            return
+        log.debug('Delivered spooled message {0}'.format(qid))
+        self.spool.complete(qid)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.stream
+    ~~~~~~~~~~~~~~~~~~~
+
+    Stream email messages, and their file attachments, in chunks so that the memory used to send
+    a message does not depend on the size of it's attachments.
+
+    File attachments are added to the message as :class:`FileAttachment` parts, which only hold a
+    placeholder as their payload. When the message is streamed, the message skeleton is flattened
+    as usual and each placeholder is replaced by the base64 encoded file contents, read in blocks.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import re
+import mmap
+import uuid
+from base64 import encodestring
+from fractions import gcd
+from cStringIO import StringIO
+from email.generator import Generator
+from email.mime.base import MIMEBase
+
+CRLF = '\r\n'
+
+# base64 encodes each 57 bytes into a 76 characters line. Keep blocks a multiple of that.
+BLOCK_SIZE = 57 * 1024
+
+# The, approximate, size of the file window mapped into memory at any given time
+MMAP_WINDOW_SIZE = 4 * 1024 * 1024
+
+NEWLINES_RE = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+
+
+class FileAttachment(MIMEBase):
+    '''
+    A MIME part whose base64 encoded payload is streamed from ``path`` when the message is
+    streamed with :func:`iter_message`.
+    '''
+
+    def __init__(self, path, maintype, subtype, **params):
+        MIMEBase.__init__(self, maintype, subtype, **params)
+        self.path = path
+        self.token = 'saltci-stream-{0}'.format(uuid.uuid4().hex)
+        self['Content-Transfer-Encoding'] = 'base64'
+        self.set_payload(self.token)
+
+    def encoded_size(self):
+        '''
+        Return the size of the base64 encoded file contents.
+        '''
+        size = os.path.getsize(self.path)
+        if not size:
+            return 0
+        lines, remainder = divmod(size, 57)
+        encoded = lines * 77
+        if remainder:
+            encoded += (remainder + 2) // 3 * 4 + 1
+        # The trailing newline is not included, just like `email.encoders.encode_base64`
+        return encoded - 1
+
+    def iter_encoded(self, blocksize=BLOCK_SIZE):
+        '''
+        Yield the base64 encoded file contents. The file is memory mapped when possible.
+        '''
+        blocksize = max(blocksize - blocksize % 57, 57)
+        previous = None
+        for block in _iter_file(self.path, blocksize):
+            if previous is not None:
+                yield previous
+            previous = encodestring(block)
+        if previous is not None:
+            yield previous[:-1]
+
+
+def _iter_file(path, blocksize):
+    '''
+    Read the file in blocks. Mapped pages count towards the process RSS, so, instead of mapping
+    the whole file, it's mapped one window at a time.
+    '''
+    # Windows must start at multiples of the allocation granularity and, so that every block but
+    # the last is a multiple of 57 bytes, be a multiple of the block size.
+    window = blocksize * mmap.ALLOCATIONGRANULARITY // gcd(blocksize, mmap.ALLOCATIONGRANULARITY)
+    window *= max(MMAP_WINDOW_SIZE // window, 1)
+    with open(path, 'rb') as rfh:
+        size = os.fstat(rfh.fileno()).st_size
+        offset = 0
+        while offset < size:
+            length = min(window, size - offset)
+            try:
+                mapped = mmap.mmap(
+                    rfh.fileno(), length, access=mmap.ACCESS_READ, offset=offset
+                )
+            except (mmap.error, ValueError, EnvironmentError):
+                # Files which can't be memory mapped
+                break
+            try:
+                for position in xrange(0, length, blocksize):
+                    yield mapped[position:position + blocksize]
+            finally:
+                mapped.close()
+            offset += length
+
+        if offset < size:
+            rfh.seek(offset)
+            while True:
+                block = rfh.read(blocksize)
+                if not block:
+                    break
+                yield block
+
+
+def _flatten(msg):
+    fp = StringIO()
+    Generator(fp).flatten(msg)
+    return fp.getvalue()
+
+
+def segments(msg):
+    '''
+    Flatten the message into a list of strings and, in place of their placeholders, the
+    :class:`FileAttachment` parts. A message which is sent more than once, only needs to be
+    flattened once.
+    '''
+    skeleton = _flatten(msg)
+    parts = dict([
+        (part.token, part) for part in msg.walk() if isinstance(part, FileAttachment)
+    ])
+    if not parts:
+        return [skeleton]
+
+    ret = []
+    position = 0
+    for match in re.finditer('|'.join(parts), skeleton):
+        ret.append(skeleton[position:match.start()])
+        ret.append(parts[match.group()])
+        position = match.end()
+    ret.append(skeleton[position:])
+    return ret
+
+
+def segments_size(segments):
+    '''
+    Return the size, in bytes, of the message the ``segments`` make up.
+    '''
+    size = 0
+    for segment in segments:
+        if isinstance(segment, FileAttachment):
+            size += segment.encoded_size()
+        else:
+            size += len(segment)
+    return size
+
+
+def iter_segments(segments, blocksize=BLOCK_SIZE):
+    '''
+    Yield the message the ``segments`` make up in chunks, streaming the file attachments.
+    '''
+    for segment in segments:
+        if isinstance(segment, FileAttachment):
+            for chunk in segment.iter_encoded(blocksize):
+                yield chunk
+        elif segment:
+            yield segment
+
+
+def message_size(msg):
+    '''
+    Return the size, in bytes, of the flattened message, without flattening the file
+    attachments.
+    '''
+    return segments_size(segments(msg))
+
+
+def iter_message(msg, blocksize=BLOCK_SIZE):
+    '''
+    Yield the flattened message in chunks, streaming any :class:`FileAttachment` contents.
+    '''
+    return iter_segments(segments(msg), blocksize)
+
+
+def iter_chunks(payload):
+    '''
+    Return an iterable of chunks for ``payload`` which can either be a string or already an
+    iterable of strings.
+    '''
+    if isinstance(payload, basestring):
+        return (payload,)
+    return payload
+
+
+def quote_stream(chunks):
+    '''
+    The streaming version of :func:`smtplib.quotedata`. Normalize the line endings to ``CRLF``
+    and escape any leading dots, also for lines split across chunks. The ``DATA`` terminator is
+    appended at the end.
+    '''
+    line_start = True
+    pending_cr = False
+    for chunk in chunks:
+        if pending_cr:
+            chunk = '\r' + chunk
+            pending_cr = False
+        if chunk.endswith('\r'):
+            # It might be the first half of a CRLF
+            chunk = chunk[:-1]
+            pending_cr = True
+        if not chunk:
+            continue
+        data = NEWLINES_RE.sub(CRLF, chunk).replace(CRLF + '.', CRLF + '..')
+        if line_start and data.startswith('.'):
+            data = '.' + data
+        line_start = data.endswith(CRLF)
+        yield data
+
+    if pending_cr or not line_start:
+        yield CRLF
+    yield '.' + CRLF
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.templates
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Render notification templates locally, on the notifications minion.
+
+    A named template, ``<name>``, is made of the following files in the template directory:
+
+        ``<name>.txt``       The plain text body. Required.
+        ``<name>.html``      The HTML body. Optional, auto-escaped.
+        ``<name>.subject``   The subject. Optional.
+
+    The Jinja2 environment is created once per process. Compiled templates are kept in memory,
+    reloaded when their file changes, and their bytecode is cached on disk so that new processes
+    don't have to compile them again.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import logging
+import threading
+
+# Import 3rd-party libs
+from jinja2 import (
+    Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateError, TemplateNotFound
+)
+
+log = logging.getLogger(__name__)
+
+_ENVIRONMENTS = {}
+_ENVIRONMENTS_LOCK = threading.Lock()
+
+
+def template_path(opts, sendmail_opts):
+    '''
+    Return the template directory. Unless explicitly configured, it's ``salt-ci-notif.d/templates``
+    next to the configuration file.
+    '''
+    if sendmail_opts.get('template_dir'):
+        return sendmail_opts['template_dir']
+    return os.path.join(
+        os.path.dirname(opts.get('conf_file') or '/etc/salt/salt-ci-notif'),
+        'salt-ci-notif.d',
+        'templates'
+    )
+
+
+def bytecode_cache_path(opts):
+    '''
+    Return the directory where the compiled templates bytecode is cached.
+    '''
+    return os.path.join(opts['cachedir'], 'sendmail', 'jinja')
+
+
+def _autoescape(template_name):
+    return template_name is not None and template_name.endswith(('.html', '.htm'))
+
+
+def _get_bytecode_cache(cache_dir):
+    '''
+    Return the bytecode cache on ``cache_dir`` or ``None``, each process then compiling the
+    templates itself, if the directory can't be created or written to.
+    '''
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+    except OSError, err:
+        if not os.path.isdir(cache_dir):
+            log.warning(
+                'Not caching the templates bytecode, failed to create {0}: {1}'.format(
+                    cache_dir, err
+                )
+            )
+            return None
+    if not os.access(cache_dir, os.W_OK):
+        log.warning(
+            'Not caching the templates bytecode, {0} is not writable'.format(cache_dir)
+        )
+        return None
+    return FileSystemBytecodeCache(cache_dir)
+
+
+def get_environment(template_dir, cache_dir):
+    '''
+    Return the process wide Jinja2 environment for ``template_dir``.
+    '''
+    key = (template_dir, cache_dir)
+    environment = _ENVIRONMENTS.get(key)
+    if environment is not None:
+        return environment
+
+    with _ENVIRONMENTS_LOCK:
+        if key not in _ENVIRONMENTS:
+            _ENVIRONMENTS[key] = Environment(
+                loader=FileSystemLoader(template_dir),
+                bytecode_cache=_get_bytecode_cache(cache_dir),
+                auto_reload=True,
+                autoescape=_autoescape,
+                cache_size=400,
+                trim_blocks=True
+            )
+        return _ENVIRONMENTS[key]
+
+
+def render(environment, name, context):
+    '''
+    Render the named template.
+
+    :returns: A dictionary with the rendered ``body`` and, if their templates exist, ``html``
+              and ``subject``.
+    '''
+    rendered = {'body': environment.get_template(name + '.txt').render(context)}
+    for key, extension in (('html', '.html'), ('subject', '.subject')):
+        try:
+            template = environment.get_template(name + extension)
+        except TemplateNotFound:
+            continue
+        rendered[key] = template.render(context)
+    if 'subject' in rendered:
+        # Subjects are single line
+        rendered['subject'] = ' '.join(rendered['subject'].split())
+    return rendered
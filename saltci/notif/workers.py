@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.notif.workers
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Deliver messages from several worker processes.
+
+    When ``notif_workers`` is set, the ``salt-ci-notif`` daemon becomes a supervisor which, once
+    it's configuration is loaded, forks that many worker processes. The messages the daemon's
+    jobs send are handed to the workers, partitioned by a consistent hash of the recipients'
+    domain, so that the messages to a domain are always delivered, in order, by the same worker,
+    which reuses it's pooled SMTP connections, while delivery throughput scales with the number
+    of workers. Workers which die are restarted, on the same partition.
+
+    Messages to recipients on several domains are split into one delivery per domain when
+    ``delivery_mode`` is ``direct``, where each domain gets it's own transaction anyway, and
+    otherwise handed, whole, to the worker of their first domain, in alphabetical order.
+
+    Since every worker delivers to the relay, each one gets it's share of the relay's rate
+    limits, concurrency and connection pool, see :func:`share_budgets`, so that together they
+    stay within them. The workers forward the metrics of their deliveries to the supervisor,
+    which reports them, see :mod:`saltci.notif.metrics`.
+
+    See :func:`saltci.notif.modules.sendmail.send` on the durability of the queued messages.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import uuid
+import Queue
+import atexit
+import bisect
+import hashlib
+import logging
+import threading
+import multiprocessing
+
+# Import salt-ci libs
+from saltci.notif import delivery, metrics, ratelimit, recipients
+
+
+log = logging.getLogger(__name__)
+
+# The supervised worker pool, if this process is the supervisor
+_POOL = None
+
+# How often, in seconds, the workers forward the metrics of their deliveries
+METRICS_INTERVAL = 1
+
+
+metrics.gauge(
+    metrics.PREFIX + 'workers_pending', 'Deliveries queued to the worker processes.',
+    lambda: _POOL is not None and _POOL.pending or 0
+)
+
+
+class PoolFull(Exception):
+    '''
+    Raised when a worker already has ``engine_max_pending`` queued deliveries.
+    '''
+
+
+def get_pool():
+    '''
+    Return the running worker pool, ``None`` unless this process is the supervisor.
+    '''
+    return _POOL
+
+
+def start_pool(size):
+    '''
+    Fork the worker processes. Must be called before starting any threads.
+    '''
+    global _POOL
+    if _POOL is None:
+        _POOL = WorkerPool(size)
+        _POOL.start()
+    return _POOL
+
+
+@atexit.register
+def _stop_pool():
+    '''
+    Let the workers deliver the already queued messages before the daemon exits.
+    '''
+    if _POOL is not None:
+        _POOL.stop()
+
+
+def _point(key):
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    '''
+    A consistent hash ring. Each node is placed on the ring ``replicas`` times, a key belongs to
+    the first node found walking the ring clockwise from the key's position. Adding, or
+    removing, a node only moves the keys of it's neighbours.
+    '''
+
+    def __init__(self, nodes, replicas=64):
+        ring = sorted([
+            (_point('{0}-{1}'.format(node, replica)), node)
+            for node in nodes for replica in xrange(replicas)
+        ])
+        self._points = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get(self, key):
+        idx = bisect.bisect(self._points, _point(key))
+        return self._nodes[idx % len(self._nodes)]
+
+
+def partition(send_to, direct=False):
+    '''
+    Return a list of ``(domain, send_to)`` tuples, the deliveries the message is split into.
+    '''
+    groups = recipients.group_by_domain(send_to)
+    if direct:
+        return groups.items()
+    return [(min(groups), send_to)]
+
+
+def _share(value, idx, size, minimum):
+    return max(value // size + int(idx < value % size), minimum)
+
+
+def share_budgets(opts, idx, size):
+    '''
+    Return a copy of the resolved sendmail configuration with worker ``idx``'s share, out of
+    ``size`` workers, of the relay's rate limits, concurrency bounds and connection pool sizes.
+    Every worker gets at least one concurrency slot and connection.
+    '''
+    opts = opts.copy()
+    for name in ('rate_limit_messages', 'rate_limit_recipients'):
+        if opts.get(name):
+            opts[name] = float(opts[name]) / size
+    for name, minimum in (('concurrency_min', 1), ('concurrency_max', 1),
+                          ('pool_min_size', 0), ('pool_max_size', 1)):
+        if opts.get(name) is not None:
+            opts[name] = _share(int(opts[name]), idx, size, minimum)
+    return opts
+
+
+def _forward_metrics(results):
+    state = metrics.drain()
+    if state:
+        results.put(state)
+
+
+def _work(idx, queue, results):
+    '''
+    The worker process' main loop.
+    '''
+    log.info('Notifications worker {0} started'.format(idx))
+    # Only this worker's own deliveries are forwarded, not what the supervisor collected before
+    # forking it
+    metrics.drain()
+    forwarded = time.time()
+    while True:
+        try:
+            item = queue.get(timeout=METRICS_INTERVAL)
+        except Queue.Empty:
+            _forward_metrics(results)
+            continue
+        except (EOFError, IOError), err:
+            # The supervisor is gone
+            log.debug('Notifications worker {0} stopping: {1}'.format(idx, err))
+            return
+        if item is None:
+            _forward_metrics(results)
+            return
+        delivery_id, opts, sender, send_to, msg = item
+        try:
+            refused = delivery.deliver(opts, sender, send_to, msg.iter_message, size=msg.size)
+        except Exception:
+            log.exception('Failed to process delivery {0}'.format(delivery_id))
+            refused = None
+        if refused:
+            log.warning(
+                'Delivery {0} refused recipients: {1}'.format(
+                    delivery_id, ', '.join(sorted(refused))
+                )
+            )
+        if time.time() - forwarded >= METRICS_INTERVAL:
+            _forward_metrics(results)
+            forwarded = time.time()
+
+
+class WorkerPool(object):
+    '''
+    Supervise ``size`` worker processes, each with it's own queue, holding up to the
+    ``engine_max_pending`` deliveries the submitting configuration allows, unbounded if ``0``.
+    '''
+
+    def __init__(self, size):
+        self.size = max(int(size), 1)
+        self.ring = HashRing(range(self.size))
+        self.queues = [multiprocessing.Queue() for _ in xrange(self.size)]
+        # The workers forward the metrics of their deliveries on it
+        self.results = multiprocessing.Queue()
+        self.processes = [None] * self.size
+        self.restarts = 0
+        # The relays already warned about having fewer concurrency slots than workers
+        self._oversubscribed = set()
+        self._stop = threading.Event()
+        self._monitor = None
+        self._collector = None
+
+    @property
+    def pending(self):
+        try:
+            return sum([queue.qsize() for queue in self.queues])
+        except NotImplementedError:
+            # Not every platform implements sem_getvalue()
+            return None
+
+    def _qsize(self, idx):
+        try:
+            return self.queues[idx].qsize()
+        except NotImplementedError:
+            # The bound can't be enforced
+            return 0
+
+    def _spawn(self, idx):
+        process = multiprocessing.Process(
+            target=_work, args=(idx, self.queues[idx], self.results),
+            name='NotifWorker-{0}'.format(idx)
+        )
+        process.daemon = True
+        process.start()
+        self.processes[idx] = process
+
+    def start(self):
+        for idx in xrange(self.size):
+            self._spawn(idx)
+        self._monitor = threading.Thread(target=self._supervise, name='NotifWorkerSupervisor')
+        self._monitor.daemon = True
+        self._monitor.start()
+        self._collector = threading.Thread(target=self._collect, name='NotifWorkerMetrics')
+        self._collector.daemon = True
+        self._collector.start()
+
+    def _collect(self):
+        while True:
+            try:
+                state = self.results.get()
+            except (EOFError, IOError):
+                return
+            if state is None:
+                return
+            metrics.merge(state)
+
+    def _supervise(self):
+        while not self._stop.wait(1):
+            for idx, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                if self._stop.is_set():
+                    # Stopping, the workers exit once they've delivered their queued messages
+                    return
+                process.join()
+                log.error(
+                    'Notifications worker {0}, pid {1}, died with exit code {2}, '
+                    'restarting it'.format(idx, process.pid, process.exitcode)
+                )
+                self.restarts += 1
+                self._spawn(idx)
+
+    def submit(self, opts, sender, send_to, msg):
+        '''
+        Queue a message for delivery.
+
+        :param opts: The resolved sendmail configuration. Unless ``delivery_mode`` is
+                     ``direct``, the worker delivers with it's share of the relay's budgets,
+                     see :func:`share_budgets`.
+        :param msg: A :class:`saltci.notif.builder.Message`.
+        :returns: The delivery id.
+        '''
+        delivery_id = uuid.uuid4().hex
+        max_pending = opts['engine_max_pending']
+        direct = opts['delivery_mode'] == 'direct'
+        if not direct:
+            self._check_oversubscribed(opts)
+        for domain, domain_send_to in partition(send_to, direct):
+            idx = self.ring.get(domain)
+            if max_pending and self._qsize(idx) >= max_pending:
+                raise PoolFull(
+                    'Notifications worker {0} already has {1} deliveries pending'.format(
+                        idx, max_pending
+                    )
+                )
+            worker_opts = opts if direct else share_budgets(opts, idx, self.size)
+            self.queues[idx].put((delivery_id, worker_opts, sender, domain_send_to, msg))
+        return delivery_id
+
+    def _check_oversubscribed(self, opts):
+        relay = ratelimit.relay_key(opts)
+        if relay in self._oversubscribed or int(opts['concurrency_max']) >= self.size:
+            return
+        self._oversubscribed.add(relay)
+        log.warning(
+            'There are {0} notifications workers but only {1} concurrent deliveries allowed to '
+            '{2}, each worker is allowed one'.format(
+                self.size, opts['concurrency_max'], relay
+            )
+        )
+
+    def stop(self, timeout=30):
+        '''
+        Stop the workers once they deliver the already queued messages, waiting at most
+        ``timeout`` seconds for each.
+        '''
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        log.info(
+            'Stopping the notifications workers, {0} deliveries pending'.format(self.pending)
+        )
+        for queue in self.queues:
+            queue.put(None)
+        for idx, process in enumerate(self.processes):
+            process.join(timeout)
+            if process.is_alive():
+                log.error(
+                    'Notifications worker {0}, pid {1}, did not stop in {2} seconds, '
+                    'terminating it'.format(idx, process.pid, timeout)
+                )
+                process.terminate()
+        # Everything the workers forwarded is merged before the collector stops
+        self.results.put(None)
+        if self._collector is not None:
+            self._collector.join(timeout)
+        log.info('Notifications workers stopped')
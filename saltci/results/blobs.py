@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.results.blobs
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Keep the memory used by the test messages, their captured output, flat regardless of their
+    size.
+
+    As soon as a CI job return is parsed, the messages larger than ``results_spill_threshold``
+    bytes are written, zlib compressed, to a content addressed blob store on disk, and replaced
+    by a reference to their SHA1 hash, which is what gets stored on the database. Identical
+    messages, like the same failure on every minion, are only stored once. The messages larger
+    than ``results_compress_threshold`` bytes are kept zlib compressed until they are written to
+    the database.
+
+    Blobs are held, and never removed, while a queued message references them. Those of the
+    returns which are dropped, or discarded, are removed once no test result references them,
+    and the whole store is swept, every ``results_blob_sweep_interval`` seconds, of the blobs no
+    test result references, see :mod:`saltci.results.writer`.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import zlib
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+
+
+log = logging.getLogger(__name__)
+
+REFERENCE_PREFIX = 'saltci-blob:'
+
+# Queued messages favour speed, stored blobs, which are only compressed once, size
+QUEUE_COMPRESSION_LEVEL = 1
+BLOB_COMPRESSION_LEVEL = 6
+
+
+def blob_dir(opts):
+    '''
+    Return the blob store's directory.
+    '''
+    return opts.get('results_blob_dir') or os.path.join(
+        opts['cachedir'], 'saltci-results', 'blobs'
+    )
+
+
+def _encode(message):
+    if isinstance(message, unicode):
+        return message.encode('utf-8')
+    return message
+
+
+def reference(digest):
+    return REFERENCE_PREFIX + digest
+
+
+def parse_reference(message):
+    '''
+    Return the blob digest ``message`` references, ``None`` if it's not a reference.
+    '''
+    if isinstance(message, basestring) and message.startswith(REFERENCE_PREFIX):
+        return str(message[len(REFERENCE_PREFIX):])
+    return None
+
+
+def _is_digest(digest):
+    return len(digest) == 40 and not digest.strip('0123456789abcdef')
+
+
+class Compressed(object):
+    '''
+    A compressed message. ``len()`` is it's compressed size.
+    '''
+
+    __slots__ = ('data', 'is_unicode')
+
+    def __init__(self, message):
+        self.is_unicode = isinstance(message, unicode)
+        self.data = zlib.compress(_encode(message), QUEUE_COMPRESSION_LEVEL)
+
+    def __len__(self):
+        return len(self.data)
+
+    def inflate(self):
+        data = zlib.decompress(self.data)
+        if self.is_unicode:
+            return data.decode('utf-8')
+        return data
+
+
+def inflate(message):
+    '''
+    Return ``message`` decompressed, if it's :class:`Compressed`, or as it is.
+    '''
+    if isinstance(message, Compressed):
+        return message.inflate()
+    return message
+
+
+class BlobStore(object):
+    '''
+    A content addressed store of zlib compressed blobs, each on it's own file, named after the
+    blob's SHA1 hash, under a directory named after the hash's first two characters.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        # How many queued messages reference each blob
+        self._refs = {}
+        self._lock = threading.Lock()
+
+    def _path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def put(self, data):
+        '''
+        Store ``data``, unless it's already stored, and return it's digest. The blob is held,
+        it's never removed, until it's released, see :meth:`release`.
+        '''
+        data = _encode(data)
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._path(digest)
+        with self._lock:
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+            if os.path.exists(path):
+                return digest
+        try:
+            self._write(path, data)
+        except Exception:
+            self.release([digest])
+            raise
+        return digest
+
+    def _write(self, path, data):
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.blob.')
+        try:
+            with os.fdopen(fd, 'wb') as wfh:
+                wfh.write(zlib.compress(data, BLOB_COMPRESSION_LEVEL))
+            # Readers never see a partially written blob
+            os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def get(self, digest):
+        '''
+        Return the blob, decoded from UTF-8, ``None`` if it's not stored.
+        '''
+        if not _is_digest(digest):
+            return None
+        try:
+            with open(self._path(digest), 'rb') as rfh:
+                data = rfh.read()
+        except IOError, err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise
+        return zlib.decompress(data).decode('utf-8', 'replace')
+
+    def release(self, digests):
+        '''
+        Release the blobs :meth:`put` held, once per put, and return the set of those no longer
+        held.
+        '''
+        released = set()
+        with self._lock:
+            for digest in digests:
+                count = self._refs.get(digest, 0) - 1
+                if count > 0:
+                    self._refs[digest] = count
+                else:
+                    self._refs.pop(digest, None)
+                    released.add(digest)
+        return released
+
+    def remove(self, digest):
+        '''
+        Remove the blob, unless it's held. Return whether it was removed.
+        '''
+        with self._lock:
+            if self._refs.get(digest):
+                return False
+            try:
+                os.unlink(self._path(digest))
+            except OSError, err:
+                if err.errno == errno.ENOENT:
+                    return False
+                raise
+        return True
+
+    def digests(self):
+        '''
+        Yield the digests of the stored blobs.
+        '''
+        try:
+            dirnames = os.listdir(self.path)
+        except OSError, err:
+            if err.errno == errno.ENOENT:
+                return
+            raise
+        for dirname in dirnames:
+            if len(dirname) != 2:
+                continue
+            # Partially written blobs are not valid digests
+            for name in os.listdir(os.path.join(self.path, dirname)):
+                if _is_digest(dirname + name):
+                    yield dirname + name
+
+    def sweep(self, referenced):
+        '''
+        Remove the stored blobs which are neither on the ``referenced`` set nor held. Return how
+        many were removed.
+        '''
+        removed = 0
+        for digest in self.digests():
+            if digest in referenced:
+                continue
+            try:
+                if self.remove(digest):
+                    removed += 1
+            except OSError, err:
+                log.warning('Failed to remove the blob {0}: {1}'.format(digest, err))
+        return removed
+
+
+class MessagePacker(object):
+    '''
+    Spill, or compress, a test message depending on it's size. A threshold of ``0`` disables
+    either.
+    '''
+
+    def __init__(self, store=None, compress_threshold=0, spill_threshold=0):
+        self.store = store
+        self.compress_threshold = compress_threshold
+        self.spill_threshold = spill_threshold
+        self.compressed = 0
+        self.spilled = 0
+
+    def __call__(self, message):
+        if not isinstance(message, basestring):
+            return message
+        size = len(message)
+        if self.store is not None and self.spill_threshold and size > self.spill_threshold:
+            try:
+                digest = self.store.put(message)
+            except (IOError, OSError), err:
+                log.error('Failed to spill a {0} bytes message: {1}'.format(size, err))
+            else:
+                self.spilled += 1
+                return reference(digest)
+        if self.compress_threshold and size > self.compress_threshold:
+            self.compressed += 1
+            return Compressed(message)
+        return message
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.results.collector
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Capture the returns of CI jobs from the master's event bus and hand them to the results
+    writer.
+
+    A CI job is any job whose return is a dictionary with a ``tests`` key, which can either be:
+
+    * A dictionary mapping each test name to it's outcome, or, to a dictionary with the
+      ``outcome`` and, optionally, the ``duration``, in seconds, and ``message`` keys.
+    * A list of dictionaries with the ``name``, ``outcome`` and, optionally, the ``duration``
+      and ``message`` keys.
+
+    The outcome is one of ``passed``, ``failed``, ``error`` or ``skipped``. Booleans are also
+    accepted, ``True`` for ``passed`` and ``False`` for ``failed``. The return may also include a
+    ``build`` key, the build the job belongs to, which defaults to the job id, and a ``branch``
+    key, the branch which was built.
+
+    To enable test selection, see :mod:`saltci.selection`, each test's dictionary may include a
+    ``files`` key, the source files, relative to the repository root, the test exercised, and
+    the return a ``sources`` key, a dictionary mapping those files to their git blob id, as
+    listed by ``git ls-files -s``. Files without a blob id, untracked by git, are left out of
+    the map.
+
+    The collector runs on it's own process, started by ``salt-ci-master``, so that the database
+    work never competes with the master's own processes. Large test messages are compressed, or
+    spilled to disk, as soon as the return is parsed, see :mod:`saltci.results.blobs`. This only
+    bounds the collector's memory, the returns are published on the event bus, and received and
+    unpacked by the master, in full.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import sys
+import signal
+import logging
+import multiprocessing
+
+# Import salt-ci libs
+from saltci.results import blobs, models
+from saltci.results.writer import ResultRecord, ResultWriter, ingest_stamp_path
+
+
+log = logging.getLogger(__name__)
+
+
+def _outcome(value):
+    if value is True:
+        return 'passed'
+    if value is False:
+        return 'failed'
+    value = str(value).lower()
+    if value not in models.OUTCOMES:
+        return 'error'
+    return value
+
+
+def _parse_tests(tests, pack=None):
+    parsed = []
+    files = {}
+    if isinstance(tests, dict):
+        tests = [
+            dict(value, name=name) if isinstance(value, dict) else {'name': name, 'outcome': value}
+            for name, value in tests.iteritems()
+        ]
+    for test in tests:
+        if not isinstance(test, dict) or not test.get('name'):
+            continue
+        duration = test.get('duration')
+        try:
+            duration = float(duration) if duration is not None else None
+        except (TypeError, ValueError):
+            duration = None
+        message = test.get('message')
+        if pack is not None:
+            message = pack(message)
+        parsed.append((test['name'], _outcome(test.get('outcome')), duration, message))
+        if isinstance(test.get('files'), list):
+            files[test['name']] = test['files']
+    return parsed, files
+
+
+def parse_return(data, pack=None):
+    '''
+    Return a :class:`~saltci.results.writer.ResultRecord` if the event ``data`` is the return
+    of a CI job, ``None`` otherwise.
+
+    :param pack: A :class:`~saltci.results.blobs.MessagePacker` the test messages are passed
+                 through.
+    '''
+    if not isinstance(data, dict) or 'jid' not in data or 'id' not in data:
+        return None
+    ret = data.get('return')
+    if not isinstance(ret, dict) or not isinstance(ret.get('tests'), (dict, list)):
+        return None
+    tests, files = _parse_tests(ret['tests'], pack)
+    sources = ret.get('sources')
+    return ResultRecord(
+        jid=data['jid'],
+        minion=data['id'],
+        fun=data.get('fun', ''),
+        success=data.get('success', True),
+        build=str(ret.get('build') or data['jid']),
+        branch=str(ret.get('branch') or ''),
+        tests=tests,
+        files=files,
+        sources=sources if isinstance(sources, dict) else {}
+    )
+
+
+class ResultCollector(object):
+    '''
+    Listen to the master's event bus and write the CI job returns.
+    '''
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.writer = None
+
+    def _handle_sigterm(self, signum, frame):
+        log.info('Flushing the pending job returns before exiting')
+        if self.writer is not None:
+            self.writer.stop()
+        sys.exit(0)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        # Import salt libs
+        import salt.utils.event
+
+        engine = models.get_engine(self.opts)
+        # Create any missing tables
+        models.metadata.create_all(engine)
+
+        store = blobs.BlobStore(blobs.blob_dir(self.opts))
+        self.writer = ResultWriter(
+            engine,
+            batch_size=self.opts.get('results_batch_size', 1000),
+            flush_interval=self.opts.get('results_flush_interval', 1),
+            max_pending=self.opts.get('results_max_pending', 100000),
+            stats_window=self.opts.get('results_stats_window', 50),
+            stamp_path=ingest_stamp_path(self.opts),
+            batch_bytes=self.opts.get('results_batch_bytes', 0),
+            max_pending_bytes=self.opts.get('results_max_pending_bytes', 0),
+            store=store,
+            blob_sweep_interval=self.opts.get('results_blob_sweep_interval', 0)
+        )
+        self.writer.start()
+
+        pack = blobs.MessagePacker(
+            store,
+            compress_threshold=self.opts.get('results_compress_threshold', 0),
+            spill_threshold=self.opts.get('results_spill_threshold', 0)
+        )
+
+        event = salt.utils.event.MasterEvent(self.opts['sock_dir'])
+        log.info(
+            'Collecting CI job returns into {0}'.format(models.describe_url(engine.url))
+        )
+        while True:
+            data = event.get_event(wait=1)
+            if data is None:
+                continue
+            # The master, and this process, already hold the whole return, packing the messages
+            # only keeps the queued ones from piling up in memory
+            try:
+                record = parse_return(data, pack)
+            except Exception:
+                log.exception('Failed to parse the return for job {0}'.format(data.get('jid')))
+                continue
+            if record is not None:
+                self.writer.put(record)
+
+
+def start(opts):
+    '''
+    Start the collector on it's own process.
+    '''
+    process = multiprocessing.Process(
+        target=ResultCollector(opts).run, name='SaltCIResultCollector'
+    )
+    process.daemon = True
+    process.start()
+    return process
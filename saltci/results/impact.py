@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.results.impact
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Maintain the ``test_impact`` map, which source files, and contents, each test exercised the
+    last time it passed.
+
+    A test's rows are only replaced if the files, or their contents, changed since it last
+    passed, which is known, without reading the rows, by comparing the hash of the new rows with
+    the ``impact_digest`` kept on it's ``test_stats`` row.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import hashlib
+
+# Import 3rd-party libs
+from sqlalchemy import and_, bindparam, select
+
+# Import salt-ci libs
+from saltci.results import models
+
+
+def digest(files):
+    '''
+    Hash a sorted list of ``(path, blob)`` tuples.
+    '''
+    sha1 = hashlib.sha1()
+    for path, blob in files:
+        sha1.update('{0}\0{1}\n'.format(path, blob))
+    return sha1.hexdigest()
+
+
+def update(conn, impacts):
+    '''
+    Replace the ``test_impact`` rows of the tests in ``impacts``, a dictionary mapping
+    ``(test_id, branch)`` to a sorted list of ``(path, blob)`` tuples, which changed. Must be
+    called within the ingesting transaction, after :func:`saltci.results.stats.update`.
+    '''
+    stats = models.test_stats
+    table = models.test_impact
+
+    changed = {}
+    keys = sorted(impacts)
+    for idx in xrange(0, len(keys), models.IN_CLAUSE_SIZE):
+        chunk = keys[idx:idx + models.IN_CLAUSE_SIZE]
+        branches = set([branch for (_, branch) in chunk])
+        query = select(
+            [stats.c.test_id, stats.c.branch, stats.c.impact_digest],
+            stats.c.test_id.in_([test_id for (test_id, _) in chunk])
+        )
+        current = dict([
+            ((row[0], row[1]), row[2]) for row in conn.execute(query) if row[1] in branches
+        ])
+        for key in chunk:
+            new_digest = digest(impacts[key])
+            if current.get(key) != new_digest:
+                changed[key] = new_digest
+    if not changed:
+        return
+
+    params = [
+        {'b_test_id': test_id, 'b_branch': branch, 'b_digest': new_digest}
+        for (test_id, branch), new_digest in changed.iteritems()
+    ]
+    conn.execute(
+        table.delete().where(
+            and_(table.c.branch == bindparam('b_branch'), table.c.test_id == bindparam('b_test_id'))
+        ),
+        params
+    )
+    rows = [
+        {'branch': branch, 'test_id': test_id, 'path': path, 'blob': blob}
+        for (test_id, branch) in changed for (path, blob) in impacts[(test_id, branch)]
+    ]
+    if rows:
+        conn.execute(table.insert(), rows)
+    conn.execute(
+        stats.update().where(
+            and_(stats.c.test_id == bindparam('b_test_id'), stats.c.branch == bindparam('b_branch'))
+        ).values(impact_digest=bindparam('b_digest')),
+        params
+    )
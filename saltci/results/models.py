@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.results.models
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    The build results schema.
+
+    Tables are defined with SQLAlchemy Core, rows are written in bulk, using the DBAPI's
+    ``executemany()``, by :mod:`saltci.results.writer`, no ORM objects are ever created.
+
+    ``test_stats`` holds per test, and branch, rolling aggregates, updated incrementally as
+    results are ingested, which :mod:`saltci.results.queries` reports from without scanning
+    ``test_results``.
+
+    ``test_impact`` maps, per branch, each source file, and it's contents, to the tests which
+    exercised it the last time they passed, see :mod:`saltci.selection`.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import 3rd-party libs
+from sqlalchemy import (
+    create_engine, Column, DateTime, Float, ForeignKey, Index, Integer, MetaData, String, Table,
+    Text
+)
+from sqlalchemy.engine.url import make_url
+
+
+metadata = MetaData()
+
+builds = Table(
+    'builds', metadata,
+    Column('id', Integer, primary_key=True),
+    # The build identifier the CI run provided, the salt job id if it did not
+    Column('name', String(255), nullable=False, unique=True),
+    Column('branch', String(255), nullable=False, default='', index=True),
+    Column('created', DateTime, nullable=False),
+    # The number of test results by outcome, updated as they are ingested
+    Column('passed', Integer, nullable=False, default=0),
+    Column('failed', Integer, nullable=False, default=0),
+    Column('error', Integer, nullable=False, default=0),
+    Column('skipped', Integer, nullable=False, default=0)
+)
+
+minions = Table(
+    'minions', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(255), nullable=False, unique=True)
+)
+
+jobs = Table(
+    'jobs', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('jid', String(20), nullable=False, index=True),
+    Column('build_id', Integer, ForeignKey('builds.id'), nullable=False, index=True),
+    Column('minion_id', Integer, ForeignKey('minions.id'), nullable=False),
+    Column('fun', String(255), nullable=False),
+    Column('success', Integer, nullable=False),
+    Column('received', DateTime, nullable=False)
+)
+
+tests = Table(
+    'tests', metadata,
+    Column('id', Integer, primary_key=True),
+    # The fully qualified test name, ie, ``integration.modules.test.TestModuleTest.test_ping``
+    Column('name', String(512), nullable=False, unique=True)
+)
+
+test_results = Table(
+    'test_results', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('job_id', Integer, ForeignKey('jobs.id'), nullable=False, index=True),
+    Column('build_id', Integer, ForeignKey('builds.id'), nullable=False, index=True),
+    Column('test_id', Integer, ForeignKey('tests.id'), nullable=False),
+    # One of ``passed``, ``failed``, ``error`` or ``skipped``
+    Column('outcome', String(16), nullable=False),
+    Column('duration', Float),
+    Column('message', Text)
+)
+
+# A test's history, newest first, on a single branch
+Index(
+    'ix_test_results_test_build', test_results.c.test_id, test_results.c.build_id, test_results.c.id
+)
+
+test_stats = Table(
+    'test_stats', metadata,
+    Column('test_id', Integer, ForeignKey('tests.id'), primary_key=True),
+    Column('branch', String(255), primary_key=True),
+    Column('runs', Integer, nullable=False),
+    Column('failures', Integer, nullable=False),
+    # The outcomes of the latest ``results_stats_window`` runs, newest last, one character each,
+    # see ``OUTCOME_CODES``
+    Column('recent', String(255), nullable=False),
+    # How many times the outcome flipped between passing and failing within ``recent``
+    Column('flips', Integer, nullable=False),
+    # Exponentially weighted moving average of the duration
+    Column('avg_duration', Float),
+    Column('last_duration', Float),
+    Column('last_outcome', String(16), nullable=False),
+    Column('last_build_id', Integer, ForeignKey('builds.id'), nullable=False),
+    # The hash of the test's ``test_impact`` rows, if any
+    Column('impact_digest', String(40))
+)
+
+# The reports page through these in order
+Index('ix_test_stats_flips', test_stats.c.branch, test_stats.c.flips, test_stats.c.test_id)
+Index(
+    'ix_test_stats_duration', test_stats.c.branch, test_stats.c.avg_duration, test_stats.c.test_id
+)
+
+test_impact = Table(
+    'test_impact', metadata,
+    Column('branch', String(255), primary_key=True),
+    # The source file path, relative to the repository root
+    Column('path', String(512), primary_key=True),
+    Column('test_id', Integer, ForeignKey('tests.id'), primary_key=True),
+    # The git blob id of the file when the test last passed exercising it
+    Column('blob', String(40), nullable=False)
+)
+
+# Replacing a test's rows
+Index('ix_test_impact_test', test_impact.c.branch, test_impact.c.test_id)
+
+# The jobs whose returns are discarded, the speculative duplicates of the shard chunks another
+# minion already ran, see :mod:`saltci.scheduler`
+cancelled_jobs = Table(
+    'cancelled_jobs', metadata,
+    Column('jid', String(20), primary_key=True),
+    Column('cancelled', DateTime, nullable=False)
+)
+
+# Keep the IN clauses well below every database's bound parameters limit
+IN_CLAUSE_SIZE = 500
+
+OUTCOMES = ('passed', 'failed', 'error', 'skipped')
+OUTCOME_CODES = {'passed': 'P', 'failed': 'F', 'error': 'E', 'skipped': 'S'}
+
+
+def get_engine(opts):
+    '''
+    Create the database engine honoring the ``SQLALCHEMY_*`` settings. Pool settings which are
+    not set are left to SQLAlchemy's defaults.
+    '''
+    kwargs = {}
+    for setting, kwarg in (('SQLALCHEMY_POOL_SIZE', 'pool_size'),
+                           ('SQLALCHEMY_POOL_TIMEOUT', 'pool_timeout'),
+                           ('SQLALCHEMY_POOL_RECYCLE', 'pool_recycle')):
+        if opts.get(setting) is not None:
+            kwargs[kwarg] = opts[setting]
+    url = make_url(opts['SQLALCHEMY_DATABASE_URI'])
+    if opts.get('SQLALCHEMY_NATIVE_UNICODE') is False and url.drivername.startswith('postgres'):
+        # Only psycopg2 supports the option
+        kwargs['use_native_unicode'] = False
+    return create_engine(url, **kwargs)
+
+
+def describe_url(url):
+    '''
+    Return ``url`` fit to be logged, only it's driver, host and database, never it's credentials.
+    '''
+    url = make_url(url)
+    return '{0}://{1}{2}/{3}'.format(
+        url.drivername, url.host or '', url.port and ':{0}'.format(url.port) or '',
+        url.database or ''
+    )
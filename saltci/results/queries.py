@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.results.queries
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    The build history reports.
+
+    The reports read the precomputed ``test_stats`` aggregates, walking the indexes they are
+    sorted by, and page through them using keyset pagination: instead of an ``OFFSET``, which
+    the database has to scan through, each page returns a cursor, the sort key of it's last row,
+    and the next page starts right after it.
+
+    Cursors are opaque strings meant to be passed back, as is, by the web interface.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import 3rd-party libs
+from sqlalchemy import and_, or_, select
+
+# Import salt-ci libs
+from saltci.results import models
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursor(ValueError):
+    '''
+    Raised when a pagination cursor can't be decoded.
+    '''
+
+
+def encode_cursor(value, test_id):
+    return '{0!r}:{1}'.format(value, test_id)
+
+
+def decode_cursor(cursor, kind=int):
+    try:
+        value, test_id = cursor.rsplit(':', 1)
+        return kind(value), int(test_id)
+    except (AttributeError, TypeError, ValueError):
+        raise InvalidCursor('Invalid cursor: {0!r}'.format(cursor))
+
+
+def _page(conn, column, branch, limit, after, kind, where=None):
+    '''
+    Return a page of ``test_stats`` rows, for ``branch``, sorted by ``column`` and the test id,
+    both descending, so that the database walks the index backwards without sorting.
+    '''
+    stats = models.test_stats
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    clauses = [stats.c.branch == (branch or '')]
+    if where is not None:
+        clauses.append(where)
+    if after:
+        value, test_id = decode_cursor(after, kind)
+        clauses.append(
+            or_(column < value, and_(column == value, stats.c.test_id < test_id))
+        )
+
+    query = select(
+        [stats, models.tests.c.name],
+        and_(*clauses),
+        from_obj=[stats.join(models.tests, models.tests.c.id == stats.c.test_id)]
+    ).order_by(column.desc(), stats.c.test_id.desc()).limit(limit + 1)
+
+    rows = [dict(row) for row in conn.execute(query)]
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1][column.name], rows[-1]['test_id'])
+    return {'results': rows, 'next': cursor}
+
+
+def flaky_tests(conn, branch=None, limit=DEFAULT_PAGE_SIZE, after=None, min_flips=1):
+    '''
+    The tests which flipped the most between passing and failing within their latest runs, see
+    the ``results_stats_window`` setting.
+
+    :param after: The cursor returned with the previous page.
+    :returns: A dictionary with the ``results`` list and the ``next`` page cursor, ``None`` if
+              it's the last page.
+    '''
+    stats = models.test_stats
+    return _page(
+        conn, stats.c.flips, branch, limit, after, int, where=stats.c.flips >= min_flips
+    )
+
+
+def slowest_tests(conn, branch=None, limit=DEFAULT_PAGE_SIZE, after=None):
+    '''
+    The tests with the highest moving average duration.
+
+    :param after: The cursor returned with the previous page.
+    :returns: A dictionary with the ``results`` list and the ``next`` page cursor, ``None`` if
+              it's the last page.
+    '''
+    stats = models.test_stats
+    return _page(
+        conn, stats.c.avg_duration, branch, limit, after, float,
+        where=stats.c.avg_duration != None
+    )
+
+
+def test_durations(conn, names, branch=''):
+    '''
+    The moving average duration, on ``branch``, of the ``names`` tests which have one.
+
+    :returns: A dictionary mapping the test names to their average duration.
+    '''
+    stats = models.test_stats
+    tests = models.tests
+    names = list(names)
+    durations = {}
+    for idx in xrange(0, len(names), models.IN_CLAUSE_SIZE):
+        query = select(
+            [tests.c.name, stats.c.avg_duration],
+            and_(
+                tests.c.name.in_(names[idx:idx + models.IN_CLAUSE_SIZE]),
+                stats.c.branch == (branch or ''),
+                stats.c.avg_duration != None
+            ),
+            from_obj=[tests.join(stats, stats.c.test_id == tests.c.id)]
+        )
+        for name, duration in conn.execute(query):
+            durations[name] = duration
+    return durations
+
+
+def latest_builds(conn, branch=None, limit=20):
+    '''
+    The latest builds, newest first, with their test results counted by outcome.
+    '''
+    builds = models.builds
+    query = select([builds])
+    if branch is not None:
+        query = query.where(builds.c.branch == branch)
+    query = query.order_by(builds.c.id.desc()).limit(max(1, min(int(limit), MAX_PAGE_SIZE)))
+    rows = []
+    for row in conn.execute(query):
+        row = dict(row)
+        row['status'] = 'failed' if row['failed'] or row['error'] else 'passed'
+        rows.append(row)
+    return rows
+
+
+def test_history(conn, test_id, limit=DEFAULT_PAGE_SIZE, before=None):
+    '''
+    A test's results, newest build first, walking the ``(test_id, build_id, id)`` index. A
+    build may hold several results of the same test, one per job, so results are sorted, and
+    paged, by their build and result ids.
+
+    :param before: The cursor of the previous page, only the older results are returned.
+    '''
+    results = models.test_results
+    builds = models.builds
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    clauses = [results.c.test_id == test_id]
+    if before:
+        build_id, result_id = decode_cursor(before)
+        clauses.append(
+            or_(
+                results.c.build_id < build_id,
+                and_(results.c.build_id == build_id, results.c.id < result_id)
+            )
+        )
+    query = select(
+        [
+            results.c.id, results.c.build_id, builds.c.name.label('build'), builds.c.branch,
+            results.c.outcome, results.c.duration, results.c.message
+        ],
+        and_(*clauses),
+        from_obj=[results.join(builds, builds.c.id == results.c.build_id)]
+    ).order_by(results.c.build_id.desc(), results.c.id.desc()).limit(limit + 1)
+
+    rows = [dict(row) for row in conn.execute(query)]
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1]['build_id'], rows[-1]['id'])
+    return {'results': rows, 'next': cursor}
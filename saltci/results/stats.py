@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.results.stats
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Incrementally maintained, per test and branch, rolling aggregates.
+
+    Each ingested result is folded into it's test's ``test_stats`` row: the run and failure
+    counters, the outcomes of the latest runs, how many times those flipped between passing and
+    failing, and an exponentially weighted moving average of the duration. Only the rows of the
+    tests in the ingested batch are read and written.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import 3rd-party libs
+from sqlalchemy import and_, bindparam, select
+
+# Import salt-ci libs
+from saltci.results import models
+
+DEFAULT_WINDOW = 50
+# The weight of the latest duration on the moving average
+EWMA_ALPHA = 0.2
+
+
+def count_flips(recent):
+    '''
+    Count how many times the outcomes in ``recent`` flipped between passing and failing. Skipped
+    runs are ignored.
+    '''
+    flips = 0
+    previous = None
+    for code in recent:
+        if code == models.OUTCOME_CODES['skipped']:
+            continue
+        failing = code != models.OUTCOME_CODES['passed']
+        if previous is not None and failing != previous:
+            flips += 1
+        previous = failing
+    return flips
+
+
+def fold(stats, build_id, outcome, duration, window=DEFAULT_WINDOW):
+    '''
+    Fold a single result into the ``stats`` dictionary, a ``test_stats`` row.
+    '''
+    stats['runs'] += 1
+    if outcome in ('failed', 'error'):
+        stats['failures'] += 1
+    stats['recent'] = (stats['recent'] + models.OUTCOME_CODES[outcome])[-window:]
+    if duration is not None:
+        average = stats['avg_duration']
+        if average is None:
+            stats['avg_duration'] = duration
+        else:
+            stats['avg_duration'] = average + EWMA_ALPHA * (duration - average)
+        stats['last_duration'] = duration
+    stats['last_outcome'] = outcome
+    stats['last_build_id'] = build_id
+
+
+def update(conn, results, window=DEFAULT_WINDOW):
+    '''
+    Fold the ingested ``results``, a list of ``(test_id, branch, build_id, outcome, duration)``
+    tuples, into ``test_stats``. Must be called within the ingesting transaction.
+    '''
+    window = max(1, min(int(window), models.test_stats.c.recent.type.length))
+    table = models.test_stats
+
+    existing = {}
+    test_ids = sorted(set([result[0] for result in results]))
+    branches = set([result[1] for result in results])
+    for idx in xrange(0, len(test_ids), models.IN_CLAUSE_SIZE):
+        chunk = test_ids[idx:idx + models.IN_CLAUSE_SIZE]
+        query = select([table], table.c.test_id.in_(chunk))
+        for row in conn.execute(query):
+            if row['branch'] in branches:
+                existing[(row['test_id'], row['branch'])] = dict(row)
+
+    new = {}
+    # Builds are folded in the order they were created
+    for test_id, branch, build_id, outcome, duration in sorted(results, key=lambda r: r[2]):
+        key = (test_id, branch)
+        stats = existing.get(key) or new.get(key)
+        if stats is None:
+            stats = new[key] = {
+                'test_id': test_id,
+                'branch': branch,
+                'runs': 0,
+                'failures': 0,
+                'recent': '',
+                'flips': 0,
+                'avg_duration': None,
+                'last_duration': None,
+            }
+        fold(stats, build_id, outcome, duration, window)
+
+    touched = set([(result[0], result[1]) for result in results])
+    updates = []
+    for key, stats in existing.iteritems():
+        if key not in touched:
+            continue
+        stats['flips'] = count_flips(stats['recent'])
+        row = dict([('b_' + name, value) for name, value in stats.iteritems()])
+        updates.append(row)
+    for stats in new.itervalues():
+        stats['flips'] = count_flips(stats['recent'])
+
+    if updates:
+        conn.execute(
+            table.update().where(
+                and_(
+                    table.c.test_id == bindparam('b_test_id'),
+                    table.c.branch == bindparam('b_branch')
+                )
+            ).values(
+                dict([
+                    (name, bindparam('b_' + name)) for name in (
+                        'runs', 'failures', 'recent', 'flips', 'avg_duration', 'last_duration',
+                        'last_outcome', 'last_build_id'
+                    )
+                ])
+            ),
+            updates
+        )
+    if new:
+        conn.execute(table.insert(), new.values())
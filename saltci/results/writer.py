@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.results.writer
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Buffered, bulk, writer of CI job returns.
+
+    Returns are queued in memory and written, by a single background thread, in batches of up to
+    ``results_batch_size`` test results, or ``results_batch_bytes`` bytes of test messages, or
+    whatever arrived within ``results_flush_interval`` seconds. Each batch is written in a single
+    transaction using multi-row inserts, the DBAPI's ``executemany()``, so a 10k tests run takes
+    a few transactions instead of 10k, while a few large returns never pile up in memory. The
+    queue itself holds up to ``results_max_pending`` returns and ``results_max_pending_bytes``
+    bytes.
+
+    The ids of builds, minions and tests are cached, only the names never seen before hit the
+    database. The per test rolling aggregates, see :mod:`saltci.results.stats`, and the test
+    impact map, see :mod:`saltci.results.impact`, are updated within the same transaction.
+
+    After each committed batch, the ingest stamp file is touched, which lets other processes,
+    like ``salt-ci-web``, know, with a single ``stat()``, whether there are new results.
+
+    The blobs of the test messages which were spilled to disk, see :mod:`saltci.results.blobs`,
+    are removed once their returns are dropped, or discarded, and no test result references
+    them. Every ``results_blob_sweep_interval`` seconds, the writer's thread also sweeps the
+    blob store of every blob no test result references.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import time
+import Queue
+import logging
+import threading
+from datetime import datetime
+
+# Import 3rd-party libs
+from sqlalchemy import bindparam, select
+
+# Import salt-ci libs
+from saltci.results import blobs, impact, models, stats
+
+
+log = logging.getLogger(__name__)
+
+
+_SIZED = (basestring, blobs.Compressed)
+
+
+class ResultRecord(object):
+    '''
+    A single minion's return of a CI job.
+    '''
+
+    __slots__ = (
+        'jid', 'minion', 'fun', 'success', 'build', 'branch', 'received', 'tests', 'files',
+        'sources', 'size'
+    )
+
+    def __init__(self, jid, minion, fun, success, build, tests, branch='', received=None,
+                 files=None, sources=None):
+        self.jid = jid
+        self.minion = minion
+        self.fun = fun
+        self.success = success
+        self.build = build
+        self.branch = branch or ''
+        # A list of ``(name, outcome, duration, message)`` tuples, the message may be
+        # compressed, see :mod:`saltci.results.blobs`
+        self.tests = tests
+        # Maps test names to the source files they exercised, and those to their git blob id
+        self.files = files or {}
+        self.sources = sources or {}
+        self.received = received or datetime.utcnow()
+        # The, approximate, memory held by the test names and messages
+        self.size = sum([
+            len(test[0]) + (len(test[3]) if isinstance(test[3], _SIZED) else 0)
+            for test in tests
+        ])
+
+
+def ingest_stamp_path(opts):
+    '''
+    Return the path of the file touched whenever new results are written.
+    '''
+    return os.path.join(opts['cachedir'], 'saltci-results.stamp')
+
+
+def touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+
+def _chunks(items, size=models.IN_CLAUSE_SIZE):
+    for idx in xrange(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+class ResultWriter(object):
+    '''
+    Write :class:`ResultRecord` instances to the database in batches.
+    '''
+
+    def __init__(self, engine, batch_size=1000, flush_interval=1, max_pending=100000,
+                 max_retries=3, stats_window=stats.DEFAULT_WINDOW, stamp_path=None,
+                 batch_bytes=0, max_pending_bytes=0, store=None, blob_sweep_interval=0):
+        self.engine = engine
+        # The :class:`~saltci.results.blobs.BlobStore` the test messages were spilled to
+        self.store = store
+        self.blob_sweep_interval = blob_sweep_interval
+        self._last_sweep = 0
+        # The blobs of dropped records, removed by the writer's thread
+        self._orphans = set()
+        self._orphans_lock = threading.Lock()
+        self.stamp_path = stamp_path
+        self.stats_window = stats_window
+        self.batch_size = max(int(batch_size), 1)
+        self.batch_bytes = batch_bytes
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self._bytes_lock = threading.Lock()
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.written = 0
+        self.dropped = 0
+        self._queue = Queue.Queue(max_pending)
+        self._ids = {models.builds: {}, models.minions: {}, models.tests: {}}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def put(self, record):
+        '''
+        Queue a record to be written. If the queue is full, the record is dropped.
+        '''
+        with self._bytes_lock:
+            full = bool(
+                self.max_pending_bytes and self.pending_bytes and
+                self.pending_bytes + record.size > self.max_pending_bytes
+            )
+            if not full:
+                try:
+                    self._queue.put_nowait(record)
+                except Queue.Full:
+                    full = True
+                else:
+                    self.pending_bytes += record.size
+        if full:
+            self.dropped += 1
+            log.error(
+                'The results queue is full, dropping the return of {0} for job {1}'.format(
+                    record.minion, record.jid
+                )
+            )
+            self._release([record], dropped=True)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ResultWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop the writer, once every queued record is written.
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _next_batch(self):
+        '''
+        Wait for a record and then gather records until the batch is full or the flush interval
+        expires.
+        '''
+        batch = []
+        size = 0
+        nbytes = 0
+        deadline = None
+        while size < self.batch_size and not (self.batch_bytes and nbytes >= self.batch_bytes):
+            if deadline is None:
+                timeout = 0.5
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                record = self._queue.get(timeout=timeout)
+            except Queue.Empty:
+                if deadline is None and not self._stop.is_set():
+                    continue
+                break
+            if deadline is None:
+                deadline = time.time() + self.flush_interval
+            with self._bytes_lock:
+                self.pending_bytes -= record.size
+            batch.append(record)
+            # A return without tests still makes a row
+            size += len(record.tests) or 1
+            nbytes += record.size
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write_batch(batch)
+            if self.store is not None:
+                self._collect_garbage()
+            if not batch and self._stop.is_set():
+                return
+
+    def _write_batch(self, batch):
+        for attempt in xrange(self.max_retries + 1):
+            try:
+                self.write(batch)
+                self.written += len(batch)
+                break
+            except Exception:
+                if attempt == self.max_retries:
+                    log.exception(
+                        'Failed to write {0} job return(s), dropping them'.format(len(batch))
+                    )
+                    self.dropped += len(batch)
+                    self._release(batch, dropped=True)
+                    return
+                log.exception('Failed to write {0} job return(s), retrying'.format(len(batch)))
+                time.sleep(2 ** attempt)
+
+        if self.stamp_path is not None:
+            try:
+                touch(self.stamp_path)
+            except (IOError, OSError), err:
+                log.warning('Failed to touch {0}: {1}'.format(self.stamp_path, err))
+
+    def _release(self, records, dropped=False):
+        '''
+        Release the blobs the test messages of ``records`` reference. Those of dropped records
+        are removed, by the writer's thread, once no test result references them.
+        '''
+        if self.store is None:
+            return
+        released = self.store.release([
+            digest for digest in [
+                blobs.parse_reference(test[3]) for record in records for test in record.tests
+            ] if digest is not None
+        ])
+        if dropped and released:
+            with self._orphans_lock:
+                self._orphans.update(released)
+
+    def _referenced_blobs(self, digests=None):
+        '''
+        Return the set of the blob digests, out of ``digests``, or out of every blob if
+        ``None``, which test results reference.
+        '''
+        message = models.test_results.c.message
+        if digests is None:
+            queries = [select([message], message.startswith(blobs.REFERENCE_PREFIX))]
+        else:
+            queries = [
+                select([message], message.in_([blobs.reference(digest) for digest in chunk]))
+                for chunk in _chunks(sorted(digests))
+            ]
+        referenced = set()
+        conn = self.engine.connect()
+        try:
+            for query in queries:
+                referenced.update([blobs.parse_reference(row[0]) for row in conn.execute(query)])
+        finally:
+            conn.close()
+        return referenced
+
+    def sweep_blobs(self):
+        '''
+        Remove the blobs no test result references, nor any queued record, and return how many
+        were removed.
+        '''
+        return self.store.sweep(self._referenced_blobs())
+
+    def _collect_garbage(self):
+        with self._orphans_lock:
+            orphans, self._orphans = self._orphans, set()
+        if orphans:
+            try:
+                referenced = self._referenced_blobs(orphans)
+            except Exception:
+                log.exception('Failed to check the references of {0} blob(s)'.format(len(orphans)))
+                # Retried after the next batch, or left to the sweep
+                with self._orphans_lock:
+                    self._orphans.update(orphans)
+            else:
+                for digest in orphans - referenced:
+                    try:
+                        self.store.remove(digest)
+                    except OSError, err:
+                        log.warning('Failed to remove the blob {0}: {1}'.format(digest, err))
+
+        if not self.blob_sweep_interval or \
+                time.time() - self._last_sweep < self.blob_sweep_interval:
+            return
+        self._last_sweep = time.time()
+        try:
+            removed = self.sweep_blobs()
+        except Exception:
+            log.exception('Failed to sweep the blob store')
+        else:
+            log.info('Removed {0} unreferenced blob(s) from the blob store'.format(removed))
+
+    def _resolve_ids(self, conn, table, names, new_ids, columns=None, **defaults):
+        '''
+        Return the ids of ``names`` on ``table``, inserting the missing ones, in order, with the
+        ``defaults`` and, if any, their entry on the ``columns`` dictionary as the remaining
+        column values. Newly seen ids are collected on ``new_ids`` and only cached once the
+        transaction is committed.
+        '''
+        cache = self._ids[table]
+        ids = {}
+        missing = []
+        seen = set()
+        for name in names:
+            if name in seen:
+                continue
+            seen.add(name)
+            if name in cache:
+                ids[name] = cache[name]
+            else:
+                missing.append(name)
+        if not missing:
+            return ids
+
+        def _select(names):
+            for chunk in _chunks(names):
+                query = select([table.c.id, table.c.name], table.c.name.in_(chunk))
+                for row in conn.execute(query):
+                    ids[row[1]] = row[0]
+
+        _select(missing)
+        unknown = [name for name in missing if name not in ids]
+        if unknown:
+            rows = []
+            for name in unknown:
+                row = defaults.copy()
+                row.update((columns or {}).get(name, {}))
+                row['name'] = name
+                rows.append(row)
+            conn.execute(table.insert(), rows)
+            _select(unknown)
+        new_ids[table] = dict([(name, ids[name]) for name in missing])
+        return ids
+
+    def _count_outcomes(self, conn, results):
+        '''
+        Add the ingested results to their build's outcome counters.
+        '''
+        counts = {}
+        for _, _, build_id, outcome, _ in results:
+            build = counts.setdefault(build_id, dict.fromkeys(models.OUTCOMES, 0))
+            build[outcome] += 1
+        builds = models.builds
+        conn.execute(
+            builds.update().where(builds.c.id == bindparam('b_id')).values(dict([
+                (outcome, getattr(builds.c, outcome) + bindparam('b_' + outcome))
+                for outcome in models.OUTCOMES
+            ])),
+            [
+                dict([('b_id', build_id)] + [
+                    ('b_' + outcome, count) for outcome, count in outcomes.iteritems()
+                ])
+                for build_id, outcomes in counts.iteritems()
+            ]
+        )
+
+    def _discard_cancelled(self, conn, batch):
+        '''
+        Return a ``(kept, discarded)`` tuple, the records of ``batch`` which don't belong to a
+        cancelled job and those which do.
+        '''
+        table = models.cancelled_jobs
+        cancelled = set()
+        for chunk in _chunks(list(set([record.jid for record in batch]))):
+            query = select([table.c.jid], table.c.jid.in_(chunk))
+            cancelled.update([row[0] for row in conn.execute(query)])
+        if not cancelled:
+            return batch, []
+        kept = []
+        discarded = []
+        for record in batch:
+            if record.jid not in cancelled:
+                kept.append(record)
+                continue
+            log.info(
+                'Discarding the return of {0} for the cancelled job {1}'.format(
+                    record.minion, record.jid
+                )
+            )
+            discarded.append(record)
+        return kept, discarded
+
+    def write(self, batch):
+        '''
+        Write a batch of records in a single transaction. The returns of cancelled jobs are
+        discarded.
+        '''
+        new_ids = {}
+        conn = self.engine.connect()
+        try:
+            trans = conn.begin()
+            try:
+                batch, discarded = self._discard_cancelled(conn, batch)
+                if not batch:
+                    trans.commit()
+                    self._release(discarded, dropped=True)
+                    return
+                build_ids = self._resolve_ids(
+                    conn, models.builds, [record.build for record in batch], new_ids,
+                    columns=dict([
+                        (record.build, {'branch': record.branch}) for record in batch
+                    ]),
+                    created=datetime.utcnow()
+                )
+                minion_ids = self._resolve_ids(
+                    conn, models.minions, [record.minion for record in batch], new_ids
+                )
+                test_ids = self._resolve_ids(
+                    conn, models.tests,
+                    [test[0] for record in batch for test in record.tests], new_ids
+                )
+
+                conn.execute(models.jobs.insert(), [
+                    {
+                        'jid': record.jid,
+                        'build_id': build_ids[record.build],
+                        'minion_id': minion_ids[record.minion],
+                        'fun': record.fun,
+                        'success': int(bool(record.success)),
+                        'received': record.received
+                    } for record in batch
+                ])
+
+                # executemany() does not return the primary keys, select them back
+                job_ids = {}
+                jids = list(set([record.jid for record in batch]))
+                for chunk in _chunks(jids):
+                    query = select(
+                        [models.jobs.c.id, models.jobs.c.jid, models.jobs.c.minion_id],
+                        models.jobs.c.jid.in_(chunk)
+                    )
+                    for row in conn.execute(query):
+                        # The latest return wins if a minion returned more than once
+                        job_ids[(row[1], row[2])] = max(row[0], job_ids.get((row[1], row[2])))
+
+                rows = []
+                results = []
+                impacts = {}
+                for record in sorted(batch, key=lambda record: build_ids[record.build]):
+                    job_id = job_ids[(record.jid, minion_ids[record.minion])]
+                    build_id = build_ids[record.build]
+                    for name, outcome, duration, message in record.tests:
+                        results.append(
+                            (test_ids[name], record.branch, build_id, outcome, duration)
+                        )
+                        if outcome == 'passed' and name in record.files:
+                            # The latest passing run wins. Files without a blob id aren't
+                            # tracked by git, no diff ever changes them.
+                            impacts[(test_ids[name], record.branch)] = sorted(set([
+                                (path, record.sources[path]) for path in record.files[name]
+                                if record.sources.get(path)
+                            ]))
+                        rows.append({
+                            'job_id': job_id,
+                            'build_id': build_id,
+                            'test_id': test_ids[name],
+                            'outcome': outcome,
+                            'duration': duration,
+                            'message': blobs.inflate(message)
+                        })
+                for chunk in _chunks(rows, self.batch_size):
+                    conn.execute(models.test_results.insert(), chunk)
+                if results:
+                    stats.update(conn, results, self.stats_window)
+                    self._count_outcomes(conn, results)
+                if impacts:
+                    impact.update(conn, impacts)
+                trans.commit()
+            except Exception:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+
+        for table, ids in new_ids.iteritems():
+            self._ids[table].update(ids)
+        self._release(batch)
+        self._release(discarded, dropped=True)
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.scheduler
+    ~~~~~~~~~~~~~~~~
+
+    Distribute a test suite across the CI minions.
+
+    The suite is split into chunks, ``scheduler_chunks_per_minion`` per minion, balanced by the
+    tests' historical durations, their moving average on the build's branch, see
+    :mod:`saltci.results.stats`, using longest-processing-time-first bin packing. Tests without
+    history are assumed to take the median duration of those with.
+
+    The chunks are then, also longest first, queued to the minions, which run one chunk at a
+    time. A minion which drains it's queue steals the smallest queued chunk from the minion with
+    the most queued work left and, once nothing is left to steal, re-runs the chunk of a
+    straggler, a minion taking ``scheduler_straggler_factor`` times longer than estimated,
+    keeping whichever return arrives first. The other job is killed and recorded as cancelled,
+    so that the collector discards it's return if it still arrives, and so are the jobs which
+    time out. The wall-clock time of a run thus approaches the lower bound, the longest test or
+    the total duration divided by the number of minions, whichever is the largest.
+
+    Each chunk is run as a regular CI job, the function is called with the list of test names
+    and the ``build`` and ``branch`` keyword arguments, and it's return is expected in the format
+    described in :mod:`saltci.results.collector`, which stores it.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import time
+import heapq
+import logging
+from collections import deque
+from datetime import datetime
+
+# Import salt-ci libs
+from saltci.results import models, queries
+
+
+log = logging.getLogger(__name__)
+
+# The duration assumed for every test if none has history
+DEFAULT_DURATION = 1.0
+
+
+class SchedulerError(Exception):
+    '''
+    Raised when a test suite can't be scheduled.
+    '''
+
+
+def estimate_durations(tests, history=None):
+    '''
+    Return a dictionary mapping each test to it's estimated duration, ``history`` maps test
+    names to their known durations.
+    '''
+    history = history or {}
+    known = sorted([history[name] for name in tests if history.get(name) is not None])
+    if known:
+        default = known[len(known) // 2]
+    else:
+        default = DEFAULT_DURATION
+    return dict([(name, history.get(name) or default) for name in tests])
+
+
+def lpt(durations, bins):
+    '''
+    Pack the ``durations`` items into ``bins`` bins using longest-processing-time-first, each
+    item goes, longest first, to the least loaded bin.
+
+    :returns: A list of ``(load, items)`` tuples, items longest first.
+    '''
+    heap = [(0.0, idx) for idx in xrange(max(1, bins))]
+    packed = [[] for _ in heap]
+    loads = [0.0 for _ in heap]
+    for item in sorted(durations, key=lambda item: (-durations[item], item)):
+        load, idx = heapq.heappop(heap)
+        packed[idx].append(item)
+        loads[idx] = load + durations[item]
+        heapq.heappush(heap, (loads[idx], idx))
+    return [(loads[idx], packed[idx]) for idx in xrange(len(packed)) if packed[idx]]
+
+
+def lower_bound(durations, bins):
+    '''
+    The shortest possible wall-clock time to run ``durations`` on ``bins`` workers.
+    '''
+    if not durations:
+        return 0.0
+    return max(max(durations.itervalues()), sum(durations.itervalues()) / max(1, bins))
+
+
+def _queued(queue):
+    return sum([chunk.estimate for chunk in queue])
+
+
+class Chunk(object):
+    '''
+    A set of tests run as a single job.
+    '''
+
+    __slots__ = ('id', 'tests', 'estimate', 'done', 'jobs')
+
+    def __init__(self, id, tests, estimate):
+        self.id = id
+        self.tests = tests
+        self.estimate = estimate
+        self.done = False
+        # Maps the jid of each job running the chunk to it's ``(minion, started)``
+        self.jobs = {}
+
+
+def make_chunks(durations, minions, chunks_per_minion=4):
+    '''
+    Split the tests into balanced chunks and queue them, longest first, to the minions.
+
+    :returns: A dictionary mapping each minion to it's queue of :class:`Chunk` instances.
+    '''
+    chunks = [
+        Chunk(idx, tests, load) for idx, (load, tests) in enumerate(
+            lpt(durations, len(minions) * max(1, chunks_per_minion))
+        )
+    ]
+    assigned = lpt(dict([(chunk.id, chunk.estimate) for chunk in chunks]), len(minions))
+    queues = dict([(minion, deque()) for minion in minions])
+    for minion, (_, chunk_ids) in zip(sorted(minions), assigned):
+        queues[minion].extend([chunks[chunk_id] for chunk_id in chunk_ids])
+    return queues
+
+
+class ShardScheduler(object):
+    '''
+    Run the ``tests`` across the ``tgt`` minions calling ``fun``, see the module documentation.
+
+    :param opts: The ``salt-ci-master`` configuration.
+    :param client: The salt ``LocalClient`` to use, a new one by default.
+    :param event: The master event bus listener to use, a new one by default.
+    '''
+
+    def __init__(self, opts, tgt, fun, tests, build, branch='', expr_form='glob',
+                 chunks_per_minion=None, straggler_factor=None, timeout=None, client=None,
+                 event=None):
+        self.opts = opts
+        self.tgt = tgt
+        self.fun = fun
+        self.tests = list(tests)
+        self.build = build
+        self.branch = branch or ''
+        self.expr_form = expr_form
+        self.chunks_per_minion = chunks_per_minion or opts.get('scheduler_chunks_per_minion', 4)
+        self.straggler_factor = straggler_factor or opts.get('scheduler_straggler_factor', 1.5)
+        self.timeout = timeout or opts.get('scheduler_timeout', 3600)
+        self.client = client
+        self.event = event
+        self.steals = 0
+        self.speculations = 0
+
+    def _setup(self):
+        if self.client is None:
+            # Import salt libs
+            import salt.client
+            self.client = salt.client.LocalClient(mopts=self.opts)
+        if self.event is None:
+            # Import salt libs
+            import salt.utils.event
+            self.event = salt.utils.event.MasterEvent(self.opts['sock_dir'])
+
+    def history(self):
+        '''
+        Return the known durations of the tests.
+        '''
+        if not self.opts.get('SQLALCHEMY_DATABASE_URI'):
+            return {}
+        engine = models.get_engine(self.opts)
+        try:
+            return queries.test_durations(engine, self.tests, self.branch)
+        except Exception:
+            log.exception('Failed to load the tests durations, assuming they all take as long')
+            return {}
+        finally:
+            engine.dispose()
+
+    def minions(self):
+        '''
+        Return the targeted minions which are up.
+        '''
+        ret = self.client.cmd(
+            self.tgt, 'test.ping', timeout=self.opts.get('timeout', 5), expr_form=self.expr_form
+        )
+        return sorted([minion for minion, up in ret.iteritems() if up is True])
+
+    def _dispatch(self, minion, chunk, running):
+        jid = self.client.cmd_async(
+            [minion], self.fun,
+            [chunk.tests, 'build={0}'.format(self.build), 'branch={0}'.format(self.branch)],
+            expr_form='list'
+        )
+        if not jid:
+            log.error('Failed to publish chunk {0} to {1}'.format(chunk.id, minion))
+            return False
+        chunk.jobs[jid] = (minion, time.time())
+        running[jid] = chunk
+        return True
+
+    def _next_chunk(self, minion, queues, running):
+        '''
+        Return the chunk ``minion`` should run next: it's own, one stolen from the minion with
+        the most queued work or a straggler's, in this order. ``None`` if there's none.
+        '''
+        if queues[minion]:
+            return queues[minion].popleft()
+
+        victim = max(queues, key=lambda other: _queued(queues[other]))
+        if queues[victim]:
+            self.steals += 1
+            log.debug('{0} stole a chunk from {1}'.format(minion, victim))
+            return queues[victim].pop()
+
+        now = time.time()
+        stragglers = []
+        for chunk in set(running.itervalues()):
+            if chunk.done or len(chunk.jobs) > 1:
+                continue
+            started = min([started for (_, started) in chunk.jobs.itervalues()])
+            overdue = now - started - chunk.estimate * self.straggler_factor
+            if overdue > 0:
+                stragglers.append((overdue, chunk))
+        if stragglers:
+            self.speculations += 1
+            return max(stragglers, key=lambda straggler: straggler[0])[1]
+        return None
+
+    def run(self):
+        '''
+        Run the test suite and return a report of the run.
+        '''
+        if not self.tests:
+            raise SchedulerError('There are no tests to run')
+        self._setup()
+        minions = self.minions()
+        if not minions:
+            raise SchedulerError('No minions matched {0!r}'.format(self.tgt))
+
+        durations = estimate_durations(self.tests, self.history())
+        queues = make_chunks(durations, minions, self.chunks_per_minion)
+        chunks = [chunk for queue in queues.itervalues() for chunk in queue]
+        log.info(
+            'Running {0} tests, in {1} chunks, on {2} minions, estimated {3:.1f}s'.format(
+                len(self.tests), len(chunks), len(minions), lower_bound(durations, len(minions))
+            )
+        )
+
+        started = time.time()
+        # Maps the jids being run to their chunk
+        running = {}
+        idle = set(minions)
+        elapsed = dict([(minion, 0.0) for minion in minions])
+        while not all([chunk.done for chunk in chunks]):
+            for minion in sorted(idle):
+                chunk = self._next_chunk(minion, queues, running)
+                if chunk is None:
+                    continue
+                if self._dispatch(minion, chunk, running):
+                    idle.discard(minion)
+                    continue
+                # The minion can't be reached, leave it out
+                self._drop(minion, queues, idle)
+                if not queues:
+                    log.error('{0} can\'t be reached and no other minion is left'.format(minion))
+                    raise SchedulerError(
+                        'No minion is left to run the tests, the last one, {0}, can\'t be '
+                        'reached'.format(minion)
+                    )
+                if not chunk.jobs:
+                    self._requeue(chunk, queues)
+
+            ret = self.event.get_event(wait=1, full=True)
+            data = (ret or {}).get('data') or {}
+            jid = str(data.get('jid', ''))
+            if jid in running and 'return' in data:
+                chunk = running.pop(jid)
+                minion, job_started = chunk.jobs.pop(jid)
+                elapsed[minion] += time.time() - job_started
+                if minion in queues:
+                    idle.add(minion)
+                if not chunk.done:
+                    chunk.done = True
+                    self._cancel(chunk, running, idle, queues)
+
+            self._expire(running, idle, queues)
+            if not queues:
+                raise SchedulerError('Every minion timed out')
+
+        wall_clock = time.time() - started
+        return {
+            'build': self.build,
+            'branch': self.branch,
+            'tests': len(self.tests),
+            'chunks': len(chunks),
+            'minions': elapsed,
+            'steals': self.steals,
+            'speculations': self.speculations,
+            'lower_bound': lower_bound(durations, len(minions)),
+            'wall_clock': wall_clock
+        }
+
+    def _requeue(self, chunk, queues):
+        if queues:
+            queues[min(queues, key=lambda other: _queued(queues[other]))].appendleft(chunk)
+
+    def _drop(self, minion, queues, idle):
+        '''
+        Leave ``minion`` out of the run, it's queued chunks are handed to the other minions.
+        '''
+        idle.discard(minion)
+        for chunk in queues.pop(minion, ()):
+            self._requeue(chunk, queues)
+
+    def _record_cancelled(self, jids):
+        '''
+        Record the cancelled jobs, the collector discards their returns.
+        '''
+        if not jids or not self.opts.get('SQLALCHEMY_DATABASE_URI'):
+            return
+        engine = models.get_engine(self.opts)
+        try:
+            engine.execute(
+                models.cancelled_jobs.insert(),
+                [{'jid': jid, 'cancelled': datetime.utcnow()} for jid in jids]
+            )
+        except Exception:
+            log.exception(
+                'Failed to record the cancelled jobs {0}, their returns will be stored'.format(
+                    ', '.join(jids)
+                )
+            )
+        finally:
+            engine.dispose()
+
+    def _cancel(self, chunk, running, idle, queues):
+        '''
+        Kill the remaining, speculative, jobs of a finished chunk.
+        '''
+        # Recorded before they're killed, they may return meanwhile
+        self._record_cancelled(chunk.jobs.keys())
+        for jid, (minion, _) in chunk.jobs.items():
+            self.client.cmd_async(minion, 'saltutil.kill_job', [jid])
+            running.pop(jid, None)
+            if minion in queues:
+                idle.add(minion)
+        chunk.jobs.clear()
+
+    def _expire(self, running, idle, queues):
+        '''
+        Give up on the jobs running for longer than the timeout, they're killed and recorded as
+        cancelled, the minion is left out of the run and the chunk is queued again.
+        '''
+        now = time.time()
+        for jid, chunk in running.items():
+            minion, started = chunk.jobs[jid]
+            if now - started < self.timeout:
+                continue
+            log.error(
+                '{0} timed out running chunk {1}, leaving it out of the run'.format(
+                    minion, chunk.id
+                )
+            )
+            # Recorded before it's killed, it may return meanwhile
+            self._record_cancelled([jid])
+            self.client.cmd_async(minion, 'saltutil.kill_job', [jid])
+            running.pop(jid)
+            chunk.jobs.pop(jid)
+            self._drop(minion, queues, idle)
+            if not chunk.jobs:
+                self._requeue(chunk, queues)
@@ -10,6 +10,9 @@
     :license: Apache 2.0, see LICENSE for more details.
 '''
 
+# Import python libs
+import sys
+
 
 def run_salt_ci_master():
     from saltci.cli_adapt import SaltCIMaster
@@ -29,6 +32,12 @@ def run_salt_ci():
     saltcicmd.run()
 
 
+def run_salt_ci_shard():
+    from saltci.cli_adapt import SaltCIShard
+    saltcishard = SaltCIShard()
+    saltcishard.run()
+
+
 def run_salt_ci_notif():
     from saltci.notif.cli import SaltCINotif
     saltcinotif = SaltCINotif()
@@ -36,6 +45,19 @@ def run_salt_ci_notif():
 
 
 def run_salt_ci_notif_call():
+    # Forward the call to the running salt-ci-notif daemon, if any, which avoids loading salt,
+    # the configuration and the execution modules.
+    from saltci.notif import ipc
+    retcode = ipc.run_client(sys.argv[1:])
+    if retcode is not None:
+        sys.exit(retcode)
+
     from saltci.notif.cli import SaltCINotifCall
     saltcinotifcall = SaltCINotifCall()
     saltcinotifcall.run()
+
+
+def run_salt_ci_web():
+    from saltci.web.cli import SaltCIWeb
+    saltciweb = SaltCIWeb()
+    saltciweb.run()
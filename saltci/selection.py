@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.selection
+    ~~~~~~~~~~~~~~~~
+
+    Select the tests impacted by a change.
+
+    Passing test results may report the source files each test exercised, and their git blob
+    ids, see :mod:`saltci.results.collector`, which are kept, per branch, on the ``test_impact``
+    map. Since blob ids are content hashes, the map knows exactly which contents each test
+    passed against.
+
+    Given a git diff, the impacted tests are those which exercised the changed files, plus every
+    test the map knows nothing about. The full suite is selected instead if the map is stale,
+    which is when any changed file is unknown to the map, unless it matches one of the
+    ``selection_ignore`` patterns, or it's contents at the diff's base differ from those the
+    tests passed against.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import fnmatch
+import logging
+import subprocess
+
+# Import 3rd-party libs
+from sqlalchemy import and_, select
+
+# Import salt-ci libs
+from saltci.results import models
+
+
+log = logging.getLogger(__name__)
+
+
+class SelectionError(Exception):
+    '''
+    Raised when the changes can't be determined.
+    '''
+
+
+class Selection(object):
+    '''
+    The selected tests.
+
+    :param tests: The selected tests, in the suite's order.
+    :param full: Whether it's the full suite.
+    :param reason: Why the full suite was selected.
+    '''
+
+    __slots__ = ('tests', 'full', 'reason')
+
+    def __init__(self, tests, full=False, reason=None):
+        self.tests = tests
+        self.full = full
+        self.reason = reason
+
+
+def _git(repo, *args):
+    try:
+        proc = subprocess.Popen(
+            ('git',) + args, cwd=repo, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except OSError, err:
+        raise SelectionError('Failed to run git: {0}'.format(err))
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise SelectionError(
+            'git {0} failed: {1}'.format(' '.join(args), err.strip() or proc.returncode)
+        )
+    return out
+
+
+def changed_files(repo, base, head='HEAD'):
+    '''
+    Return the paths, at ``base``, of the files changed between ``base`` and ``head``. Added
+    files are included too, they're unknown to the map at ``base``.
+    '''
+    out = _git(repo, 'diff', '--name-status', '-z', '-M', base, head, '--')
+    fields = out.split('\0')
+    changed = set()
+    idx = 0
+    while idx < len(fields) and fields[idx]:
+        status = fields[idx]
+        if status[0] in ('R', 'C'):
+            # Renames and copies are followed by the old and the new paths
+            changed.update(fields[idx + 1:idx + 3])
+            idx += 3
+        else:
+            changed.add(fields[idx + 1])
+            idx += 2
+    return sorted(changed)
+
+
+def blob_ids(repo, rev, paths):
+    '''
+    Return a dictionary mapping the ``paths`` which exist at ``rev`` to their git blob id.
+    '''
+    blobs = {}
+    paths = list(paths)
+    # Keep the command line short
+    for idx in xrange(0, len(paths), models.IN_CLAUSE_SIZE):
+        out = _git(repo, 'ls-tree', '-z', rev, '--', *paths[idx:idx + models.IN_CLAUSE_SIZE])
+        for entry in out.split('\0'):
+            if not entry:
+                continue
+            info, path = entry.split('\t', 1)
+            blobs[path] = info.split()[2]
+    return blobs
+
+
+def select_tests(conn, tests, changed, base_blobs, branch='', ignore=()):
+    '''
+    Select which of the suite's ``tests`` are impacted by the ``changed`` files.
+
+    :param changed: The changed file paths.
+    :param base_blobs: A dictionary mapping the changed files which existed at the diff's base
+                       to their git blob id.
+    :param ignore: ``fnmatch`` patterns of the files which impact no test.
+    :returns: A :class:`Selection`.
+    '''
+    table = models.test_impact
+    changed = [
+        path for path in changed
+        if not any([fnmatch.fnmatch(path, pattern) for pattern in ignore])
+    ]
+
+    impacted = set()
+    known = set()
+    for idx in xrange(0, len(changed), models.IN_CLAUSE_SIZE):
+        query = select(
+            [table.c.path, table.c.blob, models.tests.c.name],
+            and_(
+                table.c.branch == (branch or ''),
+                table.c.path.in_(changed[idx:idx + models.IN_CLAUSE_SIZE])
+            ),
+            from_obj=[table.join(models.tests, models.tests.c.id == table.c.test_id)]
+        )
+        for path, blob, name in conn.execute(query):
+            if not blob:
+                # Stored before files without a blob id were left out of the map
+                continue
+            if blob != base_blobs.get(path):
+                return Selection(
+                    list(tests), True,
+                    'The tests exercising {0} last passed against other contents'.format(path)
+                )
+            known.add(path)
+            impacted.add(name)
+
+    unknown = sorted(set(changed) - known)
+    if unknown:
+        return Selection(
+            list(tests), True, 'No passing test exercised {0}'.format(', '.join(unknown[:5]))
+        )
+
+    # The tests which never passed reporting the files they exercised always run
+    mapped = set()
+    stats = models.test_stats
+    names = list(tests)
+    for idx in xrange(0, len(names), models.IN_CLAUSE_SIZE):
+        query = select(
+            [models.tests.c.name],
+            and_(
+                models.tests.c.name.in_(names[idx:idx + models.IN_CLAUSE_SIZE]),
+                stats.c.branch == (branch or ''),
+                stats.c.impact_digest != None
+            ),
+            from_obj=[models.tests.join(stats, stats.c.test_id == models.tests.c.id)]
+        )
+        mapped.update([row[0] for row in conn.execute(query)])
+
+    return Selection(
+        [name for name in tests if name in impacted or name not in mapped]
+    )
+
+
+def select_changed(conn, tests, repo, base, head='HEAD', branch='', ignore=()):
+    '''
+    Select which of the suite's ``tests`` are impacted by the changes between the ``base`` and
+    ``head`` revisions of the ``repo`` git repository.
+    '''
+    changed = changed_files(repo, base, head)
+    selection = select_tests(
+        conn, tests, changed, blob_ids(repo, base, changed), branch, ignore
+    )
+    if selection.full:
+        log.info('Selecting the full test suite: {0}'.format(selection.reason))
+    else:
+        log.info(
+            '{0} changed files impact {1} of {2} tests'.format(
+                len(changed), len(selection.tests), len(tests)
+            )
+        )
+    return selection
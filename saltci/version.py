@@ -11,9 +11,12 @@
 '''
 
 # Import python libs
+import os
 import sys
 
 
+# The base version. The full version, which includes the git information on development
+# checkouts, is returned by ``get_version()``
 __version_info__ = (0, 4, 0)
 __version__ = '.'.join(map(str, __version_info__))
 
@@ -22,22 +25,94 @@ GIT_DESCRIBE_REGEX = (
     r'(?:(?:.*)-(?P<noc>[\d]+)-(?P<sha>[a-z0-9]{8}))?'
 )
 
+# The file, inside the git directory, where the discovered version is cached
+GIT_VERSION_CACHE = 'salt-ci-version'
 
-def __get_version(version, version_info):
+_VERSION = None
+
+
+def get_version():
+    '''
+    Return the ``(version, version_info)`` tuple, discovering it the first time it's called.
+    '''
+    global _VERSION
+    if _VERSION is None:
+        _VERSION = _discover_version(__version__, __version_info__)
+    return _VERSION
+
+
+def _git_state(git_dir):
+    '''
+    Return a cheap fingerprint of the checkout's ``HEAD`` and tags, which is what
+    ``git describe`` depends on, without running git.
+    '''
+    with open(os.path.join(git_dir, 'HEAD')) as rfh:
+        state = [rfh.read().strip()]
+    if state[0].startswith('ref: '):
+        ref = os.path.join(git_dir, state[0][5:])
+        if os.path.isfile(ref):
+            with open(ref) as rfh:
+                state.append(rfh.read().strip())
+    for name in ('packed-refs', os.path.join('refs', 'tags')):
+        try:
+            state.append(os.stat(os.path.join(git_dir, name)).st_mtime)
+        except OSError:
+            state.append(None)
+    return repr(state)
+
+
+def _discover_version(version, version_info):
     '''
     If we can get a version provided at installation time or from Git, use
     that instead, otherwise we carry on.
     '''
     try:
         # Try to import the version information provided at install time
-        from salt._version import __version__, __version_info__
+        from saltci._version import __version__, __version_info__
         return __version__, __version_info__
     except ImportError:
         pass
 
     # This might be a 'python setup.py develop' installation type. Let's
     # discover the version information at runtime.
-    import os
+    git_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.git')
+    if not os.path.isdir(git_dir):
+        # Not a git checkout, don't even try
+        return version, version_info
+
+    cache = os.path.join(git_dir, GIT_VERSION_CACHE)
+    try:
+        state = _git_state(git_dir)
+    except (IOError, OSError):
+        state = None
+    if state is not None and os.path.isfile(cache):
+        try:
+            with open(cache) as rfh:
+                cached_state, cached_version, cached_version_info = rfh.read().split('\n')[:3]
+            if cached_state == state:
+                return cached_version, tuple(
+                    [int(part) for part in cached_version_info.split('.')]
+                )
+        except (IOError, ValueError):
+            pass
+
+    discovered = _git_describe(version, version_info)
+    if state is not None:
+        try:
+            with open(cache, 'w') as wfh:
+                wfh.write('{0}\n{1}\n{2}\n'.format(
+                    state, discovered[0], '.'.join(map(str, discovered[1]))
+                ))
+        except IOError:
+            # Read-only checkout, we'll ask git again next time
+            pass
+    return discovered
+
+
+def _git_describe(version, version_info):
+    '''
+    Discover the version information by running ``git describe``.
+    '''
     import re
     import warnings
     import subprocess
@@ -95,12 +170,6 @@ def __get_version(version, version_info):
     return version, version_info
 
 
-# Get additional version information if available
-__version__, __version_info__ = __get_version(__version__, __version_info__)
-# This function has executed once, we're done with it. Delete it!
-del __get_version
-
-
 def versions_report():
     '''
     Report on all of the versions for dependant software
@@ -120,7 +189,7 @@ def versions_report():
 
     fmt = '{0:>{pad}}: {1}'
 
-    yield fmt.format('Salt-CI', __version__, pad=padding)
+    yield fmt.format('Salt-CI', get_version()[0], pad=padding)
 
     yield fmt.format(
         'Python', sys.version.rsplit('\n')[0].strip(), pad=padding
@@ -138,4 +207,4 @@ def versions_report():
 
 
 if __name__ == '__main__':
-    print(__version__)
+    print(get_version()[0])
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.web.application
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    The Salt-CI web dashboard application.
+
+    Every view reports from the precomputed aggregates, see :mod:`saltci.results.queries`, and
+    is cached, see :mod:`saltci.web.cache`, until new results are ingested. Live build status is
+    pushed to the ``/api/events`` clients, see :mod:`saltci.web.events`.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import 3rd-party libs
+from flask import Flask, Response, abort, jsonify, render_template, request, stream_with_context
+from flask.ext.sass import Sass
+from flask.ext.sqlalchemy import SQLAlchemy
+
+# Import salt-ci libs
+from saltci.results import blobs, models, queries
+from saltci.results.writer import ingest_stamp_path
+from saltci.web.cache import ViewCache
+from saltci.web.events import EventHub, format_event
+
+
+def setup_sass(app):
+    '''
+    Compile the application's Sass stylesheets once, at startup, instead of checking them
+    before every request, as Flask-Sass does, in debug mode, or before the first one.
+    '''
+    sass = Sass(app)
+    if sass.find_searcheable_paths in app.before_request_funcs.get(None, ()):
+        app.before_request_funcs[None].remove(sass.find_searcheable_paths)
+    if sass.find_searcheable_paths in app.before_first_request_funcs:
+        app.before_first_request_funcs.remove(sass.find_searcheable_paths)
+
+    static_folders = [app.static_folder] + [
+        blueprint.static_folder for blueprint in app.blueprints.itervalues()
+    ]
+    for static_folder in static_folders:
+        if not static_folder:
+            continue
+        for sass_file, css_file in sass.find_sass_files(static_folder):
+            sass.generate_css_from_sass(css_file, sass_file)
+    return sass
+
+
+def _page_args():
+    try:
+        limit = int(request.args.get('limit', queries.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    return request.args.get('branch', ''), limit, request.args.get('after')
+
+
+def create_app(opts):
+    '''
+    Create the dashboard application from the ``salt-ci-master`` configuration.
+    '''
+    app = Flask(__name__)
+    app.config.update(
+        (key, value) for (key, value) in opts.iteritems() if key.startswith('SQLALCHEMY_')
+    )
+    if opts.get('SASS_BIN_PATH'):
+        app.config['SASS_BIN_PATH'] = opts['SASS_BIN_PATH']
+
+    db = SQLAlchemy(app)
+    # Create any missing tables, the dashboard might start before the master
+    models.metadata.create_all(db.engine)
+
+    cache = ViewCache(
+        ingest_stamp_path(opts),
+        default_ttl=opts.get('web_cache_ttl', 5),
+        max_entries=opts.get('web_cache_entries', 1024)
+    )
+    app.view_cache = cache
+    app.sass = setup_sass(app)
+    # Only starts listening to the master's events once the first client connects
+    hub = app.event_hub = EventHub(
+        opts['sock_dir'],
+        buffer_size=opts.get('web_events_buffer', 1000),
+        client_buffer_size=opts.get('web_events_client_buffer', 100)
+    )
+    keepalive = opts.get('web_events_keepalive', 15)
+    store = blobs.BlobStore(blobs.blob_dir(opts))
+
+    @app.route('/')
+    @cache.cached()
+    def index():
+        branch = request.args.get('branch') or None
+        return render_template(
+            'index.html', branch=branch, builds=queries.latest_builds(db.engine, branch)
+        )
+
+    @app.route('/flaky')
+    @cache.cached()
+    def flaky():
+        branch, limit, after = _page_args()
+        try:
+            page = queries.flaky_tests(db.engine, branch, limit, after)
+        except queries.InvalidCursor:
+            abort(400)
+        return render_template('flaky.html', branch=branch, page=page)
+
+    @app.route('/slowest')
+    @cache.cached()
+    def slowest():
+        branch, limit, after = _page_args()
+        try:
+            page = queries.slowest_tests(db.engine, branch, limit, after)
+        except queries.InvalidCursor:
+            abort(400)
+        return render_template('slowest.html', branch=branch, page=page)
+
+    @app.route('/tests/<int:test_id>')
+    @cache.cached()
+    def test_history(test_id):
+        test = db.engine.execute(
+            models.tests.select(models.tests.c.id == test_id)
+        ).first()
+        if test is None:
+            abort(404)
+        try:
+            page = queries.test_history(db.engine, test_id, before=request.args.get('before'))
+        except queries.InvalidCursor:
+            abort(400)
+        for result in page['results']:
+            # Large messages are spilled to the blob store, they're linked to instead
+            result['blob'] = blobs.parse_reference(result['message'])
+        return render_template('test.html', test=test, page=page)
+
+    @app.route('/blobs/<digest>')
+    def blob(digest):
+        data = store.get(digest)
+        if data is None:
+            abort(404)
+        response = Response(data, mimetype='text/plain')
+        # Blobs are content addressed, they never change
+        response.set_etag(digest)
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        return response.make_conditional(request)
+
+    @app.route('/api/status')
+    @cache.cached()
+    def status():
+        builds = queries.latest_builds(
+            db.engine, request.args.get('branch'), request.args.get('limit', 1, type=int)
+        )
+        for build in builds:
+            build['created'] = build['created'].isoformat()
+        return jsonify(builds=builds)
+
+    @app.route('/api/events')
+    def events():
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            abort(400)
+        subscription = hub.subscribe(last_event_id)
+
+        def stream():
+            try:
+                yield 'retry: 3000\n\n'
+                while True:
+                    events = subscription.get(keepalive)
+                    if not events:
+                        # Keeps proxies from closing an idle connection
+                        yield ': keepalive\n\n'
+                        continue
+                    yield ''.join([format_event(event) for event in events])
+            finally:
+                subscription.close()
+
+        response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+        response.cache_control.no_cache = True
+        # Don't let nginx buffer the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    return app
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.web.cache
+    ~~~~~~~~~~~~~~~~
+
+    Server-side caching of the dashboard's responses.
+
+    The dashboard only changes when new results are ingested, which the results writer signals
+    by touching the ingest stamp file, see :func:`saltci.results.writer.ingest_stamp_path`. Each
+    cached response is tagged with the stamp's modification time, the cache's generation, and
+    served until it's TTL expires or the generation changes, whichever comes first. A generation
+    change drops every cached response at once.
+
+    Responses carry an ``ETag``, the hash of their body, and a ``Last-Modified`` header, the
+    generation. Monitors polling the dashboard revalidate on every request, ``Cache-Control:
+    no-cache``, and, as long as nothing was ingested, get a ``304 Not Modified`` which costs a
+    ``stat()`` and a dictionary lookup, no queries and no template rendering.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import os
+import time
+import hashlib
+import threading
+from functools import wraps
+
+# Import 3rd-party libs
+from flask import current_app, make_response, request
+
+# Import salt-ci libs
+from saltci.lru import LRUCache
+
+
+class CachedResponse(object):
+
+    __slots__ = ('body', 'mimetype', 'etag', 'generation', 'expires')
+
+    def __init__(self, body, mimetype, generation, expires):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.generation = generation
+        self.expires = expires
+
+
+class ViewCache(object):
+    '''
+    A thread-safe LRU cache of rendered responses, keyed by their URL.
+
+    :param stamp_path: The ingest stamp file path.
+    :param default_ttl: How many seconds responses are cached for, unless the view says
+                        otherwise.
+    :param max_entries: How many responses are kept.
+    '''
+
+    def __init__(self, stamp_path, default_ttl=5, max_entries=1024):
+        self.stamp_path = stamp_path
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._entries = LRUCache(max_entries)
+        self._lock = threading.Lock()
+        self._generation = None
+        # Used as the generation until something gets ingested
+        self._started = int(time.time())
+
+    def generation(self):
+        '''
+        Return the current generation, dropping every cached response if it changed.
+        '''
+        try:
+            generation = os.stat(self.stamp_path).st_mtime
+        except OSError:
+            generation = self._started
+        if generation != self._generation:
+            with self._lock:
+                if generation != self._generation:
+                    self._entries.clear()
+                    self._generation = generation
+        return generation
+
+    def invalidate(self, key=None):
+        '''
+        Drop the cached response for ``key``, or every cached response if ``key`` is ``None``.
+        '''
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key)
+
+    def get(self, key, generation):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.generation != generation or entry.expires <= time.time():
+            self._entries.pop(key)
+            return None
+        return entry
+
+    def set(self, key, entry):
+        self._entries.set(key, entry)
+
+    def _respond(self, entry):
+        response = current_app.response_class(entry.body, mimetype=entry.mimetype)
+        response.set_etag(entry.etag)
+        response.last_modified = entry.generation
+        response.cache_control.no_cache = True
+        # Turns the response into a 304 if the client's copy is still current
+        return response.make_conditional(request)
+
+    def cached(self, ttl=None):
+        '''
+        Decorate a view to cache it's successful responses for ``ttl`` seconds.
+        '''
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return view(*args, **kwargs)
+                key = request.full_path
+                generation = self.generation()
+                entry = self.get(key, generation)
+                if entry is not None:
+                    self.hits += 1
+                    return self._respond(entry)
+
+                self.misses += 1
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = CachedResponse(
+                    response.data, response.mimetype, generation,
+                    time.time() + (self.default_ttl if ttl is None else ttl)
+                )
+                self.set(key, entry)
+                return self._respond(entry)
+            return wrapper
+        return decorator
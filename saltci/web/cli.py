@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.web.cli
+    ~~~~~~~~~~~~~~
+
+    Salt-CI web dashboard.
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import logging
+
+# Import salt libs
+from salt.utils import parsers
+
+# Import salt-ci libs
+from saltci import config
+
+
+log = logging.getLogger(__name__)
+
+
+class SaltCIWeb(parsers.OptionParser, parsers.ConfigDirMixIn, parsers.LogLevelMixIn):
+
+    __metaclass__ = parsers.OptionParserMeta
+
+    description = 'The Salt-CI web dashboard.'
+    usage = '%prog [options]'
+
+    # ConfigDirMixIn configuration filename attribute
+    _config_filename_ = 'salt-ci-master'
+
+    # LogLevelMixIn attributes
+    _default_logging_logfile_ = '/var/log/salt/salt-ci-web'
+
+    def _mixin_setup(self):
+        self.add_option(
+            '--host',
+            default=None,
+            help='The address to listen on. Default: the web_host setting.'
+        )
+        self.add_option(
+            '--port',
+            default=None,
+            type=int,
+            help='The port to listen on. Default: the web_port setting.'
+        )
+        self.add_option(
+            '--debug',
+            default=False,
+            action='store_true',
+            help='Run the application in debug mode.'
+        )
+
+    def setup_config(self):
+        return config.saltci_master_config(self.get_config_file_path())
+
+    def run(self):
+        self.parse_args()
+        if not self.config.get('SQLALCHEMY_DATABASE_URI'):
+            self.error('The SQLALCHEMY_DATABASE_URI setting is required')
+
+        from saltci.web.application import create_app
+        app = create_app(self.config)
+        host = self.options.host or self.config['web_host']
+        port = self.options.port or self.config['web_port']
+        log.info('Serving the Salt-CI dashboard on {0}:{1}'.format(host, port))
+        app.run(host=host, port=port, debug=self.options.debug, threaded=True)
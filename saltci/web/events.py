@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+'''
+    saltci.web.events
+    ~~~~~~~~~~~~~~~~~
+
+    Live build status, pushed to the dashboard's clients as `server-sent events`_.
+
+    A single background thread, per dashboard process, listens to the ``salt-ci-master`` event
+    bus, no matter how many clients are connected, and fans out the following events:
+
+    ``job-start``
+        A job was published, ``{"jid", "fun", "minions"}``.
+    ``job-return``
+        A minion returned, ``{"jid", "minion", "fun", "success"}`` plus, for CI jobs, the
+        ``build``, ``branch`` and the number of ``tests`` by outcome.
+    ``build-complete``
+        Every targeted minion returned a CI job, ``{"jid", "build", "branch", "success",
+        "minions", "tests"}``.
+
+    Every event gets an increasing id and the latest ``web_events_buffer`` are kept, so that
+    reconnecting clients, which send the last id they've seen as the ``Last-Event-ID`` header,
+    get whatever they missed replayed. Each client has it's own ring buffer, of up to
+    ``web_events_client_buffer`` events, so a slow client only ever drops it's own oldest events
+    and never holds back the others.
+
+    .. _`server-sent events`: http://www.w3.org/TR/eventsource/
+
+    :codeauthor: :email:`Pedro Algarvio (pedro@algarvio.me)`
+    :copyright: © 2013 by the SaltStack Team, see AUTHORS for more details.
+    :license: Apache 2.0, see LICENSE for more details.
+'''
+
+# Import python libs
+import json
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+
+# Import salt-ci libs
+from saltci.results import collector
+
+
+log = logging.getLogger(__name__)
+
+# How many published jobs are tracked while waiting for their minions to return
+MAX_PENDING_JOBS = 1000
+# How long, in seconds, a published job is tracked
+PENDING_JOB_TTL = 3600
+
+
+def format_event(event):
+    '''
+    Format an ``(id, name, data)`` event on the ``text/event-stream`` format.
+    '''
+    return 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(
+        event[0], event[1], json.dumps(event[2], separators=(',', ':'))
+    )
+
+
+def _event_jid(tag, data):
+    if data.get('jid'):
+        return str(data['jid'])
+    if tag.startswith('salt/job/'):
+        return tag.split('/')[2]
+    return tag
+
+
+class Subscription(object):
+    '''
+    A client's ring buffer of events, see :meth:`EventHub.subscribe`.
+    '''
+
+    def __init__(self, hub, size):
+        self.hub = hub
+        self.events = deque(maxlen=size)
+        self.dropped = 0
+
+    def _push(self, event):
+        # Called with the hub's lock held
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+
+    def get(self, timeout=None):
+        '''
+        Wait up to ``timeout`` seconds for events and return every buffered one, an empty list
+        if none arrived.
+        '''
+        with self.hub.condition:
+            if not self.events:
+                self.hub.condition.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+        return events
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class EventHub(object):
+    '''
+    Listen to the master's event bus, on a background thread, and fan out the build status
+    events to every subscription.
+
+    :param sock_dir: The ``salt-ci-master`` ``sock_dir``.
+    :param buffer_size: How many of the latest events are kept for replaying.
+    :param client_buffer_size: How many events each subscription buffers.
+    '''
+
+    def __init__(self, sock_dir, buffer_size=1000, client_buffer_size=100):
+        self.sock_dir = sock_dir
+        self.client_buffer_size = client_buffer_size
+        self.condition = threading.Condition()
+        self._history = deque(maxlen=buffer_size)
+        self._subscriptions = set()
+        self._jobs = OrderedDict()
+        self._last_id = 0
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        '''
+        Start listening to the event bus, unless already listening.
+        '''
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    thread = threading.Thread(target=self._run, name='SaltCIEventHub')
+                    thread.daemon = True
+                    thread.start()
+                    self._thread = thread
+
+    def subscribe(self, last_event_id=None):
+        '''
+        Return a new :class:`Subscription`, with the events after ``last_event_id``, if any,
+        already buffered.
+        '''
+        self.start()
+        subscription = Subscription(self, self.client_buffer_size)
+        with self.condition:
+            if last_event_id is not None:
+                if last_event_id > self._last_id:
+                    # The id is from before the dashboard restarted, replay everything
+                    last_event_id = 0
+                for event in self._history:
+                    if event[0] > last_event_id:
+                        subscription._push(event)
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.condition:
+            self._subscriptions.discard(subscription)
+
+    @property
+    def subscribers(self):
+        return len(self._subscriptions)
+
+    def publish(self, name, data):
+        with self.condition:
+            self._last_id += 1
+            event = (self._last_id, name, data)
+            self._history.append(event)
+            for subscription in self._subscriptions:
+                subscription._push(event)
+            self.condition.notify_all()
+
+    def _run(self):
+        # Import salt libs
+        import salt.utils.event
+
+        event = salt.utils.event.MasterEvent(self.sock_dir)
+        log.info('Listening to the master events on {0}'.format(self.sock_dir))
+        while True:
+            try:
+                ret = event.get_event(wait=1, full=True)
+                if ret is not None:
+                    self.handle(ret.get('tag', ''), ret.get('data'))
+            except Exception:
+                log.exception('Failed to handle a master event')
+
+    def _expire_jobs(self):
+        expires = time.time() - PENDING_JOB_TTL
+        while self._jobs:
+            jid, job = next(self._jobs.iteritems())
+            if job['published'] > expires and len(self._jobs) <= MAX_PENDING_JOBS:
+                break
+            self._jobs.pop(jid)
+
+    def handle(self, tag, data):
+        '''
+        Translate a master event into the build status events.
+        '''
+        if not isinstance(data, dict):
+            return
+        jid = _event_jid(tag, data)
+
+        if 'return' in data and 'id' in data:
+            ret = {
+                'jid': jid,
+                'minion': data['id'],
+                'fun': data.get('fun', ''),
+                'success': data.get('success', True)
+            }
+            record = collector.parse_return(dict(data, jid=jid))
+            if record is not None:
+                tests = {}
+                for _, outcome, _, _ in record.tests:
+                    tests[outcome] = tests.get(outcome, 0) + 1
+                ret.update(build=record.build, branch=record.branch, tests=tests)
+            self.publish('job-return', ret)
+            self._job_returned(jid, ret)
+
+        elif isinstance(data.get('minions'), list):
+            self._expire_jobs()
+            self._jobs[jid] = {
+                'published': time.time(),
+                'minions': set(data['minions']),
+                'returns': []
+            }
+            self.publish('job-start', {
+                'jid': jid, 'fun': data.get('fun', ''), 'minions': data['minions']
+            })
+
+    def _job_returned(self, jid, ret):
+        job = self._jobs.get(jid)
+        if job is None:
+            return
+        job['minions'].discard(ret['minion'])
+        job['returns'].append(ret)
+        if job['minions']:
+            return
+        self._jobs.pop(jid)
+
+        returns = [ret for ret in job['returns'] if 'build' in ret]
+        if not returns:
+            # Not a CI job
+            return
+        tests = {}
+        for ret in returns:
+            for outcome, count in ret['tests'].iteritems():
+                tests[outcome] = tests.get(outcome, 0) + count
+        self.publish('build-complete', {
+            'jid': jid,
+            'build': returns[0]['build'],
+            'branch': returns[0]['branch'],
+            'success': all(
+                ret['success'] and not ret['tests'].get('failed') and
+                not ret['tests'].get('error') for ret in returns
+            ),
+            'minions': [ret['minion'] for ret in job['returns']],
+            'tests': tests
+        })
@@ -47,6 +47,18 @@ class CustomBuild(build.build):
 
     def run(self):
         build.build.run(self)
+        # Write the version information, installations don't have to discover it at runtime
+        version_file = os.path.join(self.build_lib, 'saltci', '_version.py')
+        if os.path.isdir(os.path.dirname(version_file)):
+            log.info("Writing %s" % version_file)
+            with open(version_file, 'w') as wfh:
+                wfh.write(
+                    '# This file was generated by setup.py\n'
+                    '__version__ = {0!r}\n'
+                    '__version_info__ = {1!r}\n'.format(
+                        package.__version__, package.__version_info__
+                    )
+                )
         # Compile SASS files
         static_path = os.path.join(os.path.dirname(package.__file__), 'web', 'static')
         for (dirpath, dirnames, filenames) in os.walk(static_path):
@@ -77,6 +89,8 @@ setup(name=package.__package_name__,
               '**.js',
               '**.png',
               '**.cfg',
+              'web/templates/*.html',
+              'web/static/css/*.scss',
               'web/translations/*/LC_MESSAGES/saltci.mo'
           ]
       },
@@ -97,6 +111,7 @@ setup(name=package.__package_name__,
       salt-ci               = saltci.scripts:run_salt_ci
       salt-ci-key           = saltci.scripts:run_salt_ci_key
       salt-ci-master        = saltci.scripts:run_salt_ci_master
+      salt-ci-shard         = saltci.scripts:run_salt_ci_shard
 
       salt-ci-notif         = saltci.scripts:run_salt_ci_notif
       salt-ci-notif-call    = saltci.scripts:run_salt_ci_notif_call